@@ -0,0 +1,117 @@
+"""
+Compares pickling and copying generated structs and unions using the
+__getstate__()/__setstate__() methods generated by python_types with the
+generic protocol for objects with slots.
+
+Run from the repository root:
+
+    $ python benchmark/bench_pickle.py
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import contextlib
+import copy
+import datetime
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SPEC = """\
+namespace bench
+
+struct Entry
+    name String
+    size UInt64
+    tags List(String)
+    modified Timestamp("%Y-%m-%dT%H:%M:%SZ")
+    parent String?
+
+union Change
+    deleted
+    updated Entry
+
+struct Batch
+    entries List(Entry)
+    changes List(Change)
+"""
+
+N = 200
+
+
+def _report(name, generic, fast):
+    print('{:<10} generic {:8.1f} us  fast {:8.1f} us  speedup {:5.2f}x'.format(
+        name, generic / N * 1e6, fast / N * 1e6, generic / fast))
+
+
+def _generate(target):
+    p = subprocess.Popen(
+        [sys.executable, '-m', 'stone.cli', 'python_types', target, '-'],
+        stdin=subprocess.PIPE, cwd=ROOT)
+    p.communicate(SPEC.encode('utf-8'))
+    if p.wait() != 0:
+        raise SystemExit('Could not generate the benchmark spec')
+
+
+@contextlib.contextmanager
+def _generic_protocol(bb, classes):
+    # Temporarily removes the methods, so that the generic protocol is used.
+    removed = []
+    for cls, names in [(bb.Struct, ['__reduce__', '__copy__', '__deepcopy__']),
+                       (bb.Union, ['__reduce__', '__setstate__', '__copy__', '__deepcopy__'])] + \
+            [(cls, ['__getstate__', '__setstate__']) for cls in classes]:
+        for name in names:
+            removed.append((cls, name, cls.__dict__[name]))
+            delattr(cls, name)
+    try:
+        yield
+    finally:
+        for cls, name, method in removed:
+            setattr(cls, name, method)
+
+
+def main():
+    target = tempfile.mkdtemp()
+    try:
+        _generate(target)
+        sys.path.insert(0, target)
+        import bench  # pylint: disable=import-error
+        import stone_base as bb  # pylint: disable=import-error
+
+        modified = datetime.datetime(2015, 5, 12, 15, 50, 38)
+        entries = [
+            bench.Entry(name='file%d' % i, size=i, tags=['a', 'b'], modified=modified,
+                        parent='/dir')
+            for i in range(100)
+        ]
+        batch = bench.Batch(
+            entries=entries,
+            changes=[bench.Change.updated(e) if i % 2 else bench.Change.deleted
+                     for i, e in enumerate(entries)])
+        protocol = pickle.HIGHEST_PROTOCOL
+        pickled = pickle.dumps(batch, protocol)
+
+        benchmarks = [
+            ('dumps', lambda: pickle.dumps(batch, protocol)),
+            ('loads', lambda: pickle.loads(pickled)),
+            ('copy', lambda: [copy.copy(e) for e in entries]),
+            ('deepcopy', lambda: copy.deepcopy(batch)),
+        ]
+        fast = [timeit.timeit(f, number=N) for _, f in benchmarks]
+        with _generic_protocol(bb, [bench.Entry, bench.Batch]):
+            pickled = pickle.dumps(batch, protocol)
+            generic = [timeit.timeit(f, number=N) for _, f in benchmarks]
+        for (name, _), g, f in zip(benchmarks, generic, fast):
+            _report(name, g, f)
+    finally:
+        shutil.rmtree(target)
+
+
+if __name__ == '__main__':
+    main()
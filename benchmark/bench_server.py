@@ -0,0 +1,173 @@
+"""
+Compares serving an RPC route with the stone_server.Dispatcher, which binds
+each route's codec up front, with hand-rolled WSGI glue that looks up the
+route and calls json_decode() and json_encode() for each request.
+
+Each app is timed when it's called in-process, and when it's called over a
+loopback connection with a local HTTP client and the wsgiref server.
+
+Run from the repository root:
+
+    $ python benchmark/bench_server.py
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import datetime
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import timeit
+
+from six.moves import http_client
+from wsgiref import simple_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SPEC = """\
+namespace bench
+
+struct GetMetadataArg
+    path String
+    include_media_info Boolean = false
+    include_deleted Boolean = false
+
+struct Metadata
+    name String
+    path_lower String
+    size UInt64
+    tags List(String)
+    modified Timestamp("%Y-%m-%dT%H:%M:%SZ")
+
+union GetMetadataError
+    not_found
+
+route get_metadata(GetMetadataArg, Metadata, GetMetadataError)
+"""
+
+N = 2000
+N_HTTP = 300
+
+ARG = json.dumps({'path': '/Homework/math/Prime_Numbers.txt', 'include_deleted': True})
+
+
+class _QuietHandler(simple_server.WSGIRequestHandler):
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+def _report(name, hand_rolled, dispatcher, n):
+    print('{:<10} hand-rolled {:8.1f} us  dispatcher {:8.1f} us  speedup {:5.2f}x'.format(
+        name, hand_rolled / n * 1e6, dispatcher / n * 1e6, hand_rolled / dispatcher))
+
+
+def _generate(target):
+    p = subprocess.Popen(
+        [sys.executable, '-m', 'stone.cli', 'python_types', target, '-', '--', '--server'],
+        stdin=subprocess.PIPE, cwd=ROOT)
+    p.communicate(SPEC.encode('utf-8'))
+    if p.wait() != 0:
+        raise SystemExit('Could not generate the benchmark spec')
+
+
+def _hand_rolled_app(namespaces, handlers, ss):
+    # The glue each service writes without a dispatcher.
+    def app(environ, start_response):
+        _, namespace, name = environ['PATH_INFO'].rsplit('/', 2)
+        route = getattr(namespaces[namespace], 'ROUTES', {}).get(name)
+        if route is None:
+            start_response(str('404 Not Found'), [])
+            return [b'']
+        body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+        arg = ss.json_decode(route.arg_type, body.decode('utf-8'))
+        result = handlers[namespace + '/' + name](arg, environ)
+        out = ss.json_encode(route.result_type, result).encode('utf-8')
+        start_response(str('200 OK'), [(str('Content-Type'), str('application/json')),
+                                       (str('Content-Length'), str(len(out)))])
+        return [out]
+    return app
+
+
+def _call_in_process(app):
+    body = ARG.encode('utf-8')
+    environ = {
+        'REQUEST_METHOD': str('POST'),
+        'PATH_INFO': str('/2/bench/get_metadata'),
+        'CONTENT_LENGTH': str(len(body)),
+    }
+
+    def start_response(status, headers):
+        pass
+
+    def call():
+        environ['wsgi.input'] = io.BytesIO(body)
+        return b''.join(app(environ, start_response))
+    return call
+
+
+def _time_http(app):
+    server = simple_server.make_server('127.0.0.1', 0, app, handler_class=_QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    port = server.server_address[1]
+    body = ARG.encode('utf-8')
+
+    def call():
+        # wsgiref closes the connection after each response.
+        conn = http_client.HTTPConnection('127.0.0.1', port)
+        conn.request('POST', '/2/bench/get_metadata', body,
+                     {'Content-Type': 'application/json'})
+        r = conn.getresponse()
+        r.read()
+        conn.close()
+        if r.status != 200:
+            raise SystemExit('Unexpected status {}'.format(r.status))
+
+    try:
+        return timeit.timeit(call, number=N_HTTP)
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def main():
+    target = tempfile.mkdtemp()
+    try:
+        _generate(target)
+        sys.path.insert(0, target)
+        import bench  # pylint: disable=import-error
+        import stone_serializers as ss  # pylint: disable=import-error
+        import stone_server  # pylint: disable=import-error
+
+        metadata = bench.Metadata(
+            name='Prime_Numbers.txt', path_lower='/homework/math/prime_numbers.txt',
+            size=7212, tags=['school', 'math'],
+            modified=datetime.datetime(2015, 5, 12, 15, 50, 38))
+
+        def get_metadata(arg, request):  # pylint: disable=unused-argument
+            return metadata
+
+        dispatcher = stone_server.Dispatcher({'bench': bench})
+        dispatcher.register('bench/get_metadata', get_metadata)
+        fast = stone_server.WsgiApp(dispatcher, prefix='/2')
+        slow = _hand_rolled_app({'bench': bench}, {'bench/get_metadata': get_metadata}, ss)
+        if _call_in_process(fast)() != _call_in_process(slow)():
+            raise SystemExit('The apps return different responses')
+
+        _report('in-process',
+                timeit.timeit(_call_in_process(slow), number=N),
+                timeit.timeit(_call_in_process(fast), number=N), N)
+        _report('http', _time_http(slow), _time_http(fast), N_HTTP)
+    finally:
+        shutil.rmtree(target)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Compares the specialized ISO 8601 timestamp codec in stone_serializers with
+the generic strftime()/strptime() path.
+
+Run from the repository root:
+
+    $ python benchmark/bench_timestamps.py
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stone.backends.python_rsrc import stone_serializers as ss  # noqa: E402
+from stone.backends.python_rsrc import stone_validators as bv  # noqa: E402
+
+ISO_8601 = '%Y-%m-%dT%H:%M:%SZ'
+N = 100000
+
+
+def _report(name, generic, fast):
+    print('{:<8} generic {:7.3f} us  fast {:7.3f} us  speedup {:5.2f}x'.format(
+        name, generic / N * 1e6, fast / N * 1e6, generic / fast))
+
+
+def main():
+    dt = datetime.datetime(2015, 5, 12, 15, 50, 38)
+    s = dt.strftime(ISO_8601)
+    encode, decode = ss._get_timestamp_codec(ISO_8601)
+
+    generic = timeit.timeit(lambda: ss._strftime(dt, ISO_8601), number=N)
+    fast = timeit.timeit(lambda: encode(dt), number=N)
+    _report('encode', generic, fast)
+
+    generic = timeit.timeit(lambda: datetime.datetime.strptime(s, ISO_8601), number=N)
+    fast = timeit.timeit(lambda: decode(s), number=N)
+    _report('decode', generic, fast)
+
+    # End to end through the JSON-compatible codec, with the generic codec
+    # swapped in for comparison.
+    validator = bv.List(bv.Timestamp(ISO_8601))
+    values = [dt] * 1000
+    encoded = ss.json_compat_obj_encode(validator, values)
+    n = N // len(values)
+    fast_encode = timeit.timeit(
+        lambda: ss.json_compat_obj_encode(validator, values), number=n)
+    fast_decode = timeit.timeit(
+        lambda: ss.json_compat_obj_decode(validator, encoded), number=n)
+    ss._timestamp_codecs[ISO_8601] = (
+        lambda v: ss._strftime(v, ISO_8601),
+        lambda v: datetime.datetime.strptime(v, ISO_8601))
+    try:
+        generic_encode = timeit.timeit(
+            lambda: ss.json_compat_obj_encode(validator, values), number=n)
+        generic_decode = timeit.timeit(
+            lambda: ss.json_compat_obj_decode(validator, encoded), number=n)
+    finally:
+        del ss._timestamp_codecs[ISO_8601]
+    _report('list enc', generic_encode, fast_encode)
+    _report('list dec', generic_decode, fast_decode)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,11 @@
 #!/bin/bash -eux
 
 EXCLUDE='(^example/|^ez_setup\.py$|^setup\.py$)'
+# Modules that use Python 3 syntax, which the Python 2 check skips.
+PY3_ONLY='^stone/backends/python_rsrc/stone_(async|asgi)\.py$'
 
 # Include all Python files registered in Git, that don't occur in $EXCLUDE.
 INCLUDE=$(git ls-files "$@" | grep '\.py$' | grep -Ev "$EXCLUDE" | tr '\n' '\0' | xargs -0 | cat)
 MYPY_CMD=mypy
 $MYPY_CMD $INCLUDE
-$MYPY_CMD --py2 $INCLUDE
+$MYPY_CMD --py2 $(echo "$INCLUDE" | tr ' ' '\n' | grep -Ev "$PY3_ONLY" | tr '\n' ' ')
@@ -1,6 +1,8 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import os
 import re
+import shutil
 
 from stone.backend import CodeBackend
 from stone.backends.helpers import fmt_underscores
@@ -17,6 +19,7 @@ from stone.backends.python_types import (
     class_name_for_data_type,
 )
 from stone.ir import (
+    is_list_type,
     is_nullable_type,
     is_struct_type,
     is_tag_ref,
@@ -58,6 +61,20 @@ recommend using the `contextlib.closing
 <https://docs.python.org/2/library/contextlib.html#contextlib.closing>`_
 context manager to ensure this."""
 
+DOCSTRING_CLOSE_RESPONSE_ASYNC = """\
+If you do not read the entire response body, then you must call close on it,
+otherwise its connection is not returned to the pool."""
+
+UPLOAD_BODY_DOC = (
+    'Contents to upload: bytes, a memoryview, a binary file object or an '
+    'iterable of chunks of bytes. Files are streamed rather than read into '
+    'memory.')
+
+UPLOAD_BODY_DOC_ASYNC = (
+    'Contents to upload: bytes, a memoryview, a binary file object, or an '
+    'iterable or async iterable of chunks of bytes. Files are streamed rather '
+    'than read into memory.')
+
 _cmdline_parser = argparse.ArgumentParser(
     prog='python-client-backend',
     description=(
@@ -103,6 +120,23 @@ _cmdline_parser.add_argument(
     type=str,
     help='The auth type of the client to generate.', 
 )
+_cmdline_parser.add_argument(
+    '--asyncio',
+    action='store_true',
+    help=('Generate "async def" route methods that await an abstract '
+          'request_async() method. stone_async.py, with helpers to fan out '
+          'calls and a reference HTTP transport, is copied to the output '
+          'directory. The generated code requires Python 3.5+.'),
+)
+_cmdline_parser.add_argument(
+    '--cache-size',
+    default=0,
+    type=int,
+    help=('Cache the results of routes with a cache_ttl attribute, for that '
+          'many seconds, in an in-process LRU cache that holds at most this '
+          'many results. stone_cache.py is copied to the output directory. '
+          'Off by default.'),
+)
 
 
 class PythonClientBackend(CodeBackend):
@@ -110,6 +144,8 @@ class PythonClientBackend(CodeBackend):
 
     cmdline_parser = _cmdline_parser
     supported_auth_types = None
+    # Maps routes that are cached to their cache_ttl attribute.
+    _cache_ttls = {}  # type: typing.Dict[typing.Any, typing.Any]
 
     def generate(self, api):
         """Generates a module called "base".
@@ -131,7 +167,22 @@ class PythonClientBackend(CodeBackend):
                 if found_deprecated:
                     break
             self.emit()
-            self._generate_imports(api.namespaces.values())
+            # The default _save_body_to_file() streams with stone_streams, and
+            # _save_body_to_file_async() with stone_async.
+            found_download = any(
+                route.attrs.get('style') == 'download'
+                for namespace in api.namespaces.values() for route in namespace.routes)
+            self._cache_ttls = self._get_cache_ttls(api.namespaces.values())
+            rsrc_modules = []
+            if self.args.asyncio:
+                if found_download or self._cache_ttls:
+                    rsrc_modules.append('stone_async')
+            else:
+                if found_download:
+                    rsrc_modules.append('stone_streams')
+                if self._cache_ttls:
+                    rsrc_modules.append('stone_cache')
+            self._generate_imports(api.namespaces.values(), rsrc_modules)
             self.emit()
             self.emit()  # PEP-8 expects two-blank lines before class def
             self.emit('class %s(object):' % self.args.class_name)
@@ -139,22 +190,208 @@ class PythonClientBackend(CodeBackend):
                 self.emit('__metaclass__ = ABCMeta')
                 self.emit()
                 self.emit('@abstractmethod')
-                self.emit(
-                    'def request(self, route, namespace, arg, arg_binary=None):')
+                if self.args.asyncio:
+                    self.emit('async def request_async(self, route, namespace, arg, '
+                              'arg_binary=None):')
+                else:
+                    self.emit(
+                        'def request(self, route, namespace, arg, arg_binary=None):')
                 with self.indent():
                     self.emit('pass')
                 self.emit()
+                if found_download:
+                    if self.args.asyncio:
+                        self._generate_save_body_to_file_async()
+                    else:
+                        self._generate_save_body_to_file()
+                if self._cache_ttls:
+                    self._generate_route_cache()
+                if self.args.asyncio:
+                    self._generate_batch_routes(api.namespaces.values())
                 self._generate_route_methods(api.namespaces.values())
 
-    def _generate_imports(self, namespaces):
+        rsrc_folder = os.path.join(os.path.dirname(__file__), 'python_rsrc')
+        rsrc_files = []
+        if found_download or self.args.asyncio:
+            # stone_async builds on stone_streams.
+            rsrc_files.append('stone_streams.py')
+        if self.args.asyncio or self.args.cache_size:
+            # stone_async builds on stone_cache.
+            rsrc_files.append('stone_cache.py')
+        if self.args.asyncio:
+            rsrc_files.append('stone_async.py')
+        for rsrc_file in rsrc_files:
+            self.logger.info('Copying %s to output folder', rsrc_file)
+            shutil.copy(os.path.join(rsrc_folder, rsrc_file), self.target_folder_path)
+
+    def _generate_imports(self, namespaces, rsrc_modules=()):
         # Only import namespaces that have user-defined types defined.
         self.emit('from . import (')
         with self.indent():
             for namespace in namespaces:
                 if namespace.data_types:
                     self.emit(fmt_namespace(namespace.name) + ',')
+            for rsrc_module in rsrc_modules:
+                self.emit(rsrc_module + ',')
         self.emit(')')
 
+    def _generate_save_body_to_file(self):
+        """Generates a default for the method that the _to_file variants of
+        download-style routes save the response body with."""
+        self.emit('def _save_body_to_file(self, download_path, body):')
+        with self.indent():
+            self.emit('"""')
+            self.emit_wrapped_text(
+                'Writes the body of a response to a download-style route to a '
+                'path or a binary file object, in chunks. See '
+                'stone_streams.iter_download_chunks() for the bodies it takes.')
+            self.emit('"""')
+            self.emit('stone_streams.save_body_to_file(body, download_path)')
+        self.emit()
+
+    def _generate_save_body_to_file_async(self):
+        """Generates a default for the method that the _to_file variants of
+        download-style routes save the response body with, for --asyncio."""
+        self.emit('async def _save_body_to_file_async(self, download_path, body):')
+        with self.indent():
+            self.emit('"""')
+            self.emit_wrapped_text(
+                'Writes the body of a response to a download-style route to a '
+                'path or a binary file object, in chunks. See '
+                'stone_async.save_body_to_file_async() for the bodies it takes.')
+            self.emit('"""')
+            self.emit('await stone_async.save_body_to_file_async(body, download_path)')
+        self.emit()
+
+    def _get_cache_ttls(self, namespaces):
+        """Returns a map from each route with a cache_ttl attribute to the
+        attribute, or an empty map if --cache-size isn't set."""
+        cache_ttls = {}
+        if not self.args.cache_size:
+            return cache_ttls
+        if self.args.cache_size < 0:
+            raise RuntimeError('--cache-size must not be negative, got {}.'.format(
+                self.args.cache_size))
+        for namespace in namespaces:
+            for route in namespace.routes:
+                ttl = route.attrs.get('cache_ttl')
+                if ttl is None:
+                    continue
+                if (route.attrs.get('style') or 'rpc') != 'rpc':
+                    raise RuntimeError('{!r} can not be cached: only RPC-style routes '
+                                       'can have a cache_ttl.'.format(route))
+                if isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or ttl <= 0:
+                    raise RuntimeError('The cache_ttl of {!r} must be a positive number of '
+                                       'seconds, got {!r}.'.format(route, ttl))
+                cache_ttls[route] = ttl
+        return cache_ttls
+
+    def _generate_route_cache(self):
+        """Generates a property for the cache that the methods for routes with
+        a cache_ttl attribute go through."""
+        if self.args.asyncio:
+            cache_class = 'stone_async.AsyncRouteCache'
+        else:
+            cache_class = 'stone_cache.RouteCache'
+        self.emit('@property')
+        self.emit('def route_cache(self):')
+        with self.indent():
+            self.emit('"""')
+            self.emit_wrapped_text(
+                'The in-process cache of the results of routes with a cache_ttl '
+                'attribute, with hit and miss counters per route. It is created '
+                'on first use; assign _route_cache to share one between '
+                'clients.')
+            self.emit('"""')
+            self.emit("cache = self.__dict__.get('_route_cache')")
+            self.emit('if cache is None:')
+            with self.indent():
+                self.emit('cache = self.__dict__.setdefault(')
+                with self.indent():
+                    self.emit("'_route_cache', {}(max_size={}))".format(
+                        cache_class, self.args.cache_size))
+            self.emit('return cache')
+        self.emit()
+
+    def _generate_batch_routes(self, namespaces):
+        """Generates a map from each route with a batch attribute to its batch
+        counterpart, for stone_async.CoalescingTransport."""
+        entries = []
+        for namespace in namespaces:
+            for route in namespace.routes:
+                if route.attrs.get('batch'):
+                    entries.append(self._batch_route_entry(namespace, route))
+        if not entries:
+            return
+        self.emit('# Routes with a batch counterpart, mapped to (batch route, argument')
+        self.emit('# field, result field, result tag, error tag).')
+        with self.block('_batch_routes_ =', delim=('{', '}')):
+            for entry in entries:
+                self.emit(entry)
+        self.emit()
+
+    def _batch_route_entry(self, namespace, route):
+        """
+        Checks that the batch counterpart of a route has the expected shape,
+        and returns the entry of the route in the _batch_routes_ map.
+
+        The argument of the batch route must be a struct with one field, a
+        list of the route's arguments. Its result must be a list, or a struct
+        with one field that is a list, with an entry for each argument. The
+        entries are the route's results, or a union with a tag for the
+        route's result and optionally one for its error.
+        """
+        batch_name = route.attrs['batch']
+        name, _, version = batch_name.partition(':')
+        try:
+            batch_route = namespace.routes_by_name[name].at_version[int(version or 1)]
+        except (KeyError, ValueError):
+            raise RuntimeError('The batch route {!r} of {!r} is not a route in the {} '
+                               'namespace.'.format(batch_name, route, namespace.name))
+
+        def check(condition, expected):
+            if not condition:
+                raise RuntimeError('{!r} can not be the batch counterpart of {!r}: {}.'.format(
+                    batch_route, route, expected))
+
+        arg_data_type = batch_route.arg_data_type
+        check(not is_void_type(route.arg_data_type) and
+              is_struct_type(arg_data_type) and
+              len(arg_data_type.all_fields) == 1 and
+              is_list_type(arg_data_type.all_fields[0].data_type) and
+              arg_data_type.all_fields[0].data_type.data_type is route.arg_data_type,
+              'its argument must be a struct with one field, a list of the arguments')
+        arg_field = fmt_var(arg_data_type.all_fields[0].name, True)
+
+        result_data_type = batch_route.result_data_type
+        result_field = None
+        if is_struct_type(result_data_type) and len(result_data_type.all_fields) == 1:
+            result_field = fmt_var(result_data_type.all_fields[0].name, True)
+            result_data_type = result_data_type.all_fields[0].data_type
+        check(is_list_type(result_data_type),
+              'its result must be a list, or a struct with one field that is a list')
+
+        entry_data_type = result_data_type.data_type
+        result_tag = error_tag = None
+        if not _is_same_type(entry_data_type, route.result_data_type):
+            check(is_union_type(entry_data_type),
+                  'its result entries must be results, or a union of results and errors')
+            for field in entry_data_type.all_fields:
+                if result_tag is None and _is_same_type(field.data_type, route.result_data_type):
+                    result_tag = field.name
+                elif (error_tag is None and not is_void_type(route.error_data_type) and
+                        field.data_type is route.error_data_type):
+                    error_tag = field.name
+            check(result_tag is not None,
+                  'its result entries must be results, or a union of results and errors')
+
+        return '{}.{}: ({}.{}, {}),'.format(
+            fmt_namespace(namespace.name),
+            fmt_func(route.name, version=route.version),
+            fmt_namespace(namespace.name),
+            fmt_func(batch_route.name, version=batch_route.version),
+            ', '.join(fmt_obj(v) for v in [arg_field, result_field, result_tag, error_tag]))
+
     def _generate_route_methods(self, namespaces):
         """Creates methods for the routes in each namespace. All data types
         and routes are represented as Python classes."""
@@ -236,16 +473,23 @@ class PythonClientBackend(CodeBackend):
             extra_return_arg = None
             footer = None
             if request_binary_body:
-                extra_request_args = [('f',
-                                       'bytes',
-                                       'Contents to upload.')]
+                if self.args.asyncio:
+                    upload_doc = UPLOAD_BODY_DOC_ASYNC
+                else:
+                    upload_doc = UPLOAD_BODY_DOC
+                extra_request_args = [('f', None, upload_doc)]
             elif download_to_file:
                 extra_request_args = [('download_path',
-                                       'str',
-                                       'Path on local machine to save file.')]
+                                       None,
+                                       'Path on local machine, or binary file '
+                                       'object, to save file to.')]
             if response_binary_body and not download_to_file:
-                extra_return_arg = ':class:`requests.models.Response`'
-                footer = DOCSTRING_CLOSE_RESPONSE
+                if self.args.asyncio:
+                    extra_return_arg = ':class:`stone_async.ResponseBody`'
+                    footer = DOCSTRING_CLOSE_RESPONSE_ASYNC
+                else:
+                    extra_return_arg = ':class:`requests.models.Response`'
+                    footer = DOCSTRING_CLOSE_RESPONSE
 
             if route.doc:
                 func_docstring = self.process_doc(route.doc, self._docf)
@@ -287,12 +531,29 @@ class PythonClientBackend(CodeBackend):
                 'arg']
             if request_binary_body:
                 args.append('f')
+            elif route in self._cache_ttls:
+                args.append(fmt_obj(self._cache_ttls[route]))
+                args.append('self.request_async' if self.args.asyncio else 'self.request')
             else:
                 args.append('None')
-            self.generate_multiline_list(args, 'r = self.request', compact=False)
+            if route in self._cache_ttls:
+                if self.args.asyncio:
+                    self.generate_multiline_list(
+                        args, 'r = await self.route_cache.call_async', compact=False)
+                else:
+                    self.generate_multiline_list(
+                        args, 'r = self.route_cache.call', compact=False)
+            elif self.args.asyncio:
+                self.generate_multiline_list(
+                    args, 'r = await self.request_async', compact=False)
+            else:
+                self.generate_multiline_list(args, 'r = self.request', compact=False)
 
             if download_to_file:
-                self.emit('self._save_body_to_file(download_path, r[1])')
+                if self.args.asyncio:
+                    self.emit('await self._save_body_to_file_async(download_path, r[1])')
+                else:
+                    self.emit('self._save_body_to_file(download_path, r[1])')
                 if is_void_type(result_data_type):
                     self.emit('return None')
                 else:
@@ -340,7 +601,11 @@ class PythonClientBackend(CodeBackend):
 
         method_name = fmt_func(route.name + method_name_suffix, version=route.version)
         namespace_name = fmt_underscores(namespace.name)
-        self.generate_multiline_list(args, 'def {}_{}'.format(namespace_name, method_name), ':')
+        self.generate_multiline_list(
+            args,
+            '{}def {}_{}'.format(
+                'async ' if self.args.asyncio else '', namespace_name, method_name),
+            ':')
 
     def _maybe_generate_deprecation_warning(self, route):
         if route.deprecated:
@@ -547,3 +812,7 @@ class PythonClientBackend(CodeBackend):
                 fmt_var(value.tag_name))
         else:
             return fmt_obj(value)
+
+
+def _is_same_type(data_type1, data_type2):
+    return data_type1 is data_type2 or (is_void_type(data_type1) and is_void_type(data_type2))
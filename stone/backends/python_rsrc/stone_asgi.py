@@ -0,0 +1,192 @@
+"""
+An ASGI adapter for the stone_server.Dispatcher, which serves the routes of
+the modules generated by the python_types backend.
+
+Unlike the other modules dropped into a project that uses Stone, this one
+requires Python 3.5 or newer. It is copied into the output folder by the
+python_types backend with the --server option, next to stone_server.py.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import asyncio
+
+try:
+    from . import stone_server
+    from . import stone_streams
+    from . import stone_validators as bv
+except (ImportError, SystemError, ValueError):
+    # Catch errors raised when importing a relative module when not in a package.
+    # This makes testing this file directly (outside of a package) easier.
+    import stone_server  # type: ignore
+    import stone_streams  # type: ignore
+    import stone_validators as bv  # type: ignore
+
+_MYPY = False
+if _MYPY:
+    import typing  # noqa: F401 # pylint: disable=import-error,unused-import,useless-suppression
+
+_ARG_HEADER = stone_server.ARG_HEADER.lower().encode('ascii')
+_RESULT_HEADER = stone_server.RESULT_HEADER.lower().encode('ascii')
+
+_JSON_CONTENT_TYPE = (b'content-type', b'application/json')
+_TEXT_CONTENT_TYPE = (b'content-type', b'text/plain; charset=utf-8')
+_BINARY_CONTENT_TYPE = (b'content-type', b'application/octet-stream')
+
+class AsgiBody(object):
+    """The body of an upload request to an AsgiApp. Read it with read() or
+    read_chunk(), or iterate over its chunks with ``async for``."""
+
+    def __init__(self, receive, chunk=b'', more_body=True):
+        self._receive = receive
+        self._chunk = chunk
+        self._more_body = more_body
+
+    async def read_chunk(self):
+        """Returns the next chunk of the body, or b'' at its end."""
+        chunk = self._chunk
+        self._chunk = b''
+        while not chunk and self._more_body:
+            message = await self._receive()
+            if message['type'] == 'http.disconnect':
+                raise ConnectionResetError('The client disconnected')
+            chunk = message.get('body', b'')
+            self._more_body = message.get('more_body', False)
+        return chunk
+
+    async def read(self):
+        """Returns the rest of the body."""
+        chunks = []
+        while True:
+            chunk = await self.read_chunk()
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.read_chunk()
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+class AsgiApp(object):
+    """An ASGI application that serves the routes of a
+    stone_server.Dispatcher at ``<prefix>/<namespace>/<route>``.
+
+    Handlers can be functions or coroutine functions. They're called with
+    the ASGI scope as the request, and upload handlers get an AsgiBody.
+    Handlers run on the event loop, so one that blocks, e.g. on a database
+    call, holds up every other request. Make it a coroutine function that
+    runs the blocking work with loop.run_in_executor() instead.
+
+    Download bodies can be bytes, a memoryview, a binary file object, or an
+    iterable or async iterable of chunks of bytes. Files are read in the
+    loop's default executor, and closed once they've been sent. Iterables
+    are iterated on the event loop, so they shouldn't block.
+    """
+
+    def __init__(self, dispatcher, prefix=''):
+        self.dispatcher = dispatcher
+        self._paths = dispatcher.paths
+        self._prefix = prefix.rstrip('/') + '/'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type {!r}'.format(scope['type']))
+
+        path = scope['path']
+        bound = None
+        if path.startswith(self._prefix):
+            bound = self._paths.get(path[len(self._prefix):])
+        if bound is None or bound.handler is None:
+            await _respond(send, 404, _TEXT_CONTENT_TYPE, b'Unknown route')
+            return
+        if scope['method'] != 'POST':
+            await send({'type': 'http.response.start', 'status': 405,
+                        'headers': [(b'allow', b'POST'), (b'content-length', b'0')]})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        style = bound.style
+        body = AsgiBody(receive)
+        try:
+            if style == 'rpc':
+                arg = bound.decode_arg(await body.read())
+            else:
+                serialized_arg = b''
+                for name, value in scope['headers']:
+                    if name == _ARG_HEADER:
+                        serialized_arg = value
+                        break
+                arg = bound.decode_arg(serialized_arg)
+        except bv.ValidationError as e:
+            await _respond(send, 400, _TEXT_CONTENT_TYPE,
+                           'Bad argument: {}'.format(e).encode('utf-8'))
+            return
+
+        try:
+            if style == 'upload':
+                r = bound.handler(arg, body, scope)
+            else:
+                r = bound.handler(arg, scope)
+            if hasattr(r, '__await__'):
+                r = await r
+        except stone_server.RouteError as e:
+            await _respond(send, 409, _JSON_CONTENT_TYPE, bound.encode_error(e.error))
+            return
+        if style != 'download':
+            await _respond(send, 200, _JSON_CONTENT_TYPE, bound.encode_result(r))
+            return
+
+        result, download_body = r
+        try:
+            headers = [_BINARY_CONTENT_TYPE, (_RESULT_HEADER, bound.encode_result(result))]
+            length = stone_streams.body_length(download_body)
+            if length is not None:
+                headers.append((b'content-length', str(length).encode('ascii')))
+            await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+            if stone_streams.is_bytes_like(download_body):
+                await send({'type': 'http.response.body', 'body': bytes(download_body)})
+                return
+            if hasattr(download_body, '__aiter__'):
+                async for chunk in download_body:
+                    await send({'type': 'http.response.body', 'body': bytes(chunk),
+                                'more_body': True})
+            elif hasattr(download_body, 'read'):
+                # Chunks are sent as they're read, so they can't share a buffer.
+                loop = asyncio.get_event_loop()
+                while True:
+                    chunk = await loop.run_in_executor(
+                        None, download_body.read, stone_streams.DEFAULT_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    await send({'type': 'http.response.body', 'body': chunk,
+                                'more_body': True})
+            else:
+                for chunk in download_body:
+                    await send({'type': 'http.response.body', 'body': bytes(chunk),
+                                'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(download_body, 'close'):
+                download_body.close()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+async def _respond(send, status, content_type, body):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [content_type, (b'content-length', str(len(body)).encode('ascii'))]})
+    await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,760 @@
+"""
+Asyncio helpers for clients generated by the python_client backend with the
+--asyncio option.
+
+Unlike the other modules dropped into a project that uses Stone, this one
+requires Python 3.5 or newer. It is copied into the output folder by the
+python_client backend, next to the modules copied by the python_types backend.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import asyncio
+import collections
+import functools
+import json
+import re
+import ssl
+
+from urllib.parse import urlsplit
+
+try:
+    from . import stone_cache
+    from . import stone_serializers as ss
+    from . import stone_streams
+except (ImportError, SystemError, ValueError):
+    # Catch errors raised when importing a relative module when not in a package.
+    # This makes testing this file directly (outside of a package) easier.
+    import stone_cache  # type: ignore
+    import stone_serializers as ss  # type: ignore
+    import stone_streams  # type: ignore
+
+_MYPY = False
+if _MYPY:
+    import typing  # noqa: F401 # pylint: disable=import-error,unused-import,useless-suppression
+
+# --------------------------------------------------------------
+# Fan-out
+
+# The number of calls fan_out() and gather_bounded() have in flight at once
+# by default.
+DEFAULT_CONCURRENCY = 64
+
+# Returned by next() once the items of a fan_out() are used up.
+_EXHAUSTED = object()
+
+async def fan_out(func, items, limit=DEFAULT_CONCURRENCY, return_exceptions=False):
+    """Calls a coroutine function with each item, at most ``limit`` at a time.
+
+    Items are taken from ``items`` lazily: the next one isn't taken, and no
+    task is created for it, until fewer than ``limit`` calls are in flight. A
+    generator of tens of thousands of arguments is never turned into more
+    than ``limit`` pending tasks.
+
+    Args:
+        func: A coroutine function that takes one item, e.g. a route method
+            of a client such as ``client.files_get_metadata``.
+        items: An iterable of arguments.
+        limit (int): The maximum number of calls in flight.
+        return_exceptions (bool): If set, exceptions are returned in place of
+            results. Otherwise, the first exception stops new calls from
+            being made, cancels the calls in flight and is raised.
+
+    Returns:
+        list: The results, in the order of ``items``.
+    """
+    if limit < 1:
+        raise ValueError('limit must be at least 1, got %r' % limit)
+    semaphore = asyncio.Semaphore(limit)
+    failed = []  # type: typing.List[asyncio.Future]
+
+    def done(task):
+        semaphore.release()
+        if not return_exceptions and not task.cancelled() and task.exception() is not None:
+            failed.append(task)
+
+    tasks = []  # type: typing.List[asyncio.Future]
+    iterator = iter(items)
+    try:
+        while True:
+            # Wait for a free slot before taking the next item, so that an
+            # item (e.g. a coroutine from gather_bounded) isn't taken and
+            # then dropped when a call fails.
+            await semaphore.acquire()
+            if failed:
+                break
+            item = next(iterator, _EXHAUSTED)
+            if item is _EXHAUSTED:
+                break
+            task = asyncio.ensure_future(func(item))
+            task.add_done_callback(done)
+            tasks.append(task)
+        return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+    except BaseException:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        # Retrieve the exceptions that aren't raised, so that they aren't
+        # logged as never retrieved.
+        for task in tasks:
+            if not task.cancelled():
+                task.exception()
+        raise
+
+def _identity(aw):
+    return aw
+
+async def gather_bounded(aws, limit=DEFAULT_CONCURRENCY, return_exceptions=False):
+    """Like asyncio.gather(), but runs at most ``limit`` awaitables at a time.
+
+    Coroutines are only scheduled once there's room for them, so ``aws`` can
+    be a generator, e.g.
+    ``(client.files_get_metadata(path) for path in paths)``.
+
+    Args:
+        aws: An iterable of awaitables.
+        limit (int): The maximum number of awaitables in flight.
+        return_exceptions (bool): As for fan_out().
+
+    Returns:
+        list: The results, in the order of ``aws``.
+    """
+    return await fan_out(_identity, aws, limit, return_exceptions)
+
+# --------------------------------------------------------------
+# HTTP Transport
+
+# The maximum number of connections an HttpTransport opens by default.
+DEFAULT_MAX_CONNECTIONS = 16
+
+# The number of seconds an HttpTransport waits for a response by default.
+DEFAULT_TIMEOUT = 60.0
+
+# JSON in header values is escaped down to ASCII.
+_HEADER_UNSAFE_RE = re.compile('[^\x00-\x7e]')
+
+def _header_safe_json(s):
+    return _HEADER_UNSAFE_RE.sub(lambda m: json.dumps(m.group(0))[1:-1], s)
+
+class ApiError(Exception):
+    """Raised when a route returns an error: by HttpTransport for responses
+    with status 409, and by CoalescingTransport for error entries in the
+    result of a batch route."""
+
+    def __init__(self, route, error, body):
+        super(ApiError, self).__init__(route.name, error)
+        self.route = route
+        # The route's error, decoded with its error type.
+        self.error = error
+        # The response body, or None for an entry of a batch.
+        self.body = body
+
+class HttpError(Exception):
+    """Raised by HttpTransport for responses with a status other than 200 or
+    409."""
+
+    def __init__(self, status, reason, body):
+        super(HttpError, self).__init__(status, reason)
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+_Response = collections.namedtuple('_Response', ['status', 'reason', 'headers', 'body'])
+
+class ConnectionPool(object):
+    """A bounded pool of keep-alive connections to one host.
+
+    At most ``max_connections`` connections are checked out at a time;
+    acquire() waits for one to be released beyond that. Released connections
+    are kept open and handed out again, most recently used first.
+    """
+
+    def __init__(self, host, port, ssl_context=None, max_connections=DEFAULT_MAX_CONNECTIONS):
+        if max_connections < 1:
+            raise ValueError('max_connections must be at least 1, got %r' % max_connections)
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.max_connections = max_connections
+        # The number of connections that have been opened.
+        self.opened = 0
+        self._idle = collections.deque()  # type: typing.Deque[typing.Tuple[typing.Any, ...]]
+        # Created on first use, so that it belongs to the running event loop.
+        self._semaphore = None  # type: typing.Optional[asyncio.Semaphore]
+
+    async def acquire(self):
+        """Returns a (reader, writer) pair, and whether it has been used
+        before."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        await self._semaphore.acquire()
+        try:
+            while self._idle:
+                conn = self._idle.pop()
+                if not conn[0].at_eof() and not conn[1].transport.is_closing():
+                    return conn, True
+                conn[1].close()
+            conn = await asyncio.open_connection(self.host, self.port, ssl=self.ssl_context)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        self.opened += 1
+        return conn, False
+
+    def release(self, conn, reusable):
+        """Returns a connection from acquire() to the pool, or closes it if
+        it can't be reused."""
+        if reusable:
+            self._idle.append(conn)
+        else:
+            conn[1].close()
+        self._semaphore.release()
+
+    def close(self):
+        """Closes the idle connections."""
+        while self._idle:
+            self._idle.pop()[1].close()
+
+async def _read_head(reader, status_line):
+    version, status, reason = (status_line.decode('latin-1').rstrip('\r\n') + ' ').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError('Connection closed while reading response headers')
+        if line in (b'\r\n', b'\n'):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+        keep_alive = connection != 'close'
+    else:
+        keep_alive = connection == 'keep-alive'
+    return int(status), reason.strip(), headers, keep_alive
+
+class ResponseBody(object):
+    """The body of a response, streamed from its connection.
+
+    HttpTransport returns one for download-style routes. Read it in chunks
+    with ``async for chunk in body`` or read_chunk(), or all at once with
+    read(). The connection is returned to the pool once the body has been
+    read to the end. Call close() to give up on the rest of it, which closes
+    the connection; ``async with body`` does so too.
+
+    If the ``timeout`` attribute isn't None, a read that waits that many
+    seconds for data raises asyncio.TimeoutError and closes the connection.
+    """
+
+    def __init__(self, reader, status, headers, keep_alive, release):
+        self.timeout = None  # type: typing.Optional[float]
+        self._reader = reader
+        self._release = release
+        self._done = False
+        self._chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+        # The number of bytes left in the body, or in the current chunk.
+        self._remaining = 0  # type: typing.Optional[int]
+        self._keep_alive = keep_alive
+        if self._chunked:
+            pass
+        elif 'content-length' in headers:
+            self._remaining = int(headers['content-length'])
+            if self._remaining == 0:
+                self._finish(True)
+        elif status in (204, 304) or 100 <= status < 200:
+            self._finish(True)
+        else:
+            # The body ends when the connection is closed.
+            self._remaining = None
+            self._keep_alive = False
+
+    def _finish(self, reusable):
+        self._done = True
+        self._release(reusable and self._keep_alive)
+
+    async def read_chunk(self, chunk_size=stone_streams.DEFAULT_CHUNK_SIZE):
+        """Returns the next chunk of at most ``chunk_size`` bytes, or an empty
+        bytes object at the end of the body."""
+        if self._done:
+            return b''
+        if self.timeout is None:
+            return await self._read_chunk(chunk_size)
+        return await asyncio.wait_for(self._read_chunk(chunk_size), self.timeout)
+
+    async def _read_chunk(self, chunk_size):
+        try:
+            if self._chunked and self._remaining == 0:
+                self._remaining = int((await self._reader.readline()).split(b';', 1)[0], 16)
+                if self._remaining == 0:
+                    # Skip trailers
+                    while (await self._reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    self._finish(True)
+                    return b''
+            if self._remaining is None:
+                data = await self._reader.read(chunk_size)
+                if not data:
+                    self._finish(False)
+                return data
+            data = await self._reader.read(min(chunk_size, self._remaining))
+            if not data:
+                raise ConnectionResetError('Connection closed before the end of the body')
+            self._remaining -= len(data)
+            if self._remaining == 0:
+                if self._chunked:
+                    await self._reader.readexactly(2)
+                else:
+                    self._finish(True)
+            return data
+        except BaseException:
+            self._finish(False)
+            raise
+
+    async def read(self):
+        """Returns the rest of the body."""
+        chunks = []
+        while True:
+            chunk = await self.read_chunk()
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.read_chunk()
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+    def close(self):
+        """Closes the connection, unless the body has been read to the end."""
+        if not self._done:
+            self._finish(False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _iter_file_chunks(f):
+    # Unlike stone_streams.iter_body_chunks(), doesn't reuse a buffer, as
+    # transports can hold on to the data they're given.
+    while True:
+        chunk = f.read(stone_streams.DEFAULT_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield chunk
+
+async def _write_chunk(writer, chunk):
+    # An empty chunk would end the body.
+    if chunk:
+        writer.write(b'%x\r\n' % len(chunk))
+        writer.write(chunk)
+        writer.write(b'\r\n')
+        await writer.drain()
+
+async def _write_body(writer, body, length):
+    if body is None:
+        pass
+    elif length is None:
+        # Sent with chunked transfer encoding
+        if hasattr(body, '__aiter__'):
+            async for chunk in body:
+                await _write_chunk(writer, chunk)
+        else:
+            for chunk in _iter_file_chunks(body) if hasattr(body, 'read') else body:
+                await _write_chunk(writer, chunk)
+        writer.write(b'0\r\n\r\n')
+    elif stone_streams.is_bytes_like(body):
+        writer.write(body)
+    elif length:
+        loop = asyncio.get_event_loop()
+        if hasattr(loop, 'sendfile'):
+            # Uses os.sendfile() where it can.
+            await writer.drain()
+            await loop.sendfile(writer.transport, body, body.tell(), length)
+        else:
+            for chunk in _iter_file_chunks(body):
+                writer.write(chunk)
+                await writer.drain()
+    await writer.drain()
+
+async def _write_response_body(body, f):
+    if not hasattr(body, '__aiter__'):
+        stone_streams.save_body_to_file(body, f)
+        return
+    try:
+        async for chunk in body:
+            f.write(chunk)
+    finally:
+        body.close()
+
+async def save_body_to_file_async(body, download_path):
+    """Writes a download body to a path, or to a binary file object, in
+    chunks.
+
+    Args:
+        body: An async iterable of chunks that has a close() method, e.g. a
+            ResponseBody, or a body that stone_streams.save_body_to_file()
+            takes.
+        download_path: A path, or a binary file object opened for writing.
+    """
+    if hasattr(download_path, 'write'):
+        await _write_response_body(body, download_path)
+    else:
+        with open(download_path, 'wb') as f:
+            await _write_response_body(body, f)
+
+class HttpTransport(object):
+    """Implements request_async() for a client generated with --asyncio, over
+    HTTP/1.1 with a ConnectionPool of keep-alive connections.
+
+    Inherit from it and the generated class::
+
+        class Client(HttpTransport, Base):
+            pass
+
+        async with Client('https://api.myservice.xyz/2') as client:
+            r = await client.calc_eval(left=1, right=2)
+
+    Each route is POSTed to ``<base_url>/<namespace>/<route>``, where versioned
+    routes have a ``_v<version>`` suffix. The ``style`` route attribute picks
+    how the argument and result are carried:
+
+    * ``rpc`` (also used if unset): both are JSON bodies.
+    * ``upload``: the argument is JSON in the Stone-API-Arg header and the
+      body is ``arg_binary``. The result is a JSON body.
+    * ``download``: the argument is JSON in the Stone-API-Arg header, and the
+      result is JSON in the Stone-API-Result response header. The method
+      returns a (result, ResponseBody) tuple.
+
+    Upload bodies can be bytes, a memoryview, a binary file object, or an
+    iterable or async iterable of chunks of bytes. Regular files are sent
+    with loop.sendfile(), which uses os.sendfile() where it can. Bodies
+    whose length isn't known up front are sent with chunked transfer
+    encoding. Download bodies are streamed, and the _to_file variants of
+    download routes write them in chunks.
+
+    For responses with status 409, the ``error`` key of the JSON body is
+    decoded with the route's error type and raised as an ApiError. Other
+    statuses raise HttpError.
+    """
+
+    arg_header = 'Stone-API-Arg'
+    result_header = 'Stone-API-Result'
+
+    def __init__(self, base_url, headers=None, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 timeout=DEFAULT_TIMEOUT, ssl_context=None):
+        """
+        Args:
+            base_url (str): The URL routes are relative to.
+            headers (dict): Extra headers to send with each request, e.g.
+                Authorization.
+            max_connections (int): The maximum number of connections, and so
+                of requests in flight.
+            timeout (float): The number of seconds to wait for a response,
+                and for each read of the body of a download. None waits
+                forever.
+            ssl_context (ssl.SSLContext): Used for https URLs. Defaults to
+                ssl.create_default_context().
+        """
+        parts = urlsplit(base_url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('Expected an http or https URL, got %r' % base_url)
+        if parts.scheme == 'https':
+            ssl_context = ssl_context or ssl.create_default_context()
+            port = parts.port or 443
+        else:
+            ssl_context = None
+            port = parts.port or 80
+        self.pool = ConnectionPool(parts.hostname, port, ssl_context, max_connections)
+        self.timeout = timeout
+        self._path = parts.path.rstrip('/')
+        self._headers = 'Host: {}\r\n{}'.format(
+            parts.netloc,
+            ''.join('{}: {}\r\n'.format(k, v) for k, v in (headers or {}).items()))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Closes the idle connections."""
+        self.pool.close()
+
+    async def request_async(self, route, namespace, arg, arg_binary=None):
+        style = route.attrs.get('style') or 'rpc'
+        if route.version > 1:
+            route_name = '{}_v{}'.format(route.name, route.version)
+        else:
+            route_name = route.name
+        head = ['POST {}/{}/{} HTTP/1.1\r\n'.format(self._path, namespace, route_name),
+                self._headers]
+        serialized_arg = ss.json_encode(route.arg_type, arg)
+        if style == 'rpc':
+            body = serialized_arg.encode('utf-8')
+            head.append('Content-Type: application/json\r\n')
+        else:
+            head.append('{}: {}\r\n'.format(self.arg_header, _header_safe_json(serialized_arg)))
+            if style == 'upload':
+                body = b'' if arg_binary is None else arg_binary
+                head.append('Content-Type: application/octet-stream\r\n')
+            else:
+                body = b''
+        length = None if hasattr(body, '__aiter__') else stone_streams.body_length(body)
+        if length is None:
+            head.append('Transfer-Encoding: chunked\r\n\r\n')
+        else:
+            head.append('Content-Length: {}\r\n\r\n'.format(length))
+
+        round_trip = self._round_trip(
+            ''.join(head).encode('latin-1'), body, length, style == 'download')
+        if self.timeout is None:
+            r = await round_trip
+        else:
+            r = await asyncio.wait_for(round_trip, self.timeout)
+
+        if r.status == 200:
+            if style == 'download':
+                try:
+                    result = ss.json_decode(
+                        route.result_type, r.headers[self.result_header.lower()])
+                except BaseException:
+                    r.body.close()
+                    raise
+                return result, r.body
+            return ss.json_decode(route.result_type, r.body.decode('utf-8'))
+        elif r.status == 409:
+            error = ss.json_compat_obj_decode(
+                route.error_type, json.loads(r.body.decode('utf-8'))['error'])
+            raise ApiError(route, error, r.body)
+        raise HttpError(r.status, r.reason, r.body)
+
+    async def _round_trip(self, head, body, length, stream):
+        # Only bodies that haven't been consumed can be sent again.
+        replayable = stone_streams.is_bytes_like(body)
+        while True:
+            conn, reused = await self.pool.acquire()
+            reader, writer = conn
+            try:
+                writer.write(head)
+                await _write_body(writer, body, length)
+                status_line = await reader.readline()
+                if not status_line:
+                    raise ConnectionResetError('Connection closed before a response')
+                status, reason, headers, keep_alive = await _read_head(reader, status_line)
+            except ConnectionError:
+                self.pool.release(conn, False)
+                if reused and replayable:
+                    # The server closed the connection while it was idle.
+                    # Try again on another one.
+                    continue
+                raise
+            except BaseException:
+                self.pool.release(conn, False)
+                raise
+            response_body = ResponseBody(reader, status, headers, keep_alive,
+                                         functools.partial(self.pool.release, conn))
+            if stream and status == 200:
+                # The caller reads the body after the round trip's timeout
+                # is over, so each of its reads has a timeout of its own.
+                response_body.timeout = self.timeout
+                return _Response(status, reason, headers, response_body)
+            return _Response(status, reason, headers, await response_body.read())
+
+    async def _save_body_to_file_async(self, download_path, body):
+        """Writes a download body to a path or a binary file object, in
+        chunks."""
+        await save_body_to_file_async(body, download_path)
+
+# --------------------------------------------------------------
+# Coalescing
+
+# The number of seconds CoalescingTransport collects calls for a batch by
+# default.
+DEFAULT_BATCH_WINDOW = 0.002
+
+# The maximum number of calls CoalescingTransport sends in a batch by default.
+DEFAULT_MAX_BATCH_SIZE = 100
+
+class CoalescingTransport(object):
+    """Coalesces calls to the routes of a client generated with --asyncio that
+    opt in with route attributes.
+
+    Put it before the transport in the bases of the client::
+
+        class Client(CoalescingTransport, HttpTransport, Base):
+            pass
+
+    A call to a route with a true ``coalesce`` attribute, with the same
+    argument as a call in flight, shares the request and result of that call
+    (single-flight). Arguments are compared by their canonical JSON encoding.
+
+    Calls to a route with a ``batch`` attribute, which names a batch
+    counterpart in the same namespace, are collected for ``batch_window``
+    seconds, or until there are ``max_batch_size`` of them, and sent as one
+    call to the batch route. Identical calls among them are coalesced too. A
+    call that's alone in its window is sent to the route itself. An error
+    entry in the result of the batch route is raised as an ApiError.
+
+    Coalesced calls return the same result object, which callers shouldn't
+    mutate. The python_types backend's --frozen option enforces this. Calls
+    to upload and download routes are never coalesced or batched, since
+    their bodies can only be read once.
+    """
+
+    def __init__(self, *args, batch_window=DEFAULT_BATCH_WINDOW,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE, **kwargs):
+        super(CoalescingTransport, self).__init__(*args, **kwargs)
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        # The number of calls that shared the request of another call.
+        self.coalesced_calls = 0
+        # The number of requests that were made to batch routes.
+        self.batch_requests = 0
+        # Generated for routes with a batch attribute.
+        self._batch_route_map = getattr(self, '_batch_routes_', {})
+        self._in_flight = {}  # type: typing.Dict[typing.Any, asyncio.Future]
+        self._batches = {}  # type: typing.Dict[typing.Any, typing.List[typing.Any]]
+        self._batch_tasks = set()  # type: typing.Set[asyncio.Future]
+
+    async def request_async(self, route, namespace, arg, arg_binary=None):
+        batch = self._batch_route_map.get(route)
+        if ((route.attrs.get('style') or 'rpc') != 'rpc' or
+                (batch is None and not route.attrs.get('coalesce'))):
+            return await super(CoalescingTransport, self).request_async(
+                route, namespace, arg, arg_binary)
+
+        key = (route, ss.canonical_json_encode(route.arg_type, arg))
+        future = self._in_flight.get(key)
+        if future is None:
+            if batch is None:
+                future = asyncio.ensure_future(
+                    super(CoalescingTransport, self).request_async(route, namespace, arg))
+            else:
+                future = self._add_to_batch(route, namespace, arg, batch)
+            self._in_flight[key] = future
+            future.add_done_callback(functools.partial(self._flight_done, key))
+        else:
+            self.coalesced_calls += 1
+        # A call that's cancelled doesn't cancel the calls it's coalesced with.
+        return await asyncio.shield(future)
+
+    def _flight_done(self, key, future):
+        del self._in_flight[key]
+        if not future.cancelled():
+            # Retrieve the exception, in case every call was cancelled.
+            future.exception()
+
+    def _add_to_batch(self, route, namespace, arg, batch):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        pending = self._batches.get(route)
+        if pending is None:
+            timer = loop.call_later(self.batch_window, self._send_batch, route)
+            pending = self._batches[route] = [namespace, batch, [], timer]
+        pending[2].append((arg, future))
+        if len(pending[2]) >= self.max_batch_size:
+            pending[3].cancel()
+            self._send_batch(route)
+        return future
+
+    def _send_batch(self, route):
+        namespace, batch, calls, _ = self._batches.pop(route)
+        task = asyncio.ensure_future(self._request_batch(route, namespace, batch, calls))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def _request_batch(self, route, namespace, batch, calls):
+        batch_route, arg_field, result_field, result_tag, error_tag = batch
+        request_async = super(CoalescingTransport, self).request_async
+        try:
+            if len(calls) == 1:
+                calls[0][1].set_result(await request_async(route, namespace, calls[0][0]))
+                return
+            batch_arg = batch_route.arg_type.definition(
+                **{arg_field: [arg for arg, _ in calls]})
+            self.batch_requests += 1
+            r = await request_async(batch_route, namespace, batch_arg)
+            entries = getattr(r, result_field) if result_field else r
+            if len(entries) != len(calls):
+                raise ValueError('Expected {} entries from {}, got {}'.format(
+                    len(calls), batch_route.name, len(entries)))
+        except Exception as e:  # pylint: disable=broad-except
+            for _, future in calls:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except BaseException:
+            for _, future in calls:
+                future.cancel()
+            raise
+
+        for (_, future), entry in zip(calls, entries):
+            if future.done():
+                continue
+            if result_tag is None:
+                future.set_result(entry)
+            elif entry._tag == result_tag:
+                future.set_result(entry._value)
+            elif entry._tag == error_tag:
+                future.set_exception(ApiError(route, entry._value, None))
+            else:
+                future.set_exception(ApiError(route, entry, None))
+
+# --------------------------------------------------------------
+# Caching
+
+class AsyncRouteCache(stone_cache.RouteCache):
+    """A stone_cache.RouteCache for clients generated with --asyncio.
+
+    Misses while a call with the same key is in flight await that call
+    instead of making a request of their own. A call that's cancelled doesn't
+    cancel the calls that share it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncRouteCache, self).__init__(*args, **kwargs)
+        self._futures = {}  # type: typing.Dict[typing.Any, asyncio.Future]
+
+    async def call_async(self, route, namespace, arg, ttl, request_async):
+        """Returns the cached result of a route for an argument, or awaits
+        ``request_async(route, namespace, arg, None)`` and caches its result
+        for ``ttl`` seconds."""
+        path = stone_cache.route_path(route, namespace)
+        key = (path, ss.canonical_json_encode(route.arg_type, arg))
+        with self._lock:
+            found, result = self._lookup(key)
+        if found:
+            self.hits[path] += 1
+            return result
+        future = self._futures.get(key)
+        if future is None:
+            self.misses[path] += 1
+            future = asyncio.ensure_future(
+                self._fill(key, ttl, request_async(route, namespace, arg, None)))
+            self._futures[key] = future
+            future.add_done_callback(functools.partial(self._fill_done, key))
+        else:
+            self.hits[path] += 1
+        return await asyncio.shield(future)
+
+    async def _fill(self, key, ttl, aw):
+        result = await aw
+        with self._lock:
+            self._store(key, result, ttl)
+        return result
+
+    def _fill_done(self, key, future):
+        del self._futures[key]
+        if not future.cancelled():
+            # Retrieve the exception, in case every call was cancelled.
+            future.exception()
@@ -8,6 +8,7 @@ than being added to a project.
 
 from __future__ import absolute_import, unicode_literals
 
+import copy
 import functools
 
 try:
@@ -29,18 +30,197 @@ if _MYPY:
     T = typing.TypeVar('T', bound=AnnotationType)
     U = typing.TypeVar('U')
 
+class _NotLoaded(object):
+    # The type of NOT_LOADED.
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'NOT_LOADED'
+
+    def __reduce__(self):
+        # Pickled and copied by reference, so it stays a singleton.
+        return str('NOT_LOADED')
+
+# Stands in for the value of a struct field, or of a union tag, that a field
+# mask left out when decoding.
+NOT_LOADED = _NotLoaded()
+
+class NotLoadedError(AttributeError):
+    """
+    Raised on access to a struct field, or to the value of a union tag, that
+    a field mask left out when decoding.
+    """
+    pass
+
+def is_loaded(val, field_name=None):
+    """
+    Returns whether the field ``field_name`` of the struct ``val`` or, if
+    ``field_name`` isn't given, the value of the union ``val`` was decoded
+    rather than left out by a field mask.
+    """
+    if field_name is None:
+        return val._value is not NOT_LOADED
+    return getattr(val, '_%s_value' % field_name) is not NOT_LOADED
+
+def new_instance(cls):
+    """
+    Returns an instance of a struct or union class without calling its
+    constructor, for its state to be set directly.
+    """
+    return cls.__new__(cls)
+
 class Struct(object):
     # This is a base class for all classes representing Stone structs.
+    # Structural hash of the struct's definition in the spec, set by
+    # generated subclasses.
+    _fingerprint_ = None  # type: typing.Optional[int]
+
+    # Generated subclasses override __getstate__() and __setstate__(), which
+    # move the values of their slots to and from a tuple. A struct without
+    # fields has no state.
+
+    def __getstate__(self):
+        return ()
+
+    def __setstate__(self, state):
+        pass
+
+    def __reduce__(self):
+        return (new_instance, (type(self),), self.__getstate__())
+
+    def __copy__(self):
+        copied = new_instance(type(self))
+        copied.__setstate__(self.__getstate__())
+        return copied
+
+    def __deepcopy__(self, memo):
+        copied = new_instance(type(self))
+        memo[id(self)] = copied
+        copied.__setstate__(copy.deepcopy(self.__getstate__(), memo))
+        return copied
+
     def _process_custom_annotations(self, annotation_type, field_path, processor):
         # type: (typing.Type[T], typing.Text, typing.Callable[[T, U], U]) -> None
         pass
 
+class FrozenDict(dict):
+    """
+    A dict that can't be modified once constructed, and so can be hashed.
+    Frozen structs and unions store the values of map fields as these.
+    """
+    __slots__ = ()
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("'%s' object is immutable" % type(self).__name__)
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __hash__(self):
+        return hash(frozenset(self.items()))
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, dict.__repr__(self))
+
+def freeze(validator, val):
+    """
+    Returns val, which must have been validated by validator, with the lists
+    in it replaced by tuples and the maps by FrozenDicts.
+    """
+    if isinstance(validator, bv.Nullable):
+        if val is None:
+            return None
+        validator = validator.validator
+    if isinstance(validator, bv.List):
+        item_validator = validator.item_validator
+        return tuple(freeze(item_validator, item) for item in val)
+    elif isinstance(validator, bv.Map):
+        value_validator = validator.value_validator
+        return FrozenDict((k, freeze(value_validator, v)) for k, v in val.items())
+    return val
+
+# Maps each frozen struct class to the names of all of its fields.
+_frozen_field_names = {}  # type: typing.Dict[typing.Type[FrozenStruct], typing.Tuple[str, ...]]
+
+def _get_frozen_field_names(cls):
+    names = _frozen_field_names.get(cls)
+    if names is None:
+        # Every field, including those of parent classes and permissioned
+        # ones, has a "_<name>_value" slot.
+        names = tuple(
+            slot[1:-len('_value')]
+            for klass in reversed(cls.__mro__)
+            for slot in klass.__dict__.get('__slots__', ())
+            if slot.endswith('_value'))
+        _frozen_field_names[cls] = names
+    return names
+
+class FrozenStruct(Struct):
+    """
+    Base class for structs generated with the python_types backend's
+    --frozen option. Fields can only be set in the constructor, so the
+    values of frozen structs can be hashed and compared, and can be shared
+    between threads.
+    """
+
+    def _set_field_(self, name, val):
+        # Validates val and stores it as the value of the field, with any
+        # containers frozen. Only the constructor and decoders use this.
+        validator = getattr(self, '_%s_validator' % name)
+        if val is None and isinstance(validator, bv.Nullable):
+            val, present = None, False
+        else:
+            data_type = validator
+            if isinstance(data_type, bv.Nullable):
+                data_type = data_type.validator
+            if isinstance(data_type, (bv.Struct, bv.Union)):
+                validator.validate_type_only(val)
+            else:
+                val = freeze(validator, validator.validate(val))
+            present = True
+        setattr(self, '_%s_value' % name, val)
+        setattr(self, '_%s_present' % name, present)
+
+    def replace(self, **changes):
+        """
+        Returns a copy of this struct, with the fields named in changes set
+        to the given values. Fields set to None are left unset.
+        """
+        kwargs = {}
+        for name in _get_frozen_field_names(type(self)):
+            if getattr(self, '_%s_present' % name):
+                kwargs[name] = getattr(self, '_%s_value' % name)
+        kwargs.update(changes)
+        return type(self)(**kwargs)
+
+    def _field_values_(self):
+        return tuple(getattr(self, '_%s_value' % name)
+                     for name in _get_frozen_field_names(type(self)))
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._field_values_() == other._field_values_()
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __hash__(self):
+        return hash((type(self), self._field_values_()))
+
 class Union(object):
     # TODO(kelkabany): Possible optimization is to remove _value if a
     # union is composed of only symbols.
     __slots__ = ['_tag', '_value']
     _tagmap = {}  # type: typing.Dict[typing.Text, bv.Validator]
     _permissioned_tagmaps = set()  # type: typing.Set[typing.Text]
+    # Structural hash of the union's definition in the spec, set by generated
+    # subclasses.
+    _fingerprint_ = None  # type: typing.Optional[int]
 
     def __init__(self, tag, value=None):
         validator = None
@@ -73,6 +253,28 @@ class Union(object):
     def __hash__(self):
         return hash((self._tag, self._value))
 
+    def __reduce__(self):
+        if self._value is NOT_LOADED:
+            return (new_instance, (type(self),), (self._tag, self._value))
+        # Unpickling calls the constructor, which validates the value.
+        return (type(self), (self._tag, self._value))
+
+    def __setstate__(self, state):
+        self._tag, self._value = state
+
+    def __copy__(self):
+        copied = new_instance(type(self))
+        copied._tag = self._tag
+        copied._value = self._value
+        return copied
+
+    def __deepcopy__(self, memo):
+        copied = new_instance(type(self))
+        memo[id(self)] = copied
+        copied._tag = self._tag
+        copied._value = copy.deepcopy(self._value, memo)
+        return copied
+
     def _process_custom_annotations(self, annotation_type, field_path, processor):
         # type: (typing.Type[T], typing.Text, typing.Callable[[T, U], U]) -> None
         pass
@@ -102,9 +304,30 @@ class Union(object):
 
         return cls._tagmap[tag]
 
+class FrozenUnion(Union):
+    """
+    Base class for unions generated with the python_types backend's --frozen
+    option. Lists and maps in the value of the union are stored as tuples and
+    FrozenDicts.
+    """
+    __slots__ = ()
+
+    def __init__(self, tag, value=None):
+        super(FrozenUnion, self).__init__(tag, value)
+        if value is not None:
+            for tagmap_name in ['_{}_tagmap'.format(map_name)
+                                for map_name in self._permissioned_tagmaps]:
+                if tag in getattr(self, tagmap_name):
+                    validator = getattr(self, tagmap_name)[tag]
+                    break
+            else:
+                validator = self._tagmap[tag]
+            self._value = freeze(validator, value)
+
 class Route(object):
 
-    def __init__(self, name, version, deprecated, arg_type, result_type, error_type, attrs):
+    def __init__(self, name, version, deprecated, arg_type, result_type, error_type, attrs,
+                 fingerprint=None):
         self.name = name
         self.version = version
         self.deprecated = deprecated
@@ -113,16 +336,19 @@ class Route(object):
         self.error_type = error_type
         assert isinstance(attrs, dict), 'Expected dict, got %r' % attrs
         self.attrs = attrs
+        # Structural hash of the route's signature and attributes in the spec.
+        self.fingerprint = fingerprint
 
     def __repr__(self):
-        return 'Route({!r}, {!r}, {!r}, {!r}, {!r}, {!r}, {!r})'.format(
+        return 'Route({!r}, {!r}, {!r}, {!r}, {!r}, {!r}, {!r}, {})'.format(
             self.name,
             self.version,
             self.deprecated,
             self.arg_type,
             self.result_type,
             self.error_type,
-            self.attrs)
+            self.attrs,
+            '0x{:016x}'.format(self.fingerprint) if self.fingerprint is not None else None)
 
 # helper functions used when constructing custom annotation processors
 
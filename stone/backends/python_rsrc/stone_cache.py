@@ -0,0 +1,141 @@
+"""
+An in-process cache for the results of routes with a ``cache_ttl`` attribute,
+used by clients generated by the python_client backend with the --cache-size
+option.
+
+This module should be dropped into a project that requires the use of Stone. In
+the future, this could be imported from a pre-installed Python package, rather
+than being added to a project.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import collections
+import threading
+import time
+
+try:
+    from . import stone_serializers as ss
+except (ImportError, SystemError, ValueError):
+    # Catch errors raised when importing a relative module when not in a package.
+    # This makes testing this file directly (outside of a package) easier.
+    import stone_serializers as ss  # type: ignore
+
+_MYPY = False
+if _MYPY:
+    import typing  # noqa: F401 # pylint: disable=import-error,unused-import,useless-suppression
+
+# The maximum number of results a RouteCache holds by default.
+DEFAULT_MAX_SIZE = 1024
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+def route_path(route, namespace):
+    """Returns the ``namespace/route:version`` name of a route."""
+    return '{}/{}:{}'.format(namespace, route.name, route.version)
+
+class _Call(object):
+    # A call in flight, which other calls with the same key wait for.
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None  # type: typing.Optional[BaseException]
+
+class RouteCache(object):
+    """A bounded cache of route results, keyed by the route and the canonical
+    JSON encoding of the argument.
+
+    Results expire ``ttl`` seconds after they're stored. Once the cache holds
+    ``max_size`` results, the least recently used one is evicted. Errors
+    aren't cached.
+
+    A miss while a call with the same key is in flight waits for that call
+    and shares its result or error instead of making a request of its own
+    (single-flight), so an expired entry that many threads want is only
+    fetched once.
+
+    ``hits`` and ``misses`` count calls by the ``namespace/route:version``
+    name of the route. A call that shares the result of a call in flight
+    counts as a hit, since it makes no request.
+
+    Cached results are shared between calls, so callers shouldn't mutate
+    them. The python_types backend's --frozen option enforces this.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, clock=_monotonic):
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1, got %r' % max_size)
+        self.max_size = max_size
+        self.hits = collections.Counter()  # type: typing.Counter[typing.Text]
+        self.misses = collections.Counter()  # type: typing.Counter[typing.Text]
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Maps keys to (expiry time, result), least recently used first.
+        self._entries = collections.OrderedDict()  # type: typing.Dict[typing.Any, typing.Any]
+        self._in_flight = {}  # type: typing.Dict[typing.Any, _Call]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Removes every result, but leaves the counters alone."""
+        with self._lock:
+            self._entries.clear()
+
+    def call(self, route, namespace, arg, ttl, request):
+        """Returns the cached result of a route for an argument, or calls
+        ``request(route, namespace, arg, None)`` and caches its result for
+        ``ttl`` seconds."""
+        path = route_path(route, namespace)
+        key = (path, ss.canonical_json_encode(route.arg_type, arg))
+        with self._lock:
+            found, result = self._lookup(key)
+            if found:
+                self.hits[path] += 1
+                return result
+            call = self._in_flight.get(key)
+            if call is None:
+                call = self._in_flight[key] = _Call()
+                self.misses[path] += 1
+                leader = True
+            else:
+                self.hits[path] += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = request(route, namespace, arg, None)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if call.error is None:
+                    self._store(key, call.result, ttl)
+                del self._in_flight[key]
+            call.done.set()
+        return call.result
+
+    def _lookup(self, key):
+        # Returns (found, result), and marks the entry as recently used. The
+        # lock must be held.
+        entry = self._entries.pop(key, None)
+        if entry is None or entry[0] <= self._clock():
+            return False, None
+        self._entries[key] = entry
+        return True, entry[1]
+
+    def _store(self, key, result, ttl):
+        # The lock must be held.
+        self._entries.pop(key, None)
+        self._entries[key] = (self._clock() + ttl, result)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
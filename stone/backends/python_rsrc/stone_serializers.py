@@ -1,9 +1,8 @@
 """
 Serializers for Stone data types.
 
-Currently, only JSON is officially supported, but there's an experimental
-msgpack integration. If possible, serializers should be kept separate from the
-RPC format.
+JSON, msgpack and a compact schema-driven binary format are supported. If
+possible, serializers should be kept separate from the RPC format.
 
 This module should be dropped into a project that requires the use of Stone. In
 the future, this could be imported from a pre-installed Python package, rather
@@ -14,20 +13,28 @@ from __future__ import absolute_import, unicode_literals
 
 import base64
 import collections
+import copy
 import datetime
 import functools
+import hashlib
+import io
+import itertools
 import json
+import math
 import re
 import six
+import struct
+import threading
 import time
+import weakref
 
 try:
-    from . import stone_base as bb  # noqa: F401 # pylint: disable=unused-import
+    from . import stone_base as bb
     from . import stone_validators as bv
 except (ImportError, SystemError, ValueError):
     # Catch errors raised when importing a relative module when not in a package.
     # This makes testing this file directly (outside of a package) easier.
-    import stone_validators as bb  # type: ignore # noqa: F401 # pylint: disable=unused-import
+    import stone_base as bb  # type: ignore
     import stone_validators as bv  # type: ignore
 
 _MYPY = False
@@ -125,19 +132,23 @@ class StoneSerializerBase(StoneEncoderInterface):
 
         if isinstance(validator, bv.List):
             # Because Lists are mutable, we always validate them during
-            # serialization
-            validate_f = validator.validate  # type: typing.Callable[[typing.Any], None]
+            # serialization. Only the list itself is checked here; each item
+            # is validated as it's encoded by encode_list().
+            validate_f = validator.validate_type_only  # type: typing.Callable[[typing.Any], None] # noqa: E501
             encode_f = self.encode_list  # type: typing.Callable[[typing.Any, typing.Any], typing.Any] # noqa: E501
         elif isinstance(validator, bv.Map):
-            # Also validate maps during serialization because they are also mutable
-            validate_f = validator.validate
+            # Also validate maps during serialization because they are also
+            # mutable. Keys and values are validated by encode_map().
+            validate_f = validator.validate_type_only
             encode_f = self.encode_map
         elif isinstance(validator, bv.Nullable):
-            validate_f = validator.validate
-            encode_f = self.encode_nullable
+            # A non-null value is validated when encode_nullable() delegates
+            # to the wrapped validator.
+            return self.encode_nullable(validator, value)
         elif isinstance(validator, bv.Primitive):
-            validate_f = validator.validate
-            encode_f = self.encode_primitive
+            # Validation may normalize the value (e.g. an int to a float), so
+            # encode what the validator returns.
+            return self.encode_primitive(validator, validator.validate(value))
         elif isinstance(validator, bv.Struct):
             if isinstance(validator, bv.StructTree):
                 if self.caller_permissions.permissions:
@@ -173,7 +184,9 @@ class StoneSerializerBase(StoneEncoderInterface):
         # type: (bv.List, typing.Any) -> typing.Any
         """
         Callback for serializing a ``stone_validators.List``. Arguments
-        have the same semantics as with the ``encode`` method.
+        have the same semantics as with the ``encode`` method, except that
+        only the list itself has been validated; each item should be encoded
+        (and thereby validated) with ``encode_sub``.
         """
         raise NotImplementedError
 
@@ -181,7 +194,9 @@ class StoneSerializerBase(StoneEncoderInterface):
         # type: (bv.Map, typing.Any) -> typing.Any
         """
         Callback for serializing a ``stone_validators.Map``. Arguments
-        have the same semantics as with the ``encode`` method.
+        have the same semantics as with the ``encode`` method, except that
+        only the map itself has been validated; each key and value should be
+        encoded (and thereby validated) with ``encode_sub``.
         """
         raise NotImplementedError
 
@@ -189,7 +204,9 @@ class StoneSerializerBase(StoneEncoderInterface):
         # type: (bv.Nullable, typing.Any) -> typing.Any
         """
         Callback for serializing a ``stone_validators.Nullable``.
-        Arguments have the same semantics as with the ``encode`` method.
+        Arguments have the same semantics as with the ``encode`` method,
+        except that a non-null value hasn't been validated; it should be
+        encoded (and thereby validated) with ``encode_sub``.
         """
         raise NotImplementedError
 
@@ -225,11 +242,251 @@ class StoneSerializerBase(StoneEncoderInterface):
         """
         raise NotImplementedError
 
+# ------------------------------------------------------------------------
+# Field masks
+#
+# A field mask selects part of an object with dotted paths of field names,
+# e.g. 'metadata.name'. Lists, maps and nullables are transparent, except that
+# stepping into the items of a list or the values of a map takes a '*'
+# segment. A segment after a union is a tag, or '*' for every tag. The tag of
+# a union is always kept, but only the values of selected tags are.
+
+_FIELD_MASK_WILDCARD = '*'
+
+_all_permissioned_fields_re = re.compile(r'^_all_(\w+)_fields_$')
+
+# The number of compiled masks kept per validator. Masks can come from callers,
+# e.g. from a request parameter, so there's no telling how many distinct ones
+# there are.
+FIELD_MASK_CACHE_SIZE = 64
+
+# Maps a validator to a dict from a frozenset of paths to the FieldMask
+# compiled from them, least recently used first.
+_field_masks = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary[bv.Validator, typing.Dict[typing.FrozenSet[typing.Text], FieldMask]] # noqa: E501
+_field_masks_lock = threading.Lock()
+
+class FieldMask(object):
+    """
+    A set of field paths compiled against a data type. Use
+    :func:`compile_field_mask` to get one.
+    """
+
+    __slots__ = ('data_type', 'paths', '_root')
+
+    def __init__(self, data_type, paths, root):
+        self.data_type = data_type
+        self.paths = paths
+        self._root = root
+
+    def __repr__(self):
+        return 'FieldMask(%r)' % sorted(self.paths)
+
+class _FieldMaskNode(object):
+    """
+    The part of a field mask that applies to a struct or union. Selections
+    are themselves nodes, or None if the value is selected in full.
+
+    Attributes:
+        fields: For structs, a list of (field name, field validator,
+            selection) tuples for the selected public fields, in encoding
+            order.
+        permissioned_fields: For structs, a dict from caller permission to a
+            list like ``fields`` of the selected fields that need it.
+        field_map: For structs, a dict from field name to (field validator,
+            selection) for all the selected fields.
+        subtypes: For structs with enumerated subtypes, a dict from the class
+            of each subtype (and of the base) to its node. Otherwise None.
+        tags: For unions, a dict from each selected tag to its selection.
+    """
+
+    __slots__ = ('fields', 'permissioned_fields', 'field_map', 'subtypes', 'tags')
+
+    def __init__(self):
+        self.fields = []  # type: typing.List[typing.Tuple[typing.Text, bv.Validator, typing.Optional[_FieldMaskNode]]] # noqa: E501
+        self.permissioned_fields = {}  # type: typing.Dict[typing.Text, typing.List[typing.Tuple[typing.Text, bv.Validator, typing.Optional[_FieldMaskNode]]]] # noqa: E501
+        self.field_map = {}  # type: typing.Dict[typing.Text, typing.Tuple[bv.Validator, typing.Optional[_FieldMaskNode]]] # noqa: E501
+        self.subtypes = None  # type: typing.Optional[typing.Dict[type, _FieldMaskNode]]
+        self.tags = {}  # type: typing.Dict[typing.Text, typing.Optional[_FieldMaskNode]]
+
+def _merge_field_mask_selections(a, b):
+    # Selections are parsed into tries: dicts from a path segment to the
+    # selection below it, or True if everything below it is selected.
+    if a is None:
+        return b
+    elif b is None:
+        return a
+    elif a is True or b is True:
+        return True
+    merged = dict(a)
+    for segment, selection in b.items():
+        merged[segment] = _merge_field_mask_selections(merged.get(segment), selection)
+    return merged
+
+def _parse_field_mask_paths(paths):
+    selection = {}  # type: typing.Dict[typing.Text, typing.Any]
+    for path in paths:
+        if not isinstance(path, six.string_types) or not all(path.split('.')):
+            raise ValueError('invalid field mask path %r' % (path,))
+        path_selection = True  # type: typing.Any
+        for segment in reversed(path.split('.')):
+            path_selection = {segment: path_selection}
+        selection = _merge_field_mask_selections(selection, path_selection)
+    return selection
+
+def _compile_struct_field_mask(definition, selection, path, found):
+    node = _FieldMaskNode()
+    field_lists = [(None, definition._all_fields_)]
+    for attr in sorted(dir(definition)):
+        match = _all_permissioned_fields_re.match(attr)
+        if match:
+            field_lists.append((match.group(1), getattr(definition, attr)))
+    for permission, all_fields in field_lists:
+        for field_name, field_validator in all_fields:
+            if field_name not in selection:
+                continue
+            field_mask = _compile_field_mask(
+                field_validator, selection[field_name], path + [field_name])
+            if permission is None:
+                node.fields.append((field_name, field_validator, field_mask))
+            else:
+                node.permissioned_fields.setdefault(permission, []).append(
+                    (field_name, field_validator, field_mask))
+            node.field_map[field_name] = (field_validator, field_mask)
+            found.add(field_name)
+    return node
+
+def _compile_field_mask(validator, selection, path):
+    """
+    Compiles the trie ``selection`` against ``validator``. Returns a
+    _FieldMaskNode, or None if the value is selected in full.
+
+    Raises:
+        ValueError: The selection doesn't apply to the validator.
+    """
+    if selection is True:
+        return None
+    elif isinstance(validator, bv.Nullable):
+        return _compile_field_mask(validator.validator, selection, path)
+    elif isinstance(validator, (bv.List, bv.Map)):
+        for segment in selection:
+            if segment != _FIELD_MASK_WILDCARD:
+                raise ValueError("'%s' selects a field of a %s; use '%s'" % (
+                    '.'.join(path + [segment]), type(validator).__name__,
+                    '.'.join(path + [_FIELD_MASK_WILDCARD])))
+        item_validator = (validator.item_validator if isinstance(validator, bv.List)
+                          else validator.value_validator)
+        return _compile_field_mask(
+            item_validator, selection[_FIELD_MASK_WILDCARD], path + [_FIELD_MASK_WILDCARD])
+    elif isinstance(validator, bv.StructTree):
+        definition = validator.definition
+        node = _FieldMaskNode()
+        node.subtypes = {}
+        found = set()  # type: typing.Set[typing.Text]
+        definitions = [definition] + [
+            subtype.definition for _, subtype in definition._pytype_to_tag_and_subtype_.values()]
+        for subtype_definition in definitions:
+            node.subtypes[subtype_definition] = _compile_struct_field_mask(
+                subtype_definition, selection, path, found)
+        _check_field_mask_segments(selection, found, definition, path)
+        return node
+    elif isinstance(validator, bv.Struct):
+        found = set()
+        node = _compile_struct_field_mask(validator.definition, selection, path, found)
+        _check_field_mask_segments(selection, found, validator.definition, path)
+        return node
+    elif isinstance(validator, bv.Union):
+        definition = validator.definition
+        tagmaps = [definition._tagmap] + [
+            getattr(definition, '_{}_tagmap'.format(permission))
+            for permission in getattr(definition, '_permissioned_tagmaps', ())]
+        wildcard = selection.get(_FIELD_MASK_WILDCARD)
+        if wildcard is True:
+            return None
+        node = _FieldMaskNode()
+        found = set()
+        for tagmap in tagmaps:
+            for tag, tag_validator in tagmap.items():
+                if tag in selection:
+                    found.add(tag)
+                    node.tags[tag] = _compile_field_mask(
+                        tag_validator,
+                        _merge_field_mask_selections(selection[tag], wildcard),
+                        path + [tag])
+                    if wildcard is not None:
+                        found.add(_FIELD_MASK_WILDCARD)
+                elif wildcard is not None:
+                    # Tags that the rest of the path doesn't apply to are
+                    # left out, but it must apply to at least one.
+                    try:
+                        node.tags[tag] = _compile_field_mask(
+                            tag_validator, wildcard, path + [tag])
+                    except ValueError:
+                        continue
+                    found.add(_FIELD_MASK_WILDCARD)
+        _check_field_mask_segments(selection, found, definition, path, kind='tag')
+        return node
+    else:
+        raise ValueError("'%s' selects a field of %s, which has none" % (
+            '.'.join(path + [sorted(selection)[0]]), type(validator).__name__))
+
+def _check_field_mask_segments(selection, found, definition, path, kind='field'):
+    for segment in sorted(selection):
+        if segment not in found:
+            if segment == _FIELD_MASK_WILDCARD:
+                raise ValueError("'%s' doesn't select anything in %s" % (
+                    '.'.join(path + [segment]), definition.__name__))
+            raise ValueError("'%s' is not a %s of %s" % (
+                '.'.join(path + [segment]), kind, definition.__name__))
+
+def compile_field_mask(data_type, paths):
+    """
+    Compiles a field mask for use with ``data_type``. The last
+    ``FIELD_MASK_CACHE_SIZE`` masks compiled for each data type are cached, so
+    calling this again with the same paths is cheap.
+
+    Args:
+        data_type (Validator): Validator for the objects to be masked.
+        paths: An iterable of dotted field paths, such as
+            ``['entries.*.name', 'cursor']``. A ``'*'`` segment selects the
+            items of a list or the values of a map, or every tag of a union.
+
+    Returns:
+        FieldMask
+
+    Raises:
+        ValueError: A path doesn't apply to ``data_type``.
+    """
+    if isinstance(paths, six.string_types):
+        paths = [paths]
+    key = frozenset(paths)
+    with _field_masks_lock:
+        masks = _field_masks.get(data_type)
+        if masks is None:
+            masks = _field_masks[data_type] = collections.OrderedDict()
+        field_mask = masks.pop(key, None)
+        if field_mask is not None:
+            masks[key] = field_mask
+            return field_mask
+    root = _compile_field_mask(data_type, _parse_field_mask_paths(key), [])
+    field_mask = FieldMask(data_type, key, root)
+    with _field_masks_lock:
+        masks[key] = field_mask
+        while len(masks) > FIELD_MASK_CACHE_SIZE:
+            masks.popitem(last=False)
+    return field_mask
+
+def _get_field_mask(data_type, field_mask):
+    # Encoders and decoders take a FieldMask or the paths to compile one from.
+    if field_mask is None or isinstance(field_mask, FieldMask):
+        return field_mask
+    return compile_field_mask(data_type, field_mask)
+
 # ------------------------------------------------------------------------
 class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
 
-    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, should_redact):
-        # type: (CallerPermissionsInterface, typing.Mapping[bv.Validator, typing.Callable[[typing.Any], None]], bool, bool, bool) -> None # noqa: E501
+    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, should_redact,
+                 field_mask=None):
+        # type: (CallerPermissionsInterface, typing.Mapping[bv.Validator, typing.Callable[[typing.Any], None]], bool, bool, bool, typing.Optional[FieldMask]) -> None # noqa: E501
         """
         Args:
             alias_validators (``typing.Mapping``, optional): Passed
@@ -240,19 +497,30 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
                 Defaults to ``False``.
             should_redact (bool, optional): Whether to perform redaction on
                 marked fields. Defaults to ``False``.
+            field_mask (FieldMask, optional): If set, only the selected parts
+                of the values passed to ``encode`` are encoded. It must have
+                been compiled for their validator. Defaults to ``None``.
         """
         super(StoneToPythonPrimitiveSerializer, self).__init__(
             caller_permissions, alias_validators=alias_validators)
         self._for_msgpack = for_msgpack
         self._old_style = old_style
         self.should_redact = should_redact
+        # The selection that applies to the value being encoded, or None if
+        # it's encoded in full.
+        self._mask = (
+            field_mask._root if field_mask is not None else None)  # type: typing.Optional[_FieldMaskNode] # noqa: E501
+        # The last decoder of a lazy struct checked by _passes_through(), and
+        # the result.
+        self._passthrough_decoder = None  # type: typing.Optional[PythonPrimitiveToStoneDecoder]
+        self._passthrough = False
 
     @property
     def for_msgpack(self):
         """
-        EXPERIMENTAL: A flag associated with the serializer indicating
-        whether objects produced by the ``encode`` method should be
-        encoded for msgpack.
+        A flag associated with the serializer indicating whether objects
+        produced by the ``encode`` method should be encoded for msgpack, in
+        which case Bytes and Timestamps are left as bytes and datetimes.
 
         """
         return self._for_msgpack
@@ -268,29 +536,62 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
 
     def encode_sub(self, validator, value):
         if self.should_redact and hasattr(validator, '_redact'):
-            if isinstance(value, list):
-                return [validator._redact.apply(v) for v in value]
-            elif isinstance(value, dict):
-                return {k: validator._redact.apply(v) for k, v in value.items()}
+            if isinstance(value, (list, dict)):
+                return validator._redact.apply_many(value)
             else:
                 return validator._redact.apply(value)
 
+        if isinstance(validator, bv.Struct) and (
+                self._mask is not None or self._passes_through(value) is not None):
+            # Only the presence of selected fields is checked, as they're
+            # encoded. Lazy structs have been checked when they were decoded.
+            validator.validate_type_only(value)
+            if isinstance(validator, bv.StructTree):
+                return self.encode_struct_tree(validator, value)
+            return self.encode_struct(validator, value)
+
         # Encode value normally
         return super(StoneToPythonPrimitiveSerializer, self).encode_sub(validator, value)
 
-    def encode_list(self, validator, value):
-        validated_value = validator.validate(value)
+    def encode_frozen(self, validator, value):
+        """
+        Like :meth:`encode_sub`, for the value of a field of a frozen struct,
+        or of a frozen union. It was validated when the struct or union was
+        constructed and, as its containers can't be modified, still is; only
+        the structs and unions in it are checked again.
+        """
+        if self.should_redact and hasattr(validator, '_redact'):
+            return self.encode_sub(validator, value)
+        if isinstance(validator, bv.Primitive):
+            return self.encode_primitive(validator, value)
+        elif isinstance(validator, bv.List):
+            item_validator = validator.item_validator
+            return [self.encode_frozen(item_validator, item) for item in value]
+        elif isinstance(validator, bv.Map):
+            key_validator = validator.key_validator
+            value_validator = validator.value_validator
+            return {
+                self.encode_frozen(key_validator, key): self.encode_frozen(value_validator, val)
+                for key, val in value.items()
+            }
+        elif isinstance(validator, bv.Nullable):
+            if value is None:
+                return None
+            return self.encode_frozen(validator.validator, value)
+        return self.encode_sub(validator, value)
 
-        return [self.encode_sub(validator.item_validator, value_item) for value_item in
-                validated_value]
+    def encode_list(self, validator, value):
+        encode_sub = self.encode_sub
+        item_validator = validator.item_validator
+        return [encode_sub(item_validator, value_item) for value_item in value]
 
     def encode_map(self, validator, value):
-        validated_value = validator.validate(value)
-
+        encode_sub = self.encode_sub
+        key_validator = validator.key_validator
+        value_validator = validator.value_validator
         return {
-            self.encode_sub(validator.key_validator, key):
-                self.encode_sub(validator.value_validator, value) for
-            key, value in validated_value.items()
+            encode_sub(key_validator, key): encode_sub(value_validator, value)
+            for key, value in value.items()
         }
 
     def encode_nullable(self, validator, value):
@@ -306,10 +607,14 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
         if isinstance(validator, bv.Void):
             return None
         elif isinstance(validator, bv.Timestamp):
-            return _strftime(value, validator.format)
-        elif isinstance(validator, bv.Bytes):
             if self.for_msgpack:
                 return value
+            return _get_timestamp_codec(validator.format)[0](value)
+        elif isinstance(validator, bv.Bytes):
+            if self.for_msgpack:
+                # On Python 2, str is also used for text, so wrap Bytes to
+                # keep them distinguishable.
+                return bytearray(value) if six.PY2 else value
             else:
                 return base64.b64encode(value).decode('ascii')
         elif isinstance(validator, bv.Integer) \
@@ -321,7 +626,35 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
         else:
             return value
 
+    def _passes_through(self, value):
+        """
+        If ``value`` is a lazily decoded struct, and the fields it hasn't
+        decoded yet would be encoded as they were received, returns the dict
+        it was decoded from. Otherwise, returns None.
+
+        Values from non-strict decoders aren't passed through, since they
+        may hold unknown fields, which the decoder would have dropped.
+        """
+        pending = getattr(value, '_lazy_fields_', None)
+        if not pending:
+            return None
+        decoder = value._lazy_decoder_
+        if decoder is not self._passthrough_decoder:
+            self._passthrough_decoder = decoder
+            self._passthrough = (
+                decoder.strict and
+                not self.should_redact and
+                not self.alias_validators and
+                decoder.for_msgpack == self.for_msgpack and
+                decoder.old_style == self.old_style and
+                sorted(decoder.caller_permissions.permissions) ==
+                sorted(self.caller_permissions.permissions))
+        return value._lazy_raw_ if self._passthrough else None
+
     def encode_struct(self, validator, value):
+        if self._mask is not None:
+            return self._encode_struct_masked(value)
+
         # Skip validation of fields with primitive data types because
         # they've already been validated on assignment
         d = collections.OrderedDict()  # type: typing.Dict[str, typing.Any]
@@ -332,7 +665,17 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
             all_fields_name = '_all_{}_fields_'.format(extra_permission)
             all_fields = all_fields + getattr(validator.definition, all_fields_name, [])
 
+        # Fields of a lazy struct that haven't been decoded are copied from
+        # the dict it was decoded from, without being validated.
+        raw = self._passes_through(value)
+        encode_sub = self.encode_frozen if isinstance(value, bb.FrozenStruct) else self.encode_sub
+
         for field_name, field_validator in all_fields:
+            if raw is not None and raw.get(field_name) is not None \
+                    and field_name in value._lazy_fields_:
+                d[field_name] = raw[field_name]
+                continue
+
             try:
                 field_value = getattr(value, field_name)
             except AttributeError as exc:
@@ -345,30 +688,58 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
                 # Only serialize struct fields that have been explicitly
                 # set, even if there is a default
                 try:
-                    d[field_name] = self.encode_sub(field_validator, field_value)
+                    d[field_name] = encode_sub(field_validator, field_value)
                 except bv.ValidationError as exc:
                     exc.add_parent(field_name)
 
                     raise
         return d
 
-    def encode_struct_tree(self, validator, value):
-        assert type(value) in validator.definition._pytype_to_tag_and_subtype_, \
-            '%r is not a serializable subtype of %r.' % (type(value), validator.definition)
+    def _encode_struct_masked(self, value):
+        mask = self._mask
+        node = mask.subtypes[_struct_class(value)] if mask.subtypes is not None else mask
+        fields = node.fields
+        for extra_permission in self.caller_permissions.permissions:
+            fields = fields + node.permissioned_fields.get(extra_permission, [])
 
-        tags, subtype = validator.definition._pytype_to_tag_and_subtype_[type(value)]
+        d = collections.OrderedDict()  # type: typing.Dict[str, typing.Any]
+        raw = self._passes_through(value)
+        encode_sub = self.encode_frozen if isinstance(value, bb.FrozenStruct) else self.encode_sub
+        try:
+            for field_name, field_validator, field_mask in fields:
+                if raw is not None and field_mask is None and raw.get(field_name) is not None \
+                        and field_name in value._lazy_fields_:
+                    d[field_name] = raw[field_name]
+                    continue
 
-        assert len(tags) == 1, tags
-        assert not isinstance(subtype, bv.StructTree), \
-            'Cannot serialize type %r because it enumerates subtypes.' % subtype.definition
+                try:
+                    field_value = getattr(value, field_name)
+                except AttributeError as exc:
+                    raise bv.ValidationError(exc.args[0])
+
+                if field_value is not None \
+                        and getattr(value, '_%s_present' % field_name):
+                    self._mask = field_mask
+                    try:
+                        d[field_name] = encode_sub(field_validator, field_value)
+                    except bv.ValidationError as exc:
+                        exc.add_parent(field_name)
+
+                        raise
+        finally:
+            self._mask = mask
+        return d
+
+    def encode_struct_tree(self, validator, value):
+        tag, subtype = _get_struct_tree_subtype(validator, value)
 
         if self.old_style:
             d = {
-                tags[0]: self.encode_struct(subtype, value),
+                tag: self.encode_struct(subtype, value),
             }
         else:
             d = collections.OrderedDict()
-            d['.tag'] = tags[0]
+            d['.tag'] = tag
             d.update(self.encode_struct(subtype, value))
 
         return d
@@ -388,15 +759,31 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
             or (isinstance(field_validator, bv.Nullable)
                 and value._value is None)
 
+        mask = self._mask
+        value_mask = None
+        if mask is not None:
+            if value._tag in mask.tags:
+                value_mask = mask.tags[value._tag]
+            else:
+                # Only the tag is selected
+                is_none = True
+        if not is_none and value._value is bb.NOT_LOADED:
+            raise bv.ValidationError("value of tag '%s' was not loaded" % value._tag)
+        encode_value = \
+            self.encode_frozen if isinstance(value, bb.FrozenUnion) else self.encode_sub
+
         def encode_sub(sub_validator, sub_value, parent_tag):
+            self._mask = value_mask
             try:
-                encoded_val = self.encode_sub(sub_validator, sub_value)
+                encoded_val = encode_value(sub_validator, sub_value)
             except bv.ValidationError as exc:
                 exc.add_parent(parent_tag)
 
                 raise
             else:
                 return encoded_val
+            finally:
+                self._mask = mask
 
         if self.old_style:
             if field_validator is None:
@@ -431,11 +818,157 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
                     (value._tag, encoded_val),
                 ))
 
+def _get_struct_tree_subtype(validator, value):
+    # Returns the tag and the validator of the subtype of ``value``.
+    pytype = _struct_class(value)
+    assert pytype in validator.definition._pytype_to_tag_and_subtype_, \
+        '%r is not a serializable subtype of %r.' % (pytype, validator.definition)
+
+    tags, subtype = validator.definition._pytype_to_tag_and_subtype_[pytype]
+
+    assert len(tags) == 1, tags
+    assert not isinstance(subtype, bv.StructTree), \
+        'Cannot serialize type %r because it enumerates subtypes.' % subtype.definition
+    return tags[0], subtype
+
 # ------------------------------------------------------------------------
 class StoneToJsonSerializer(StoneToPythonPrimitiveSerializer):
     def encode(self, validator, value):
         return json.dumps(super(StoneToJsonSerializer, self).encode(validator, value))
 
+# ------------------------------------------------------------------------
+# Encoded form cache
+#
+# As frozen structs and unions can't change, their encodings by json_encode()
+# and msgpack_encode() are cached, so that encoding an object that's shared
+# between requests is a lookup. The primitive trees returned by the *_obj_encode()
+# functions aren't cached, as callers may modify them.
+
+_ENCODED_FORM_CACHE_BYTES = 8 * 1024 * 1024
+
+class EncodedFormCache(object):
+    """
+    Caches encodings of objects, per object and per encoder configuration.
+    Entries are dropped when their object is garbage collected and, least
+    recently used first, once they'd take up more than ``max_bytes`` in
+    total, as measured by the lengths of the encodings. A ``max_bytes`` of 0
+    disables the cache.
+    """
+
+    def __init__(self, max_bytes=_ENCODED_FORM_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Maps (id of object, config) to the encoding, least recently used
+        # first.
+        self._entries = collections.OrderedDict()  # type: typing.Dict[typing.Tuple[int, typing.Hashable], typing.Any] # noqa: E501
+        # Maps the id of each object that has entries to a weak reference to
+        # it, and the configs of its entries.
+        self._objects = {}  # type: typing.Dict[int, typing.Tuple[weakref.KeyedRef, typing.Set[typing.Hashable]]] # noqa: E501
+        # References to objects that have been garbage collected, whose
+        # entries have yet to be dropped. Weak reference callbacks only append
+        # to this, as they may run while the lock is held.
+        self._dead = []  # type: typing.List[weakref.KeyedRef]
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, obj, config):
+        """
+        Returns the encoding of ``obj`` cached for ``config``, or None.
+        """
+        with self._lock:
+            self._drop_dead()
+            key = (id(obj), config)
+            encoded = self._entries.pop(key, None)
+            if encoded is None:
+                self.misses += 1
+                return None
+            self._entries[key] = encoded
+            self.hits += 1
+            return encoded
+
+    def put(self, obj, config, encoded):
+        """
+        Caches ``encoded`` as the encoding of ``obj`` for ``config``.
+        """
+        size = len(encoded)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._drop_dead()
+            obj_id = id(obj)
+            key = (obj_id, config)
+            if key in self._entries:
+                return
+            if obj_id not in self._objects:
+                self._objects[obj_id] = (
+                    weakref.KeyedRef(obj, self._dead.append, obj_id), set())
+            self._objects[obj_id][1].add(config)
+            self._entries[key] = encoded
+            self._size += size
+            while self._size > self.max_bytes:
+                (evicted_id, evicted_config), evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                configs = self._objects[evicted_id][1]
+                configs.discard(evicted_config)
+                if not configs:
+                    del self._objects[evicted_id]
+                self.evictions += 1
+
+    def _drop_dead(self):
+        while self._dead:
+            ref = self._dead.pop()
+            entry = self._objects.get(ref.key)
+            if entry is None or entry[0] is not ref:
+                continue
+            del self._objects[ref.key]
+            for config in entry[1]:
+                self._size -= len(self._entries.pop((ref.key, config)))
+
+    def clear(self):
+        """
+        Drops all entries, and resets the statistics.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._objects.clear()
+            del self._dead[:]
+            self._size = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """
+        Returns a dict with the numbers of ``hits``, ``misses`` and
+        ``evictions`` so far, the number of ``entries``, and their ``size``
+        and ``max_bytes``.
+        """
+        with self._lock:
+            self._drop_dead()
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'size': self._size,
+                'max_bytes': self.max_bytes,
+            }
+
+# The cache used by json_encode() and msgpack_encode().
+encoded_form_cache = EncodedFormCache()
+
+def _encoded_form_config(fmt, data_type, obj, caller_permissions, alias_validators, old_style,
+                         should_redact, field_mask):
+    # Returns the key to cache the encoding of obj under, or None if it
+    # shouldn't be cached.
+    if not isinstance(obj, (bb.FrozenStruct, bb.FrozenUnion)) or alias_validators \
+            or not encoded_form_cache.max_bytes:
+        return None
+    permissions = tuple(sorted(caller_permissions.permissions)) if caller_permissions else ()
+    # Masks with the same paths share entries, whichever FieldMask they are.
+    paths = tuple(sorted(field_mask.paths)) if field_mask is not None else None
+    return (fmt, data_type, permissions, old_style, should_redact, paths)
+
 # --------------------------------------------------------------
 # JSON Encoder
 #
@@ -443,7 +976,7 @@ class StoneToJsonSerializer(StoneToPythonPrimitiveSerializer):
 # functions.
 
 def json_encode(data_type, obj, caller_permissions=None, alias_validators=None, old_style=False,
-                should_redact=False):
+                should_redact=False, field_mask=None):
     """Encodes an object into JSON based on its type.
 
     Args:
@@ -454,6 +987,9 @@ def json_encode(data_type, obj, caller_permissions=None, alias_validators=None,
         alias_validators (Optional[Mapping[bv.Validator, Callable[[], None]]]):
             Custom validation functions. These must raise bv.ValidationError on
             failure.
+        field_mask (Optional[FieldMask]): If set, only the selected fields are
+            encoded, and only those are checked for presence. Paths to compile
+            a mask from with compile_field_mask() are accepted too.
 
     Returns:
         str: JSON-encoded object.
@@ -497,12 +1033,23 @@ def json_encode(data_type, obj, caller_permissions=None, alias_validators=None,
     "{'update': {'path': 'a/b/c', 'rev': '1234'}}"
     """
     for_msgpack = False
+    field_mask = _get_field_mask(data_type, field_mask)
+    config = _encoded_form_config('json', data_type, obj, caller_permissions, alias_validators,
+                                  old_style, should_redact, field_mask)
+    if config is not None:
+        encoded = encoded_form_cache.get(obj, config)
+        if encoded is not None:
+            return encoded
     serializer = StoneToJsonSerializer(
-        caller_permissions, alias_validators, for_msgpack, old_style, should_redact)
-    return serializer.encode(data_type, obj)
+        caller_permissions, alias_validators, for_msgpack, old_style, should_redact, field_mask)
+    encoded = serializer.encode(data_type, obj)
+    if config is not None:
+        encoded_form_cache.put(obj, config, encoded)
+    return encoded
 
 def json_compat_obj_encode(data_type, obj, caller_permissions=None, alias_validators=None,
-                           old_style=False, for_msgpack=False, should_redact=False):
+                           old_style=False, for_msgpack=False, should_redact=False,
+                           field_mask=None):
     """Encodes an object into a JSON-compatible dict based on its type.
 
     Args:
@@ -515,169 +1062,1294 @@ def json_compat_obj_encode(data_type, obj, caller_permissions=None, alias_valida
         An object that when passed to json.dumps() will produce a string
         giving the JSON-encoded object.
 
-    See json_encode() for additional information about validation.
+    See json_encode() for additional information about validation and field
+    masks.
     """
     serializer = StoneToPythonPrimitiveSerializer(
-        caller_permissions, alias_validators, for_msgpack, old_style, should_redact)
+        caller_permissions, alias_validators, for_msgpack, old_style, should_redact,
+        _get_field_mask(data_type, field_mask))
     return serializer.encode(data_type, obj)
 
 # --------------------------------------------------------------
-# JSON Decoder
-class PythonPrimitiveToStoneDecoder(object):
-    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, strict):
-        self.caller_permissions = (caller_permissions if
-            caller_permissions else CallerPermissionsDefault())
-        self.alias_validators = alias_validators
-        self.strict = strict
-        self._old_style = old_style
-        self._for_msgpack = for_msgpack
+# Canonical JSON Encoder
+#
+# Equal objects have the same canonical encoding, so it can be hashed, e.g.
+# for ETags or to deduplicate stored objects. It's JSON encoded in UTF-8,
+# with:
+#
+# * The keys of every object, including structs, sorted by code point.
+# * No whitespace, and only the characters JSON requires escaped.
+# * Floats in the shortest form that round-trips, and -0.0 as 0.0.
+# * Timestamps in ISO 8601 in UTC, e.g. 2015-05-12T15:50:38Z, with
+#   microseconds if they aren't 0, whatever their format in the spec.
+# * Unions in the current style, and bytes in base64.
 
-    @property
-    def for_msgpack(self):
-        """
-        EXPERIMENTAL: A flag associated with the serializer indicating
-        whether objects produced by the ``encode`` method should be
-        encoded for msgpack.
-        """
-        return self._for_msgpack
+# Output is passed on in chunks of about this many characters.
+_CANONICAL_CHUNK_SIZE = 64 * 1024
 
-    @property
-    def old_style(self):
-        """
-        A flag associated with the serializer indicating whether objects
-        produced by the ``encode`` method should be encoded according to
-        Dropbox's old or new API styles.
-        """
-        return self._old_style
+class StoneToCanonicalPrimitiveSerializer(StoneToPythonPrimitiveSerializer):
+    """
+    Encodes objects into the primitive values written by
+    :class:`CanonicalJsonWriter`, with floats and timestamps normalized.
+    """
 
-    def json_compat_obj_decode_helper(self, data_type, obj):
-        """
-        See json_compat_obj_decode() for argument descriptions.
-        """
-        if isinstance(data_type, bv.StructTree):
-            return self.decode_struct_tree(data_type, obj)
-        elif isinstance(data_type, bv.Struct):
-            return self.decode_struct(data_type, obj)
-        elif isinstance(data_type, bv.Union):
-            if self.old_style:
-                return self.decode_union_old(data_type, obj)
-            else:
-                return self.decode_union(data_type, obj)
-        elif isinstance(data_type, bv.List):
-            return self.decode_list(
-                data_type, obj)
-        elif isinstance(data_type, bv.Map):
-            return self.decode_map(
-                data_type, obj)
-        elif isinstance(data_type, bv.Nullable):
-            return self.decode_nullable(
-                data_type, obj)
-        elif isinstance(data_type, bv.Primitive):
-            # Set validate to false because validation will be done by the
-            # containing struct or union when the field is assigned.
-            return self.make_stone_friendly(data_type, obj, False)
+    def __init__(self, caller_permissions, alias_validators, should_redact, field_mask=None):
+        # type: (CallerPermissionsInterface, typing.Mapping[bv.Validator, typing.Callable[[typing.Any], None]], bool, typing.Optional[FieldMask]) -> None # noqa: E501
+        super(StoneToCanonicalPrimitiveSerializer, self).__init__(
+            caller_permissions, alias_validators, False, False, should_redact, field_mask)
+
+    def _passes_through(self, value):
+        # Received values aren't canonical, so lazy structs are always
+        # encoded field by field.
+        return None
+
+    def encode_primitive(self, validator, value):
+        if isinstance(validator, bv.Timestamp):
+            if validator in self.alias_validators:
+                self.alias_validators[validator](value)
+            return _encode_canonical_timestamp(value)
+        value = super(StoneToCanonicalPrimitiveSerializer, self).encode_primitive(
+            validator, value)
+        if isinstance(validator, bv.Real):
+            # Adding 0.0 turns -0.0 into 0.0.
+            value = float(value) + 0.0
+        return value
+
+def _encode_canonical_timestamp(dt):
+    offset = dt.utcoffset()
+    if offset is not None:
+        dt = dt.replace(tzinfo=None) - offset
+    s = '%04d-%02d-%02dT%02d:%02d:%02d' % (
+        dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
+    if dt.microsecond:
+        s += '.%06d' % dt.microsecond
+    return s + 'Z'
+
+class CanonicalJsonWriter(object):
+    """
+    Writes primitive values as canonical JSON, passing the UTF-8 encoded
+    output to ``write`` in chunks as it goes. Call :meth:`flush` to pass on
+    the rest.
+    """
+
+    def __init__(self, write):
+        # type: (typing.Callable[[bytes], typing.Any]) -> None
+        self._write_out = write
+        self._dumps_string = json.JSONEncoder(ensure_ascii=False).encode
+        self._parts = []  # type: typing.List[typing.Text]
+        self._size = 0
+
+    def write(self, value):
+        if isinstance(value, dict):
+            self._append('{')
+            for i, key in enumerate(sorted(value)):
+                if i:
+                    self._append(',')
+                self._append(self._dumps_string(key))
+                self._append(':')
+                self.write(value[key])
+            self._append('}')
+        elif isinstance(value, list):
+            self._append('[')
+            for i, item in enumerate(value):
+                if i:
+                    self._append(',')
+                self.write(item)
+            self._append(']')
+        elif isinstance(value, six.string_types):
+            self._append(self._dumps_string(value))
+        elif value is None:
+            self._append('null')
+        elif isinstance(value, bool):
+            self._append('true' if value else 'false')
+        elif isinstance(value, float):
+            if math.isnan(value) or math.isinf(value):
+                raise ValueError('%r has no canonical JSON encoding' % (value,))
+            self._append(float.__repr__(value))
+        elif isinstance(value, six.integer_types):
+            self._append('%d' % value)
         else:
-            raise AssertionError('Cannot handle type %r.' % data_type)
+            raise TypeError('%r is not a primitive value' % (value,))
+
+    def flush(self):
+        if self._parts:
+            self._write_out(''.join(self._parts).encode('utf-8'))
+            self._parts = []
+            self._size = 0
+
+    def _append(self, s):
+        self._parts.append(s)
+        self._size += len(s)
+        if self._size >= _CANONICAL_CHUNK_SIZE:
+            self.flush()
+
+def _write_canonical_json(data_type, obj, write, caller_permissions, alias_validators,
+                          should_redact, field_mask):
+    serializer = StoneToCanonicalPrimitiveSerializer(
+        caller_permissions, alias_validators, should_redact,
+        _get_field_mask(data_type, field_mask))
+    writer = CanonicalJsonWriter(write)
+    writer.write(serializer.encode(data_type, obj))
+    writer.flush()
+
+def canonical_json_encode(data_type, obj, caller_permissions=None, alias_validators=None,
+                          should_redact=False, field_mask=None):
+    """Encodes an object into canonical JSON.
+
+    Equal objects have the same canonical encoding: the keys of all JSON
+    objects are sorted, there's no whitespace, floats are written in their
+    shortest form, and timestamps are in ISO 8601 in UTC whatever their
+    format in the spec. The object is validated like by json_encode(), which
+    describes the arguments.
 
-    def decode_struct(self, data_type, obj):
-        """
-        The data_type argument must be a Struct.
-        See json_compat_obj_decode() for argument descriptions.
-        """
-        if obj is None and data_type.has_default():
-            return data_type.get_default()
-        elif not isinstance(obj, dict):
-            raise bv.ValidationError('expected object, got %s' %
-                                     bv.generic_type_name(obj))
-        all_fields = data_type.definition._all_fields_
-        for extra_permission in self.caller_permissions.permissions:
-            all_extra_fields = '_all_{}_fields_'.format(extra_permission)
-            all_fields = all_fields + getattr(data_type.definition, all_extra_fields, [])
+    Returns:
+        bytes: UTF-8 encoded canonical JSON.
+    """
+    chunks = []  # type: typing.List[bytes]
+    _write_canonical_json(data_type, obj, chunks.append, caller_permissions, alias_validators,
+                          should_redact, field_mask)
+    return b''.join(chunks)
 
-        if self.strict:
-            all_field_names = data_type.definition._all_field_names_
-            for extra_permission in self.caller_permissions.permissions:
-                all_extra_field_names = '_all_{}_field_names_'.format(extra_permission)
-                all_field_names = all_field_names.union(
-                    getattr(data_type.definition, all_extra_field_names, {}))
+def stone_hash(data_type, obj, algorithm='sha256', caller_permissions=None,
+               alias_validators=None, should_redact=False, field_mask=None):
+    """Hashes the canonical JSON encoding of an object.
 
-            for key in obj:
-                if (key not in all_field_names and
-                        not key.startswith('.tag')):
-                    raise bv.ValidationError("unknown field '%s'" % key)
-        ins = data_type.definition()
-        self.decode_struct_fields(ins, all_fields, obj)
-        # Check that all required fields have been set.
-        data_type.validate_fields_only_with_permissions(ins, self.caller_permissions)
-        return ins
+    The encoding is fed to the hash in chunks as it's written, rather than
+    being built up first. See canonical_json_encode() for the encoding and
+    json_encode() for the other arguments.
 
-    def decode_struct_fields(self, ins, fields, obj):
-        """
-        Args:
-            ins: An instance of the class representing the data type being decoded.
-                The object will have its fields set.
-            fields: A tuple of (field_name: str, field_validator: Validator)
-            obj (dict): JSON-compatible dict that is being decoded.
-            strict (bool): See :func:`json_compat_obj_decode`.
-        Returns:
-            None: `ins` has its fields set based on the contents of `obj`.
-        """
-        for name, field_data_type in fields:
-            if name in obj:
-                try:
-                    v = self.json_compat_obj_decode_helper(field_data_type, obj[name])
-                    setattr(ins, name, v)
-                except bv.ValidationError as e:
-                    e.add_parent(name)
-                    raise
-            elif field_data_type.has_default():
-                setattr(ins, name, field_data_type.get_default())
+    Args:
+        algorithm (str): The name of a hash algorithm supported by
+            ``hashlib.new()``.
 
-    def decode_union(self, data_type, obj):
-        """
-        The data_type argument must be a Union.
-        See json_compat_obj_decode() for argument descriptions.
-        """
-        val = None
-        if isinstance(obj, six.string_types):
-            # Handles the shorthand format where the union is serialized as only
-            # the string of the tag.
-            tag = obj
-            if data_type.definition._is_tag_present(tag, self.caller_permissions):
-                val_data_type = data_type.definition._get_val_data_type(
-                    tag, self.caller_permissions)
-                if not isinstance(val_data_type, (bv.Void, bv.Nullable)):
-                    raise bv.ValidationError(
-                        "expected object for '%s', got symbol" % tag)
-                if tag == data_type.definition._catch_all:
-                    raise bv.ValidationError(
-                        "unexpected use of the catch-all tag '%s'" % tag)
-            elif not self.strict and data_type.definition._catch_all:
-                tag = data_type.definition._catch_all
+    Returns:
+        A ``hashlib`` hash object, e.g. to call ``hexdigest()`` on.
+    """
+    h = hashlib.new(algorithm)
+    _write_canonical_json(data_type, obj, h.update, caller_permissions, alias_validators,
+                          should_redact, field_mask)
+    return h
+
+# --------------------------------------------------------------
+# Structural diff and patch
+#
+# A patch is a list of operations, each a dict with an 'op' and a 'path'. The
+# path is a list of segments: field names of structs, tags of unions (whose
+# value is then stepped into), indexes of lists and keys of maps. Values are
+# JSON-compatible, as encoded by json_compat_obj_encode(), so a patch can be
+# serialized with json.dumps(). The operations are:
+#
+# * {'op': 'set', 'path': path, 'value': value}: Sets a struct field, list
+#   item or map value, or replaces the whole object if the path is empty.
+# * {'op': 'unset', 'path': path}: Unsets an optional struct field, or
+#   removes a key from a map.
+# * {'op': 'splice', 'path': path, 'index': i, 'delete': n, 'insert': items}:
+#   Replaces n items of a list, starting at index i, with items.
+
+def _patch_struct_fields(definition, caller_permissions):
+    # Returns the (name, validator) pairs of the fields of definition that are
+    # visible to the caller.
+    all_fields = definition._all_fields_
+    for extra_permission in caller_permissions.permissions:
+        all_fields_name = '_all_{}_fields_'.format(extra_permission)
+        all_fields = all_fields + getattr(definition, all_fields_name, [])
+    return all_fields
+
+def _patch_struct_subtype(validator, tree):
+    # Returns the validator of the subtype a struct tree was encoded as.
+    if isinstance(validator, bv.StructTree):
+        subtype = validator.definition._tag_to_subtype_.get((tree.get('.tag'),))
+        if subtype is None:
+            raise bv.ValidationError("unknown subtype '%s'" % (tree.get('.tag'),))
+        return subtype
+    return validator
+
+def _patch_union_value(validator, tree, caller_permissions):
+    # Returns the validator of the value of an encoded union, and the value,
+    # or None if it's void or null.
+    tag = tree['.tag']
+    value_validator = validator.definition._get_val_data_type(tag, caller_permissions)
+    if isinstance(value_validator, bv.Nullable):
+        value_validator = value_validator.validator
+    if isinstance(value_validator, bv.Struct) and not isinstance(value_validator, bv.StructTree):
+        # Struct values are encoded inline, with the tag.
+        value = {k: v for k, v in tree.items() if k != '.tag'}
+        return value_validator, (value or None)
+    return value_validator, tree.get(tag)
+
+def _diff_sub(validator, old, new, path, ops, caller_permissions):
+    if old == new:
+        return
+    if isinstance(validator, bv.Nullable):
+        validator = validator.validator
+    if old is None or new is None or isinstance(validator, bv.Primitive):
+        ops.append({'op': 'set', 'path': path, 'value': new})
+    elif isinstance(validator, bv.List):
+        _diff_list(validator, old, new, path, ops, caller_permissions)
+    elif isinstance(validator, bv.Map):
+        for key, value in new.items():
+            if key not in old:
+                ops.append({'op': 'set', 'path': path + [key], 'value': value})
             else:
-                raise bv.ValidationError("unknown tag '%s'" % tag)
-        elif isinstance(obj, dict):
-            tag, val = self.decode_union_dict(
-                data_type, obj)
+                _diff_sub(validator.value_validator, old[key], value, path + [key], ops,
+                          caller_permissions)
+        for key in old:
+            if key not in new:
+                ops.append({'op': 'unset', 'path': path + [key]})
+    elif isinstance(validator, bv.Struct):
+        if isinstance(validator, bv.StructTree) and old['.tag'] != new['.tag']:
+            ops.append({'op': 'set', 'path': path, 'value': new})
+            return
+        validator = _patch_struct_subtype(validator, new)
+        for name, field_validator in _patch_struct_fields(validator.definition,
+                                                          caller_permissions):
+            if name in new:
+                if name in old:
+                    _diff_sub(field_validator, old[name], new[name], path + [name], ops,
+                              caller_permissions)
+                else:
+                    ops.append({'op': 'set', 'path': path + [name], 'value': new[name]})
+            elif name in old:
+                ops.append({'op': 'unset', 'path': path + [name]})
+    elif isinstance(validator, bv.Union):
+        _, old_value = _patch_union_value(validator, old, caller_permissions)
+        new_validator, new_value = _patch_union_value(validator, new, caller_permissions)
+        if old['.tag'] != new['.tag'] or old_value is None or new_value is None:
+            ops.append({'op': 'set', 'path': path, 'value': new})
         else:
-            raise bv.ValidationError("expected string or object, got %s" %
-                                     bv.generic_type_name(obj))
-        return data_type.definition(tag, val)
+            _diff_sub(new_validator, old_value, new_value, path + [new['.tag']], ops,
+                      caller_permissions)
+    else:
+        raise bv.ValidationError('Unsupported data type {}'.format(type(validator).__name__))
+
+def _diff_list(validator, old, new, path, ops, caller_permissions):
+    # Only the items between the longest common prefix and suffix differ. If
+    # as many were added as removed, each changed item is diffed; otherwise
+    # they're replaced with a splice.
+    start = 0
+    while start < min(len(old), len(new)) and old[start] == new[start]:
+        start += 1
+    old_end, new_end = len(old), len(new)
+    while old_end > start and new_end > start and old[old_end - 1] == new[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+    if old_end == new_end:
+        for i in range(start, new_end):
+            _diff_sub(validator.item_validator, old[i], new[i], path + [i], ops,
+                      caller_permissions)
+    else:
+        ops.append({'op': 'splice', 'path': path, 'index': start,
+                    'delete': old_end - start, 'insert': new[start:new_end]})
 
-    def decode_union_dict(self, data_type, obj):
-        if '.tag' not in obj:
-            raise bv.ValidationError("missing '.tag' key")
-        tag = obj['.tag']
-        if not isinstance(tag, six.string_types):
-            raise bv.ValidationError(
-                'tag must be string, got %s' % bv.generic_type_name(tag))
+def stone_diff(data_type, old, new, caller_permissions=None, alias_validators=None):
+    """Returns a patch that turns one object into another.
 
-        if not data_type.definition._is_tag_present(tag, self.caller_permissions):
-            if not self.strict and data_type.definition._catch_all:
-                return data_type.definition._catch_all, None
-            else:
-                raise bv.ValidationError("unknown tag '%s'" % tag)
-        if tag == data_type.definition._catch_all:
+    Both objects are validated, and the patch is as fine-grained as the spec
+    allows: only changed struct fields and map keys are set or unset, and
+    only the changed part of a list is spliced. See stone_apply_patch() to
+    apply it.
+
+    Args:
+        data_type (Validator): Validator for old and new.
+        old (object): The object to diff from.
+        new (object): The object to diff to.
+        caller_permissions (list): The list of raw-string caller permissions
+            with which to compare the objects.
+        alias_validators (Optional[Mapping[bv.Validator, Callable[[], None]]]):
+            Custom validation functions. These must raise bv.ValidationError on
+            failure.
+
+    Returns:
+        list: The operations of the patch, as JSON-compatible dicts. The list
+        is empty if the objects encode the same way.
+    """
+    old_tree = json_compat_obj_encode(data_type, old, caller_permissions=caller_permissions,
+                                      alias_validators=alias_validators)
+    new_tree = json_compat_obj_encode(data_type, new, caller_permissions=caller_permissions,
+                                      alias_validators=alias_validators)
+    ops = []  # type: typing.List[typing.Dict[typing.Text, typing.Any]]
+    _diff_sub(data_type, old_tree, new_tree, [], ops,
+              caller_permissions or CallerPermissionsDefault())
+    return ops
+
+def _apply_patch_op(validator, tree, op, path, pos, caller_permissions):
+    # Returns a copy of the encoded object tree with the operation applied.
+    # Containers along the path are copied rather than modified, as they may
+    # be shared with the object that was encoded.
+    if pos == len(path):
+        if op['op'] == 'set':
+            return op['value']
+        elif op['op'] == 'splice':
+            if isinstance(validator, bv.Nullable):
+                validator = validator.validator
+            if not isinstance(validator, bv.List) or not isinstance(tree, list):
+                raise bv.ValidationError('can only splice lists')
+            index, delete, insert = op['index'], op['delete'], op['insert']
+            if not isinstance(index, six.integer_types) or not 0 <= index <= len(tree) or \
+                    not isinstance(delete, six.integer_types) or \
+                    not 0 <= delete <= len(tree) - index or not isinstance(insert, list):
+                raise bv.ValidationError('invalid splice')
+            return tree[:index] + insert + tree[index + delete:]
+        raise bv.ValidationError("can't unset the whole object")
+
+    if isinstance(validator, bv.Nullable):
+        validator = validator.validator
+    if tree is None:
+        raise bv.ValidationError('no value to patch')
+    segment = path[pos]
+    last = pos == len(path) - 1
+    if isinstance(validator, bv.List):
+        if not isinstance(tree, list):
+            raise bv.ValidationError('expected list, got %s' % bv.generic_type_name(tree))
+        if not isinstance(segment, six.integer_types) or not 0 <= segment < len(tree):
+            raise bv.ValidationError('invalid index %r' % (segment,))
+        new_tree = list(tree)
+        if last and op['op'] == 'unset':
+            raise bv.ValidationError("can't unset list items")
+        new_tree[segment] = _apply_patch_op(
+            validator.item_validator, tree[segment], op, path, pos + 1, caller_permissions)
+        return new_tree
+    elif isinstance(validator, (bv.Map, bv.Struct)):
+        if not isinstance(tree, dict):
+            raise bv.ValidationError('expected object, got %s' % bv.generic_type_name(tree))
+        if isinstance(validator, bv.Map):
+            child_validator = validator.value_validator
+        else:
+            fields = dict(_patch_struct_fields(
+                _patch_struct_subtype(validator, tree).definition, caller_permissions))
+            if segment not in fields:
+                raise bv.ValidationError("unknown field '%s'" % (segment,))
+            child_validator = fields[segment]
+        new_tree = dict(tree)
+        if last and op['op'] == 'unset':
+            new_tree.pop(segment, None)
+        elif last and op['op'] == 'set' or segment in tree:
+            new_tree[segment] = _apply_patch_op(
+                child_validator, tree.get(segment), op, path, pos + 1, caller_permissions)
+        else:
+            raise bv.ValidationError("no value at '%s'" % (segment,))
+        return new_tree
+    elif isinstance(validator, bv.Union):
+        if not isinstance(tree, dict):
+            raise bv.ValidationError('expected object, got %s' % bv.generic_type_name(tree))
+        if tree.get('.tag') != segment or \
+                not validator.definition._is_tag_present(segment, caller_permissions):
+            raise bv.ValidationError("tag '%s' isn't set" % (segment,))
+        value_validator, value = _patch_union_value(validator, tree, caller_permissions)
+        if last and op['op'] == 'unset':
+            raise bv.ValidationError("can't unset the value of a union")
+        value = _apply_patch_op(value_validator, value, op, path, pos + 1, caller_permissions)
+        if isinstance(value_validator, bv.Struct) and \
+                not isinstance(value_validator, bv.StructTree):
+            if not isinstance(value, dict):
+                raise bv.ValidationError('expected object, got %s' % bv.generic_type_name(value))
+            new_tree = collections.OrderedDict([('.tag', segment)])
+            new_tree.update(value)
+        else:
+            new_tree = dict(tree)
+            new_tree[segment] = value
+        return new_tree
+    raise bv.ValidationError("can't step into %s" % type(validator).__name__)
+
+def stone_apply_patch(data_type, obj, patch, caller_permissions=None, alias_validators=None):
+    """Applies a patch returned by stone_diff() to an object.
+
+    ``obj`` isn't modified. The patched object is decoded like by
+    json_compat_obj_decode(), so it's fully validated, and a ValidationError
+    is raised if the patch doesn't fit ``obj`` or the result is invalid.
+
+    Args:
+        data_type (Validator): Validator for obj.
+        obj (object): The object to patch.
+        patch (list): The operations to apply.
+        caller_permissions (list): The list of raw-string caller permissions
+            with which to patch the object.
+        alias_validators (Optional[Mapping[bv.Validator, Callable[[], None]]]):
+            Custom validation functions. These must raise bv.ValidationError on
+            failure.
+
+    Returns:
+        The patched object.
+    """
+    tree = json_compat_obj_encode(data_type, obj, caller_permissions=caller_permissions,
+                                  alias_validators=alias_validators)
+    permissions = caller_permissions or CallerPermissionsDefault()
+    for i, op in enumerate(patch):
+        try:
+            if not isinstance(op, dict) or op.get('op') not in ('set', 'unset', 'splice') \
+                    or not isinstance(op.get('path'), list):
+                raise bv.ValidationError('invalid operation')
+            tree = _apply_patch_op(data_type, tree, op, op['path'], 0, permissions)
+        except KeyError as e:
+            raise bv.ValidationError("missing key '%s'" % e.args[0], parent=str(i))
+        except bv.ValidationError as e:
+            e.add_parent(str(i))
+            raise
+    return json_compat_obj_decode(data_type, tree, caller_permissions=caller_permissions,
+                                  alias_validators=alias_validators)
+
+# --------------------------------------------------------------
+# JSON Log Encoder
+
+# Written in place of whatever didn't fit within a log encoder's limits.
+_LOG_TRUNCATED = '...'
+
+# Written in place of a value that doesn't fit its data type.
+_LOG_INVALID = '<invalid>'
+
+class _LogBudgetExhausted(Exception):
+    def __init__(self, complete):
+        super(_LogBudgetExhausted, self).__init__()
+        # Whether the value being written when the budget ran out was written
+        # (truncated) rather than abandoned.
+        self.complete = complete
+
+class StoneToJsonLogSerializer(StoneSerializerBase):
+    """
+    Encodes objects into JSON for logging. Fields marked for redaction are
+    always redacted, and the output is truncated to stay within limits on its
+    size, on the length of lists and maps, and on nesting depth. The JSON is
+    written incrementally and the walk stops once the size limit is reached,
+    so the work done is bounded by the limits rather than by the size of the
+    object.
+
+    Objects aren't validated, so that logging can't fail on them: a value
+    that can't be encoded with its data type, such as a union with an unknown
+    tag, is written as ``"<invalid>"``. Truncated output is still valid JSON;
+    see json_log_encode() for the markers used.
+    """
+
+    def __init__(self, caller_permissions, max_bytes, max_list_length, max_depth):
+        # type: (CallerPermissionsInterface, int, int, int) -> None
+        super(StoneToJsonLogSerializer, self).__init__(caller_permissions, {})
+        self.max_bytes = max_bytes
+        self.max_list_length = max_list_length
+        self.max_depth = max_depth
+        self._dumps = json.JSONEncoder().encode
+        self._parts = []  # type: typing.List[typing.Text]
+        self._remaining = 0
+        # A list per open JSON array or object: its closing character, whether
+        # it's an object, whether it has any items, and the length of _parts,
+        # _remaining and whether it had any items when its last item began.
+        self._open = []  # type: typing.List[typing.List[typing.Any]]
+
+    def encode(self, validator, value):
+        self._parts = []
+        self._remaining = self.max_bytes
+        self._open = []
+        try:
+            self.encode_sub(validator, value)
+        except _LogBudgetExhausted as e:
+            self._close_truncated(e.complete)
+        return ''.join(self._parts)
+
+    def encode_sub(self, validator, value):
+        n_parts, remaining, depth = len(self._parts), self._remaining, len(self._open)
+        try:
+            self._encode_value(validator, value)
+        except (AttributeError, KeyError, TypeError, ValueError, bv.ValidationError):
+            # Replace whatever was written of the value.
+            del self._parts[n_parts:]
+            del self._open[depth:]
+            self._remaining = remaining
+            self._write_string(_LOG_INVALID)
+
+    def _encode_value(self, validator, value):
+        if hasattr(validator, '_redact'):
+            if isinstance(value, list):
+                self._write_redacted_list(validator._redact, value)
+            elif isinstance(value, dict):
+                self._write_redacted_map(validator._redact, value)
+            else:
+                self._write_scalar(validator._redact.apply(value))
+        elif isinstance(validator, bv.Nullable):
+            self.encode_nullable(validator, value)
+        elif isinstance(validator, bv.Primitive):
+            self.encode_primitive(validator, value)
+        elif len(self._open) >= self.max_depth:
+            self._write_string(_LOG_TRUNCATED)
+        elif isinstance(validator, bv.List):
+            self.encode_list(validator, value)
+        elif isinstance(validator, bv.Map):
+            self.encode_map(validator, value)
+        elif isinstance(validator, bv.StructTree):
+            self.encode_struct_tree(validator, value)
+        elif isinstance(validator, bv.Struct):
+            self.encode_struct(validator, value)
+        elif isinstance(validator, bv.Union):
+            self.encode_union(validator, value)
+        else:
+            raise bv.ValidationError('Unsupported data type {}'.format(type(validator).__name__))
+
+    def encode_nullable(self, validator, value):
+        if value is None:
+            self._write('null')
+        else:
+            self.encode_sub(validator.validator, value)
+
+    def encode_list(self, validator, value):
+        self._open_container('[', ']', False)
+        for item in itertools.islice(value, self.max_list_length):
+            self._begin_item()
+            self.encode_sub(validator.item_validator, item)
+        self._end_list(len(value))
+
+    def encode_map(self, validator, value):
+        self._open_container('{', '}', True)
+        for key, item in itertools.islice(value.items(), self.max_list_length):
+            self._begin_item(key)
+            self.encode_sub(validator.value_validator, item)
+        self._end_map(len(value))
+
+    def encode_primitive(self, validator, value):
+        if isinstance(validator, bv.Void):
+            self._write('null')
+        elif isinstance(validator, bv.Timestamp):
+            self._write_string(_get_timestamp_codec(validator.format)[0](value))
+        elif isinstance(validator, bv.Bytes):
+            # Only encode as many bytes as could fit.
+            n = max(self._remaining, 0) * 3 // 4 + 3
+            self._write_string(base64.b64encode(value[:n]).decode('ascii'),
+                               truncated=len(value) > n)
+        else:
+            self._write_scalar(value)
+
+    def encode_struct(self, validator, value):
+        self._open_container('{', '}', True)
+        self._encode_struct_fields(validator, value)
+        self._close_container()
+
+    def encode_struct_tree(self, validator, value):
+        tags, subtype = validator.definition._pytype_to_tag_and_subtype_[_struct_class(value)]
+        self._open_container('{', '}', True)
+        self._begin_item('.tag')
+        self._write_string(tags[0])
+        self._encode_struct_fields(subtype, value)
+        self._close_container()
+
+    def encode_union(self, validator, value):
+        self._open_container('{', '}', True)
+        self._begin_item('.tag')
+        self._write_string(value._tag)
+        field_validator = validator.definition._get_val_data_type(value._tag,
+                                                                  self.caller_permissions)
+        if isinstance(field_validator, bv.Nullable) and value._value is not None:
+            field_validator = field_validator.validator
+        if value._value is None or isinstance(field_validator, bv.Void):
+            pass
+        elif isinstance(field_validator, bv.Struct) \
+                and not isinstance(field_validator, bv.StructTree) \
+                and not hasattr(field_validator, '_redact'):
+            self._encode_struct_fields(field_validator, value._value)
+        else:
+            self._begin_item(value._tag)
+            self.encode_sub(field_validator, value._value)
+        self._close_container()
+
+    def _encode_struct_fields(self, validator, value):
+        all_fields = validator.definition._all_fields_
+        for extra_permission in self.caller_permissions.permissions:
+            all_fields_name = '_all_{}_fields_'.format(extra_permission)
+            all_fields = all_fields + getattr(validator.definition, all_fields_name, [])
+
+        for field_name, field_validator in all_fields:
+            # Checking presence first avoids the error raised for a missing
+            # required field.
+            if getattr(value, '_%s_present' % field_name, False):
+                field_value = getattr(value, field_name)
+                if field_value is not None:
+                    self._begin_item(field_name)
+                    self.encode_sub(field_validator, field_value)
+
+    def _write_redacted_list(self, redactor, value):
+        self._open_container('[', ']', False)
+        for item in redactor.apply_many(value[:self.max_list_length]):
+            self._begin_item()
+            self._write_scalar(item)
+        self._end_list(len(value))
+
+    def _write_redacted_map(self, redactor, value):
+        self._open_container('{', '}', True)
+        items = dict(itertools.islice(value.items(), self.max_list_length))
+        for key, item in redactor.apply_many(items).items():
+            self._begin_item(key)
+            self._write_scalar(item)
+        self._end_map(len(value))
+
+    def _write(self, s):
+        if len(s) > self._remaining:
+            raise _LogBudgetExhausted(False)
+        self._remaining -= len(s)
+        self._parts.append(s)
+
+    def _write_scalar(self, value):
+        if isinstance(value, six.string_types):
+            self._write_string(value)
+        elif isinstance(value, bool):
+            self._write('true' if value else 'false')
+        elif value is None or isinstance(value, (six.integer_types, float)):
+            self._write(self._dumps(value))
+        else:
+            self._write_string(six.text_type(value))
+
+    def _write_string(self, s, truncated=False):
+        # Escaping can only make the string longer, so only what could fit
+        # is escaped.
+        if not truncated and len(s) + 2 <= self._remaining:
+            escaped = self._dumps(s)
+            if len(escaped) <= self._remaining:
+                self._write(escaped)
+                return
+        # Escaped characters take more than one character each, so the cut
+        # is scaled down by the escaped length until the string fits.
+        room = max(self._remaining - 2 - len(_LOG_TRUNCATED), 0)
+        cut = room
+        while True:
+            escaped = self._dumps(s[:cut] + _LOG_TRUNCATED)
+            if len(escaped) <= self._remaining or cut == 0:
+                break
+            cut = min(cut - 1, cut * room // (len(escaped) - 2 - len(_LOG_TRUNCATED)))
+        self._parts.append(escaped)
+        self._remaining -= len(escaped)
+        raise _LogBudgetExhausted(True)
+
+    def _open_container(self, opener, closer, is_object):
+        self._write(opener)
+        self._open.append([closer, is_object, False, 0, 0, False])
+
+    def _begin_item(self, key=None):
+        top = self._open[-1]
+        top[3:] = [len(self._parts), self._remaining, top[2]]
+        if top[2]:
+            self._write(', ')
+        top[2] = True
+        if key is not None:
+            self._write(self._dumps(key) + ': ')
+
+    def _close_container(self):
+        # Closing characters aren't counted against the budget, so that
+        # truncated output can always be closed.
+        self._parts.append(self._open.pop()[0])
+
+    def _end_list(self, length):
+        if length > self.max_list_length:
+            self._begin_item()
+            self._write_string('{} ({} more)'.format(_LOG_TRUNCATED,
+                                                     length - self.max_list_length))
+        self._close_container()
+
+    def _end_map(self, length):
+        if length > self.max_list_length:
+            self._begin_item(_LOG_TRUNCATED)
+            self._write_string('{} more'.format(length - self.max_list_length))
+        self._close_container()
+
+    def _close_truncated(self, complete):
+        if not self._open:
+            if not complete:
+                self._parts = [self._dumps(_LOG_TRUNCATED)]
+            return
+        _, is_object, _, mark, _, had_items = self._open[-1]
+        if not complete:
+            # Drop the item that didn't fit and mark its place.
+            del self._parts[mark:]
+            self._parts.append(', ' if had_items else '')
+            if is_object:
+                self._parts.append('{0}: {0}'.format(self._dumps(_LOG_TRUNCATED)))
+            else:
+                self._parts.append(self._dumps(_LOG_TRUNCATED))
+        while self._open:
+            self._close_container()
+
+def json_log_encode(data_type, obj, caller_permissions=None, max_bytes=4096,
+                    max_list_length=100, max_depth=16):
+    """Encodes an object into JSON for logging.
+
+    Fields marked for redaction are always redacted, and nothing past the
+    limits is visited, so the cost of logging a large object is bounded. The
+    object isn't validated.
+
+    Args:
+        data_type (Validator): Validator for obj.
+        obj (object): Object to be serialized.
+        caller_permissions (list): The list of raw-string caller permissions
+            with which to serialize.
+        max_bytes (int): Output beyond roughly this many characters is
+            dropped. Truncated strings end with ``...``, and any item that
+            didn't fit is replaced with ``"..."`` (``"...": "..."`` in
+            objects).
+        max_list_length (int): Lists and maps are truncated to this many
+            items, followed by ``"... (N more)"`` (``"...": "N more"`` in
+            maps).
+        max_depth (int): Lists, maps, structs and unions nested deeper than
+            this are replaced with ``"..."``.
+
+    Returns:
+        str: A valid JSON document.
+    """
+    serializer = StoneToJsonLogSerializer(
+        caller_permissions, max_bytes, max_list_length, max_depth)
+    return serializer.encode(data_type, obj)
+
+# --------------------------------------------------------------
+# JSON Decoder
+
+# Maps (union class, tag) to the instance shared by all decoded values of a
+# void tag, or to _NOT_VOID if the tag isn't void.
+_void_union_instances = {}  # type: typing.Dict[typing.Tuple[typing.Type[bb.Union], typing.Text], typing.Any] # noqa: E501
+_NOT_VOID = object()
+
+# The maximum number of distinct strings a decoder will intern. Strings seen
+# after the table is full are kept as-is.
+_MAX_INTERNED_STRINGS = 4096
+
+def _field_setter(ins):
+    """
+    Returns a function that sets a field of the struct ``ins`` given its name
+    and value. The fields of frozen structs can only be set this way.
+    """
+    if isinstance(ins, bb.FrozenStruct):
+        return ins._set_field_
+    return functools.partial(setattr, ins)
+
+def _validate_decoded(validator, val):
+    """
+    Like ``validator.validate(val)``, for a value returned by a decoder. The
+    structs and unions in it were checked as they were decoded, so only their
+    types are checked again. Checking them in full would fail on the fields
+    that a field mask left out.
+    """
+    if isinstance(validator, bv.Nullable):
+        if val is None:
+            return None
+        validator = validator.validator
+    if isinstance(validator, (bv.Struct, bv.Union)):
+        validator.validate_type_only(val)
+        return val
+    elif isinstance(validator, bv.List):
+        validator.validate_type_only(val)
+        item_validator = validator.item_validator
+        return [_validate_decoded(item_validator, item) for item in val]
+    elif isinstance(validator, bv.Map):
+        validator.validate_type_only(val)
+        key_validator = validator.key_validator
+        value_validator = validator.value_validator
+        return {key_validator.validate(key): _validate_decoded(value_validator, value)
+                for key, value in val.items()}
+    return validator.validate(val)
+
+def _is_container(validator):
+    if isinstance(validator, bv.Nullable):
+        validator = validator.validator
+    return isinstance(validator, (bv.List, bv.Map))
+
+def _set_decoded_field(ins, set_field, name, field_data_type, val):
+    """
+    Sets the field ``name`` of the struct ``ins`` to ``val``, a value returned
+    by a decoder for ``field_data_type``. Lists and maps are checked with
+    _validate_decoded() and stored directly, as the field's setter would
+    check the structs in them in full. Other values are set with
+    ``set_field``.
+    """
+    if val is None or not _is_container(field_data_type):
+        set_field(name, val)
+        return
+    val = _validate_decoded(field_data_type, val)
+    if isinstance(ins, bb.FrozenStruct):
+        val = bb.freeze(field_data_type, val)
+    setattr(ins, '_%s_value' % name, val)
+    setattr(ins, '_%s_present' % name, True)
+
+def _get_tag_data_type(definition, tag):
+    # Returns the validator of the value of a tag, which may be permissioned.
+    for map_name in getattr(definition, '_permissioned_tagmaps', ()):
+        tagmap = getattr(definition, '_{}_tagmap'.format(map_name))
+        if tag in tagmap:
+            return tagmap[tag]
+    return definition._tagmap[tag]
+
+def _make_union_instance(definition, tag, val):
+    """
+    Returns an instance of the union class ``definition`` with ``tag`` and
+    ``val``, which must already have been validated.
+
+    Since instances for void tags carry no state, they're shared rather than
+    constructed on every decode. The class attribute the generated code
+    defines for the tag is used if it's of the right class.
+    """
+    if val is None:
+        key = (definition, tag)
+        instance = _void_union_instances.get(key)
+        if instance is None:
+            tagmap_names = ['_{}_tagmap'.format(map_name)
+                            for map_name in getattr(definition, '_permissioned_tagmaps', ())]
+            instance = _NOT_VOID
+            for tagmap_name in ['_tagmap'] + tagmap_names:
+                if isinstance(getattr(definition, tagmap_name).get(tag), bv.Void):
+                    instance = getattr(definition, tag, None)
+                    if type(instance) is not definition:  # pylint: disable=unidiomatic-typecheck
+                        # The tag is inherited, so the class attribute is an
+                        # instance of the parent union.
+                        instance = definition(tag)
+                    break
+            _void_union_instances[key] = instance
+        if instance is not _NOT_VOID:
+            return instance
+    elif isinstance(val, bb.Struct) or val is bb.NOT_LOADED:
+        # The constructor would check the fields of a nullable struct again,
+        # which would decode all the fields of a lazily decoded one.
+        instance = definition.__new__(definition)
+        instance._tag = tag
+        instance._value = val
+        return instance
+    elif isinstance(val, (list, dict)):
+        # Likewise for the structs in a list or map.
+        data_type = _get_tag_data_type(definition, tag)
+        val = _validate_decoded(data_type, val)
+        instance = definition.__new__(definition)
+        instance._tag = tag
+        instance._value = (
+            bb.freeze(data_type, val) if isinstance(instance, bb.FrozenUnion) else val)
+        return instance
+    return definition(tag, val)
+
+# --------------------------------------------------------------
+# Lazy structs
+#
+# A lazy decoder returns structs as instances of a subclass of their
+# definition, which keeps the JSON-compatible dict the struct was decoded from
+# and decodes each field from it on first access. The dict is dropped once no
+# field is left to decode from it.
+
+class _LazyField(object):
+    """
+    Wraps the property of a struct field in a lazy struct class, so that the
+    field is decoded before it's first read. Setting or deleting the field
+    discards its undecoded value.
+    """
+
+    __slots__ = ('name', 'prop')
+
+    def __init__(self, name, prop):
+        self.name = name
+        self.prop = prop
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self.prop
+        pending = obj._lazy_fields_
+        if pending and self.name in pending:
+            _load_lazy_field(obj, self.name)
+        return self.prop.__get__(obj, objtype)
+
+    def __set__(self, obj, val):
+        if obj._lazy_fields_:
+            _discard_lazy_field(obj, self.name)
+        self.prop.__set__(obj, val)
+
+    def __delete__(self, obj):
+        if obj._lazy_fields_:
+            _discard_lazy_field(obj, self.name)
+        self.prop.__delete__(obj)
+
+def _lazy_struct_repr(self):
+    load_lazy(self, recursive=False)
+    return self._lazy_definition_.__repr__(self)
+
+# Lazy structs are loaded before they're pickled or copied, and the result is
+# an instance of the generated class.
+
+def _lazy_struct_reduce(self):
+    load_lazy(self, recursive=False)
+    return (bb.new_instance, (self._lazy_definition_,), self.__getstate__())
+
+def _lazy_struct_copy(self):
+    load_lazy(self, recursive=False)
+    copied = bb.new_instance(self._lazy_definition_)
+    copied.__setstate__(self.__getstate__())
+    return copied
+
+def _lazy_struct_deepcopy(self, memo):
+    load_lazy(self, recursive=False)
+    copied = bb.new_instance(self._lazy_definition_)
+    memo[id(self)] = copied
+    copied.__setstate__(copy.deepcopy(self.__getstate__(), memo))
+    return copied
+
+# Maps a struct class to its lazy subclass.
+_lazy_struct_classes = {}  # type: typing.Dict[typing.Type[bb.Struct], typing.Type[bb.Struct]]
+
+def _get_lazy_struct_class(definition):
+    cls = _lazy_struct_classes.get(definition)
+    if cls is None:
+        attrs = {
+            '__slots__': ('_lazy_raw_', '_lazy_fields_', '_lazy_decoder_'),
+            '__module__': definition.__module__,
+            '__doc__': definition.__doc__,
+            '__repr__': _lazy_struct_repr,
+            '__reduce__': _lazy_struct_reduce,
+            '__copy__': _lazy_struct_copy,
+            '__deepcopy__': _lazy_struct_deepcopy,
+            '_lazy_definition_': definition,
+        }  # type: typing.Dict[str, typing.Any]
+        field_names = []
+        for attr in dir(definition):
+            if attr == '_all_fields_' or _all_permissioned_fields_re.match(attr):
+                for field_name, _ in getattr(definition, attr):
+                    attrs[str(field_name)] = _LazyField(field_name, getattr(definition, field_name))
+                    field_names.append(field_name)
+        attrs['_lazy_field_names_'] = tuple(field_names)
+        cls = type(str(definition.__name__), (definition,), attrs)
+        cls = _lazy_struct_classes.setdefault(definition, cls)
+    return cls
+
+def _struct_class(value):
+    # Returns the generated class of a struct, even if it was decoded lazily.
+    cls = type(value)
+    return getattr(cls, '_lazy_definition_', cls)
+
+def _discard_lazy_field(ins, name):
+    pending = ins._lazy_fields_
+    pending.pop(name, None)
+    if not pending:
+        ins._lazy_raw_ = None
+
+def _load_lazy_field(ins, name):
+    decoder = ins._lazy_decoder_
+    with decoder._lazy_lock:
+        if name not in ins._lazy_fields_:
+            # Loaded by another thread in the meantime
+            return
+        field_data_type, selection = ins._lazy_fields_[name]
+        obj = ins._lazy_raw_
+        mask = decoder._mask
+        decoder._mask = selection
+        try:
+            if name in obj:
+                v = decoder.json_compat_obj_decode_helper(field_data_type, obj[name])
+            else:
+                v = field_data_type.get_default()
+            # Lists and maps of lazy structs are stored without being checked
+            # in full, which would decode every field of every item.
+            _set_decoded_field(ins, _field_setter(ins), name, field_data_type, v)
+            _discard_lazy_field(ins, name)
+        except bv.ValidationError as e:
+            e.add_parent(name)
+            raise
+        finally:
+            decoder._mask = mask
+
+def load_lazy(obj, recursive=True):
+    """
+    Decodes and validates every field of a lazily decoded struct that hasn't
+    been yet, so that no later access can fail. Lists, maps, unions and
+    structs are searched for lazy structs, and the fields of nested lazy
+    structs are loaded as well unless ``recursive`` is false.
+
+    Args:
+        obj: A value returned by a decoder with ``lazy`` set.
+
+    Returns:
+        ``obj``
+
+    Raises:
+        bv.ValidationError: If a field fails validation.
+    """
+    if isinstance(obj, list):
+        for item in obj:
+            load_lazy(item, recursive)
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            load_lazy(item, recursive)
+    elif isinstance(obj, bb.Union):
+        load_lazy(obj._value, recursive)
+    elif isinstance(obj, bb.Struct) and hasattr(obj, '_lazy_definition_'):
+        for name in list(obj._lazy_fields_):
+            getattr(obj, name)
+        if recursive:
+            for name in obj._lazy_field_names_:
+                load_lazy(getattr(obj, '_%s_value' % name), recursive)
+    return obj
+
+class PythonPrimitiveToStoneDecoder(object):
+    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, strict,
+                 intern_strings=False, field_mask=None, lazy=False):
+        self.caller_permissions = (caller_permissions if
+            caller_permissions else CallerPermissionsDefault())
+        self.alias_validators = alias_validators
+        self.strict = strict
+        self._old_style = old_style
+        self._for_msgpack = for_msgpack
+        # Maps a string to its canonical instance. None if interning is off.
+        self._interned_strings = (
+            {} if intern_strings else None)  # type: typing.Optional[typing.Dict[typing.Text, typing.Text]] # noqa: E501
+        # Maps a union class to a map from its tags to the instances in its
+        # tagmaps. Kept apart from _interned_strings, so that a string decoded
+        # before a tag that's equal to it can't stand in for the tag.
+        self._interned_tags = (
+            {} if intern_strings else None)  # type: typing.Optional[typing.Dict[typing.Any, typing.Dict[typing.Text, typing.Text]]] # noqa: E501
+        # The selection that applies to the value being decoded, or None if
+        # it's decoded in full.
+        self._mask = (
+            field_mask._root if field_mask is not None else None)  # type: typing.Optional[_FieldMaskNode] # noqa: E501
+        self._lazy = lazy
+        # Held while a lazy struct decodes a field, since the decoder is
+        # shared by all the structs it returns.
+        self._lazy_lock = threading.RLock() if lazy else None
+
+    @property
+    def for_msgpack(self):
+        """
+        A flag associated with the decoder indicating whether objects were
+        decoded from msgpack, in which case Bytes and Timestamps are expected
+        as bytes and datetimes.
+        """
+        return self._for_msgpack
+
+    @property
+    def old_style(self):
+        """
+        A flag associated with the serializer indicating whether objects
+        produced by the ``encode`` method should be encoded according to
+        Dropbox's old or new API styles.
+        """
+        return self._old_style
+
+    def intern_string(self, s):
+        """
+        Returns the canonical instance of the string ``s`` if this decoder
+        interns strings, so that equal strings decoded by it share storage.
+        Otherwise, returns ``s``.
+        """
+        table = self._interned_strings
+        if table is None:
+            return s
+        canonical = table.get(s)
+        if canonical is None:
+            canonical = s
+            if len(table) < _MAX_INTERNED_STRINGS:
+                table[s] = s
+        return canonical
+
+    def intern_tag(self, data_type, tag):
+        """
+        Like :meth:`intern_string`, but the canonical instance of a tag of
+        the union ``data_type`` is the one in its definition's tagmap.
+        """
+        tables = self._interned_tags
+        if tables is None:
+            return tag
+        definition = data_type.definition
+        table = tables.get(definition)
+        if table is None:
+            table = tables[definition] = {}
+            tagmap_names = ['_{}_tagmap'.format(map_name)
+                            for map_name in getattr(definition, '_permissioned_tagmaps', ())]
+            for tagmap_name in ['_tagmap'] + tagmap_names:
+                for known_tag in getattr(definition, tagmap_name):
+                    table[known_tag] = known_tag
+        return table.get(tag, tag)
+
+    def json_compat_obj_decode_helper(self, data_type, obj):
+        """
+        See json_compat_obj_decode() for argument descriptions.
+        """
+        if isinstance(data_type, bv.StructTree):
+            return self.decode_struct_tree(data_type, obj)
+        elif isinstance(data_type, bv.Struct):
+            return self.decode_struct(data_type, obj)
+        elif isinstance(data_type, bv.Union):
+            if self._mask is not None:
+                return self.decode_union_masked(data_type, obj)
+            elif self.old_style:
+                return self.decode_union_old(data_type, obj)
+            else:
+                return self.decode_union(data_type, obj)
+        elif isinstance(data_type, bv.List):
+            return self.decode_list(
+                data_type, obj)
+        elif isinstance(data_type, bv.Map):
+            return self.decode_map(
+                data_type, obj)
+        elif isinstance(data_type, bv.Nullable):
+            return self.decode_nullable(
+                data_type, obj)
+        elif isinstance(data_type, bv.Primitive):
+            # Set validate to false because validation will be done by the
+            # containing struct or union when the field is assigned.
+            return self.make_stone_friendly(data_type, obj, False)
+        else:
+            raise AssertionError('Cannot handle type %r.' % data_type)
+
+    def decode_struct(self, data_type, obj):
+        """
+        The data_type argument must be a Struct.
+        See json_compat_obj_decode() for argument descriptions.
+        """
+        if obj is None and data_type.has_default():
+            return data_type.get_default()
+        elif not isinstance(obj, dict):
+            raise bv.ValidationError('expected object, got %s' %
+                                     bv.generic_type_name(obj))
+        all_fields = data_type.definition._all_fields_
+        for extra_permission in self.caller_permissions.permissions:
+            all_extra_fields = '_all_{}_fields_'.format(extra_permission)
+            all_fields = all_fields + getattr(data_type.definition, all_extra_fields, [])
+
+        if self.strict:
+            all_field_names = data_type.definition._all_field_names_
+            for extra_permission in self.caller_permissions.permissions:
+                all_extra_field_names = '_all_{}_field_names_'.format(extra_permission)
+                all_field_names = all_field_names.union(
+                    getattr(data_type.definition, all_extra_field_names, {}))
+
+            for key in obj:
+                if (key not in all_field_names and
+                        not key.startswith('.tag')):
+                    raise bv.ValidationError("unknown field '{value}'", value=key)
+        if self._lazy and not issubclass(data_type.definition, bb.FrozenStruct):
+            # Frozen structs are always decoded eagerly.
+            ins = _get_lazy_struct_class(data_type.definition)()
+            self.init_lazy_struct(ins, all_fields, obj)
+            return ins
+        ins = data_type.definition()
+        if self._mask is not None:
+            self.decode_struct_fields_masked(ins, all_fields, obj)
+            return ins
+        self.decode_struct_fields(ins, all_fields, obj)
+        # Check that all required fields have been set.
+        data_type.validate_fields_only_with_permissions(ins, self.caller_permissions)
+        return ins
+
+    def decode_struct_fields(self, ins, fields, obj):
+        """
+        Args:
+            ins: An instance of the class representing the data type being decoded.
+                The object will have its fields set.
+            fields: A tuple of (field_name: str, field_validator: Validator)
+            obj (dict): JSON-compatible dict that is being decoded.
+            strict (bool): See :func:`json_compat_obj_decode`.
+        Returns:
+            None: `ins` has its fields set based on the contents of `obj`.
+        """
+        set_field = _field_setter(ins)
+        for name, field_data_type in fields:
+            if name in obj:
+                try:
+                    v = self.json_compat_obj_decode_helper(field_data_type, obj[name])
+                    _set_decoded_field(ins, set_field, name, field_data_type, v)
+                except bv.ValidationError as e:
+                    e.add_parent(name)
+                    raise
+            elif field_data_type.has_default():
+                set_field(name, field_data_type.get_default())
+
+    def decode_struct_fields_masked(self, ins, fields, obj):
+        """
+        Like :meth:`decode_struct_fields`, but only the fields selected by the
+        current field mask are decoded, and checked for presence. The others
+        are left unset and marked as not loaded.
+        """
+        mask = self._mask
+        node = mask.subtypes[type(ins)] if mask.subtypes is not None else mask
+        field_map = node.field_map
+        set_field = _field_setter(ins)
+        try:
+            for name, field_data_type in fields:
+                selection = field_map.get(name)
+                if selection is None:
+                    setattr(ins, '_%s_value' % name, bb.NOT_LOADED)
+                elif name in obj:
+                    self._mask = selection[1]
+                    try:
+                        v = self.json_compat_obj_decode_helper(field_data_type, obj[name])
+                        _set_decoded_field(ins, set_field, name, field_data_type, v)
+                    except bv.ValidationError as e:
+                        e.add_parent(name)
+                        raise
+                elif field_data_type.has_default():
+                    set_field(name, field_data_type.get_default())
+                else:
+                    raise bv.ValidationError("missing required field '%s'" % name)
+        finally:
+            self._mask = mask
+
+    def init_lazy_struct(self, ins, fields, obj):
+        """
+        Sets up ``ins``, an instance of a lazy struct class, to decode its
+        fields from ``obj`` when they're first accessed. Only the presence of
+        required fields is checked now.
+        """
+        node = self._mask
+        if node is not None and node.subtypes is not None:
+            node = node.subtypes[_struct_class(ins)]
+        pending = {}
+        absent = []
+        for name, field_data_type in fields:
+            selection = None
+            if node is not None:
+                field_selection = node.field_map.get(name)
+                if field_selection is None:
+                    setattr(ins, '_%s_value' % name, bb.NOT_LOADED)
+                    continue
+                selection = field_selection[1]
+            if name in obj or field_data_type.has_default():
+                pending[name] = (field_data_type, selection)
+            else:
+                absent.append(name)
+        ins._lazy_raw_ = obj if pending else None
+        ins._lazy_fields_ = pending
+        ins._lazy_decoder_ = self
+        for name in absent:
+            # Fields with defaults in the struct are present regardless.
+            if not hasattr(ins, name):
+                raise bv.ValidationError("missing required field '%s'" % name)
+
+    def decode_union(self, data_type, obj):
+        """
+        The data_type argument must be a Union.
+        See json_compat_obj_decode() for argument descriptions.
+        """
+        val = None
+        if isinstance(obj, six.string_types):
+            # Handles the shorthand format where the union is serialized as only
+            # the string of the tag.
+            tag = obj
+            if data_type.definition._is_tag_present(tag, self.caller_permissions):
+                val_data_type = data_type.definition._get_val_data_type(
+                    tag, self.caller_permissions)
+                if not isinstance(val_data_type, (bv.Void, bv.Nullable)):
+                    raise bv.ValidationError(
+                        "expected object for '%s', got symbol" % tag)
+                if tag == data_type.definition._catch_all:
+                    raise bv.ValidationError(
+                        "unexpected use of the catch-all tag '%s'" % tag)
+            elif not self.strict and data_type.definition._catch_all:
+                tag = data_type.definition._catch_all
+            else:
+                raise bv.ValidationError("unknown tag '{value}'", value=tag)
+        elif isinstance(obj, dict):
+            tag, val = self.decode_union_dict(
+                data_type, obj)
+        else:
+            raise bv.ValidationError("expected string or object, got %s" %
+                                     bv.generic_type_name(obj))
+        return _make_union_instance(data_type.definition, self.intern_tag(data_type, tag), val)
+
+    def decode_union_dict(self, data_type, obj):
+        if '.tag' not in obj:
+            raise bv.ValidationError("missing '.tag' key")
+        tag = obj['.tag']
+        if not isinstance(tag, six.string_types):
+            raise bv.ValidationError(
+                'tag must be string, got %s' % bv.generic_type_name(tag))
+
+        if not data_type.definition._is_tag_present(tag, self.caller_permissions):
+            if not self.strict and data_type.definition._catch_all:
+                return data_type.definition._catch_all, None
+            else:
+                raise bv.ValidationError("unknown tag '{value}'", value=tag)
+        if tag == data_type.definition._catch_all:
             raise bv.ValidationError(
                 "unexpected use of the catch-all tag '%s'" % tag)
 
@@ -699,7 +2371,7 @@ class PythonPrimitiveToStoneDecoder(object):
                                                  bv.generic_type_name(obj[tag]))
                 for key in obj:
                     if key != tag and key != '.tag':
-                        raise bv.ValidationError("unexpected key '%s'" % key)
+                        raise bv.ValidationError("unexpected key '{value}'", value=key)
             val = None
         elif isinstance(val_data_type,
                         (bv.Primitive, bv.List, bv.StructTree, bv.Union, bv.Map)):
@@ -718,7 +2390,7 @@ class PythonPrimitiveToStoneDecoder(object):
                     raise bv.ValidationError("missing '%s' key" % tag)
             for key in obj:
                 if key != tag and key != '.tag':
-                    raise bv.ValidationError("unexpected key '%s'" % key)
+                    raise bv.ValidationError("unexpected key '{value}'", value=key)
         elif isinstance(val_data_type, bv.Struct):
             if nullable and len(obj) == 1:  # only has a .tag key
                 val = None
@@ -734,6 +2406,40 @@ class PythonPrimitiveToStoneDecoder(object):
             assert False, type(val_data_type)
         return tag, val
 
+    def decode_union_masked(self, data_type, obj):
+        """
+        Decodes a union under the current field mask. If the mask leaves out
+        the value of its tag, the value isn't decoded and is marked as not
+        loaded.
+        """
+        mask = self._mask
+        definition = data_type.definition
+        tag = None
+        if isinstance(obj, six.string_types):
+            # Tags whose values were left out may be encoded as symbols.
+            tag = obj
+        elif isinstance(obj, dict):
+            if self.old_style:
+                tag = list(obj)[0] if len(obj) == 1 else None
+            else:
+                tag = obj.get('.tag')
+        if isinstance(tag, six.string_types) and tag not in mask.tags \
+                and tag != definition._catch_all \
+                and definition._is_tag_present(tag, self.caller_permissions) \
+                and not isinstance(
+                    definition._get_val_data_type(tag, self.caller_permissions), bv.Void):
+            return _make_union_instance(
+                definition, self.intern_tag(data_type, tag), bb.NOT_LOADED)
+
+        self._mask = mask.tags.get(tag) if isinstance(tag, six.string_types) else None
+        try:
+            if self.old_style:
+                return self.decode_union_old(data_type, obj)
+            else:
+                return self.decode_union(data_type, obj)
+        finally:
+            self._mask = mask
+
     def decode_union_old(self, data_type, obj):
         """
         The data_type argument must be a Union.
@@ -753,7 +2459,7 @@ class PythonPrimitiveToStoneDecoder(object):
                 if not self.strict and data_type.definition._catch_all:
                     tag = data_type.definition._catch_all
                 else:
-                    raise bv.ValidationError("unknown tag '%s'" % tag)
+                    raise bv.ValidationError("unknown tag '{value}'", value=tag)
         elif isinstance(obj, dict):
             # Union member has value
             if len(obj) != 1:
@@ -785,11 +2491,11 @@ class PythonPrimitiveToStoneDecoder(object):
                 if not self.strict and data_type.definition._catch_all:
                     tag = data_type.definition._catch_all
                 else:
-                    raise bv.ValidationError("unknown tag '%s'" % tag)
+                    raise bv.ValidationError("unknown tag '{value}'", value=tag)
         else:
             raise bv.ValidationError("expected string or object, got %s" %
                                      bv.generic_type_name(obj))
-        return data_type.definition(tag, val)
+        return _make_union_instance(data_type.definition, self.intern_tag(data_type, tag), val)
 
     def decode_struct_tree(self, data_type, obj):
         """
@@ -854,6 +2560,13 @@ class PythonPrimitiveToStoneDecoder(object):
         if not isinstance(obj, dict):
             raise bv.ValidationError(
                 'expected dict, got %s' % bv.generic_type_name(obj))
+        if self._interned_strings is not None:
+            return {
+                self.intern_string(
+                    self.json_compat_obj_decode_helper(data_type.key_validator, key)):
+                self.json_compat_obj_decode_helper(data_type.value_validator, value)
+                for key, value in obj.items()
+            }
         return {
             self.json_compat_obj_decode_helper(data_type.key_validator, key):
             self.json_compat_obj_decode_helper(data_type.value_validator, value)
@@ -878,14 +2591,23 @@ class PythonPrimitiveToStoneDecoder(object):
         false.
         """
         if isinstance(data_type, bv.Timestamp):
-            try:
-                ret = datetime.datetime.strptime(val, data_type.format)
-            except (TypeError, ValueError) as e:
-                raise bv.ValidationError(e.args[0])
+            if self.for_msgpack and isinstance(val, datetime.datetime):
+                if val.tzinfo is not None:
+                    val = val.replace(tzinfo=None) - val.utcoffset()
+                ret = val
+            else:
+                try:
+                    ret = _get_timestamp_codec(data_type.format)[1](val)
+                except (TypeError, ValueError) as e:
+                    raise bv.ValidationError(e.args[0])
         elif isinstance(data_type, bv.Bytes):
             if self.for_msgpack:
+                # Text is accepted from older encoders, which packed Bytes
+                # as strings.
                 if isinstance(val, six.text_type):
                     ret = val.encode('utf-8')
+                elif isinstance(val, bytearray):
+                    ret = bytes(val)
                 else:
                     ret = val
             else:
@@ -909,7 +2631,8 @@ class PythonPrimitiveToStoneDecoder(object):
         return ret
 
 def json_decode(data_type, serialized_obj, caller_permissions=None,
-                alias_validators=None, strict=True, old_style=False):
+                alias_validators=None, strict=True, old_style=False, intern_strings=False,
+                field_mask=None, lazy=False):
     """Performs the reverse operation of json_encode.
 
     Args:
@@ -926,6 +2649,19 @@ def json_decode(data_type, serialized_obj, caller_permissions=None,
             recipient of serialized JSON if it's guaranteed that its Stone
             specs are at least as recent as the senders it receives messages
             from.
+        intern_strings (bool): If set, union tags in the decoded objects
+            are the instances defined by the spec, and equal map keys share
+            one instance, so that large decoded values take less memory.
+        field_mask (Optional[FieldMask]): If set, only the selected fields are
+            decoded, validated and checked for presence. The others are left
+            unset, and accessing them raises stone_base.NotLoadedError.
+            Likewise for the values of union tags that aren't selected. Paths
+            to compile a mask from with compile_field_mask() are accepted too.
+        lazy (bool): If set, structs are returned as instances of subclasses
+            of their generated classes, which decode and validate each field
+            when it's first accessed. Only the presence of required fields is
+            checked up front, so accessing a field may raise
+            bv.ValidationError; call load_lazy() to load every field at once.
 
     Returns:
         The returned object depends on the input data_type.
@@ -948,12 +2684,14 @@ def json_decode(data_type, serialized_obj, caller_permissions=None,
     else:
         return json_compat_obj_decode(
             data_type, deserialized_obj, caller_permissions=caller_permissions,
-            alias_validators=alias_validators, strict=strict, old_style=old_style)
+            alias_validators=alias_validators, strict=strict, old_style=old_style,
+            intern_strings=intern_strings, field_mask=field_mask, lazy=lazy)
 
 
 def json_compat_obj_decode(data_type, obj, caller_permissions=None,
                            alias_validators=None, strict=True,
-                           old_style=False, for_msgpack=False):
+                           old_style=False, for_msgpack=False, intern_strings=False,
+                           field_mask=None, lazy=False):
     """
     Decodes a JSON-compatible object based on its data type into a
     representative Python object.
@@ -966,12 +2704,18 @@ def json_compat_obj_decode(data_type, obj, caller_permissions=None,
         strict (bool): If strict, then unknown struct fields will raise an
             error, and unknown union variants will raise an error even if a
             catch all field is specified. See json_decode() for more.
+        intern_strings (bool): See json_decode().
+        field_mask (Optional[FieldMask]): See json_decode().
+        lazy (bool): See json_decode(). Lazy structs keep references to the
+            dicts in ``obj`` they were decoded from, so ``obj`` must not be
+            modified afterwards.
 
     Returns:
         See json_decode().
     """
     decoder = PythonPrimitiveToStoneDecoder(caller_permissions,
-        alias_validators, for_msgpack, old_style, strict)
+        alias_validators, for_msgpack, old_style, strict, intern_strings,
+        _get_field_mask(data_type, field_mask), lazy)
 
     if isinstance(data_type, bv.Primitive):
         return decoder.make_stone_friendly(
@@ -980,6 +2724,122 @@ def json_compat_obj_decode(data_type, obj, caller_permissions=None,
         return decoder.json_compat_obj_decode_helper(
             data_type, obj)
 
+# --------------------------------------------------------------
+# NDJSON
+#
+# Newline-delimited JSON, one encoded object per line.
+
+# ndjson_encode_iter() writes to the stream in chunks of at least this many
+# characters.
+_NDJSON_CHUNK_SIZE = 64 * 1024
+
+def _ndjson_write(stream, lines):
+    data = '\n'.join(lines) + '\n'
+    if isinstance(stream, (io.RawIOBase, io.BufferedIOBase)):
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+    elif isinstance(stream, io.TextIOBase) and not isinstance(data, six.text_type):
+        data = data.decode('utf-8')
+    stream.write(data)
+
+def ndjson_encode_iter(data_type, objs, stream, caller_permissions=None,
+                       alias_validators=None, old_style=False, should_redact=False,
+                       chunk_size=_NDJSON_CHUNK_SIZE, field_mask=None):
+    """Encodes each object in an iterable into a line of JSON.
+
+    One serializer is used for all of the objects, and lines are written to
+    the stream in chunks of at least ``chunk_size`` characters rather than one
+    at a time.
+
+    Args:
+        data_type (Validator): Validator for each object.
+        objs: An iterable of objects to be serialized.
+        stream: A text or binary file-like object to write to.
+        chunk_size (int): The number of characters to buffer before writing.
+
+    Other arguments are the same as for json_encode().
+
+    Returns:
+        int: The number of lines written.
+
+    Raises:
+        bv.ValidationError: If an object fails validation. The message starts
+            with the (1-based) line number the object would have been written
+            to. Lines before it have been written.
+    """
+    serializer = StoneToPythonPrimitiveSerializer(
+        caller_permissions, alias_validators, False, old_style, should_redact,
+        _get_field_mask(data_type, field_mask))
+    dumps = json.JSONEncoder().encode
+    lines = []  # type: typing.List[typing.Text]
+    buffered = 0
+    lineno = 0
+    try:
+        for lineno, obj in enumerate(objs, 1):
+            try:
+                line = dumps(serializer.encode(data_type, obj))
+            except bv.ValidationError as e:
+                raise bv.ValidationError('line {}: {}', message_args=(lineno, e),
+                                         validator=e.validator)
+            lines.append(line)
+            buffered += len(line) + 1
+            if buffered >= chunk_size:
+                _ndjson_write(stream, lines)
+                lines = []
+                buffered = 0
+    finally:
+        if lines:
+            _ndjson_write(stream, lines)
+    return lineno
+
+def ndjson_decode_iter(data_type, stream, caller_permissions=None,
+                       alias_validators=None, strict=True, old_style=False,
+                       intern_strings=False, field_mask=None, lazy=False):
+    """Performs the reverse operation of ndjson_encode_iter.
+
+    Lines are read from the stream and decoded as they're consumed, with one
+    decoder for all of them. Blank lines are skipped.
+
+    Args:
+        data_type (Validator): Validator for each line.
+        stream: An iterable of lines, such as a text or binary file-like
+            object.
+
+    Other arguments are the same as for json_decode(). With
+    ``intern_strings``, equal strings are shared across all lines.
+
+    Returns:
+        An iterator of decoded objects. See json_decode().
+
+    Raises:
+        bv.ValidationError: If a line can't be decoded. The message starts
+            with its (1-based) line number.
+    """
+    decoder = PythonPrimitiveToStoneDecoder(caller_permissions, alias_validators,
+        False, old_style, strict, intern_strings, _get_field_mask(data_type, field_mask), lazy)
+    loads = json.JSONDecoder().decode
+    is_primitive = isinstance(data_type, bv.Primitive)
+    for lineno, line in enumerate(stream, 1):
+        if isinstance(line, bytes) and not six.PY2:
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            obj = loads(line)
+        except ValueError:
+            raise bv.ValidationError('line {}: could not decode input as JSON',
+                                     message_args=(lineno,))
+        try:
+            if is_primitive:
+                ret = decoder.make_stone_friendly(data_type, obj, True)
+            else:
+                ret = decoder.json_compat_obj_decode_helper(data_type, obj)
+        except bv.ValidationError as e:
+            raise bv.ValidationError('line {}: {}', message_args=(lineno, e),
+                                     validator=e.validator)
+        yield ret
+
 # Adapted from:
 # http://code.activestate.com/recipes/306860-proleptic-gregorian-dates-and-strftime-before-1900/
 # Remove the unsupposed "%s" command. But don't do it if there's an odd
@@ -1047,29 +2907,1050 @@ def _strftime(dt, fmt):
 
     return s
 
+# The format used by the vast majority of specs. Timestamps in this format are
+# encoded and decoded without going through strftime() and strptime(), which
+# are slow and, in the case of strptime(), serialized by a module-level lock.
+_ISO_8601_UTC_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+_ISO_8601_UTC_RE = re.compile(
+    r'([0-9]{4})-([0-9]{2})-([0-9]{2})T([0-9]{2}):([0-9]{2}):([0-9]{2})Z\Z')
+
+def _encode_iso_8601_utc(dt):
+    if dt.year < 1000:
+        # Defer to the platform for years that strftime() doesn't pad
+        # consistently.
+        return _strftime(dt, _ISO_8601_UTC_FORMAT)
+    return '%04d-%02d-%02dT%02d:%02d:%02dZ' % (
+        dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
+
+def _decode_iso_8601_utc(val):
+    try:
+        m = _ISO_8601_UTC_RE.match(val)
+        if m is not None:
+            return datetime.datetime(*[int(g) for g in m.groups()])
+    except (TypeError, ValueError):
+        pass
+    # Anything that isn't the canonical form, including inputs that strptime()
+    # leniently accepts and inputs that are invalid, takes the generic path so
+    # that results and error messages are unchanged.
+    return datetime.datetime.strptime(val, _ISO_8601_UTC_FORMAT)
+
+# Maps a format string to an (encode, decode) pair of callables. Populated on
+# first use of each format.
+_timestamp_codecs = {}  # type: typing.Dict[typing.Text, typing.Tuple[typing.Callable[[datetime.datetime], typing.Text], typing.Callable[[typing.Any], datetime.datetime]]] # noqa: E501
+
+def _get_timestamp_codec(fmt):
+    """
+    Returns an (encode, decode) pair of callables for timestamps in the
+    strftime()-style format ``fmt``. Formats with a specialized
+    implementation get it; all others use strftime() and strptime().
+    """
+    try:
+        return _timestamp_codecs[fmt]
+    except KeyError:
+        pass
+    if fmt == _ISO_8601_UTC_FORMAT:
+        codec = (_encode_iso_8601_utc, _decode_iso_8601_utc)
+    else:
+        codec = (lambda dt: _strftime(dt, fmt),
+                 lambda val: datetime.datetime.strptime(val, fmt))
+    _timestamp_codecs[fmt] = codec
+    return codec
+
+
+# --------------------------------------------------------------
+# msgpack
+#
+# Objects are encoded as the same tree of primitives as for JSON, except that
+# Bytes are left as byte strings and Timestamps as datetimes. Rather than
+# building the tree, StoneToMsgpackSerializer packs each value into a buffer as
+# it walks the validators. Input is unpacked with the msgpack C extension if
+# it's installed, or with the pure Python unpacker below if it isn't. Bytes are
+# packed as the bin type and Timestamps as the timestamp extension type, so
+# neither needs a text encoding.
 
 try:
-    import msgpack
+    import msgpack  # type: ignore
+    if six.PY2 or not hasattr(msgpack, 'Timestamp'):
+        # On Python 2, field names and Bytes are both str, which msgpack can't
+        # tell apart. Releases before 1.0 lack the timestamp extension type.
+        msgpack = None
 except ImportError:
-    pass
+    msgpack = None
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MSGPACK_TIMESTAMP_EXT = -1
+
+if six.PY2:
+    _MSGPACK_STR_TYPES = (six.text_type, str)  # type: typing.Tuple[type, ...]
+    _MSGPACK_BIN_TYPES = (bytearray, memoryview)  # type: typing.Tuple[type, ...]
 else:
-    msgpack_compat_obj_encode = functools.partial(json_compat_obj_encode,
-                                                  for_msgpack=True)
-
-    def msgpack_encode(data_type, obj):
-        return msgpack.dumps(
-            msgpack_compat_obj_encode(data_type, obj), encoding='utf-8')
-
-    msgpack_compat_obj_decode = functools.partial(json_compat_obj_decode,
-                                                  for_msgpack=True)
-
-    def msgpack_decode(
-            data_type, serialized_obj, alias_validators=None, strict=True):
-        # We decode everything as utf-8 because we want all object keys to be
-        # unicode. Otherwise, we need to do a lot more refactoring to make
-        # json/msgpack share the same code. We expect byte arrays to fail
-        # decoding, but when they don't, we have to convert them to bytes.
-        deserialized_obj = msgpack.loads(
-            serialized_obj, encoding='utf-8', unicode_errors='ignore')
-        return msgpack_compat_obj_decode(
-            data_type, deserialized_obj, alias_validators, strict)
+    _MSGPACK_STR_TYPES = (str,)
+    _MSGPACK_BIN_TYPES = (bytes, bytearray, memoryview)
+
+# The deepest nesting of arrays and maps the pure Python unpacker accepts, so
+# that hostile input can't exhaust the stack.
+_MSGPACK_MAX_DEPTH = 128
+
+# Maps the first byte of fixed-size scalars to their struct format and size.
+_MSGPACK_SCALARS = {
+    0xca: ('>f', 4),
+    0xcb: ('>d', 8),
+    0xcc: ('>B', 1),
+    0xcd: ('>H', 2),
+    0xce: ('>I', 4),
+    0xcf: ('>Q', 8),
+    0xd0: ('>b', 1),
+    0xd1: ('>h', 2),
+    0xd2: ('>i', 4),
+    0xd3: ('>q', 8),
+}
+
+# Maps the first byte of variable-size values to their kind and the struct
+# format of their length.
+_MSGPACK_SIZED = {
+    0xc4: ('bin', '>B'),
+    0xc5: ('bin', '>H'),
+    0xc6: ('bin', '>I'),
+    0xc7: ('ext', '>B'),
+    0xc8: ('ext', '>H'),
+    0xc9: ('ext', '>I'),
+    0xd9: ('str', '>B'),
+    0xda: ('str', '>H'),
+    0xdb: ('str', '>I'),
+    0xdc: ('array', '>H'),
+    0xdd: ('array', '>I'),
+    0xde: ('map', '>H'),
+    0xdf: ('map', '>I'),
+}
+
+def _datetime_to_epoch_time(dt):
+    """
+    Returns the seconds and nanoseconds since the epoch of ``dt``. Naive
+    datetimes are taken to be in UTC, like all Stone timestamps.
+    """
+    if dt.tzinfo is not None:
+        dt = dt.replace(tzinfo=None) - dt.utcoffset()
+    delta = dt - _EPOCH
+    return delta.days * 86400 + delta.seconds, delta.microseconds * 1000
+
+def _epoch_time_to_datetime(seconds, nanoseconds):
+    return _EPOCH + datetime.timedelta(
+        seconds=seconds, microseconds=nanoseconds // 1000)
+
+def _msgpack_pack_header(buf, n, fix_base, fix_limit, formats):
+    if n < fix_limit:
+        buf.append(fix_base | n)
+    elif len(formats) == 3 and n <= 0xff:
+        buf += struct.pack('>BB', formats[0], n)
+    elif n <= 0xffff:
+        buf += struct.pack('>BH', formats[-2], n)
+    else:
+        buf += struct.pack('>BI', formats[-1], n)
+
+def _msgpack_pack(obj, buf):
+    """
+    Appends the msgpack encoding of ``obj``, a tree of primitives, to the
+    bytearray ``buf``.
+    """
+    if obj is None:
+        buf.append(0xc0)
+    elif obj is True:
+        buf.append(0xc3)
+    elif obj is False:
+        buf.append(0xc2)
+    elif isinstance(obj, six.integer_types):
+        if 0 <= obj < 0x80 or -0x20 <= obj < 0:
+            buf.append(obj & 0xff)
+        elif obj >= 0:
+            if obj <= 0xff:
+                buf += struct.pack('>BB', 0xcc, obj)
+            elif obj <= 0xffff:
+                buf += struct.pack('>BH', 0xcd, obj)
+            elif obj <= 0xffffffff:
+                buf += struct.pack('>BI', 0xce, obj)
+            else:
+                buf += struct.pack('>BQ', 0xcf, obj)
+        elif obj >= -0x80:
+            buf += struct.pack('>Bb', 0xd0, obj)
+        elif obj >= -0x8000:
+            buf += struct.pack('>Bh', 0xd1, obj)
+        elif obj >= -0x80000000:
+            buf += struct.pack('>Bi', 0xd2, obj)
+        else:
+            buf += struct.pack('>Bq', 0xd3, obj)
+    elif isinstance(obj, float):
+        buf += struct.pack('>Bd', 0xcb, obj)
+    elif isinstance(obj, _MSGPACK_STR_TYPES):
+        if isinstance(obj, six.text_type):
+            obj = obj.encode('utf-8')
+        _msgpack_pack_header(buf, len(obj), 0xa0, 32, (0xd9, 0xda, 0xdb))
+        buf += obj
+    elif isinstance(obj, _MSGPACK_BIN_TYPES):
+        obj = bytes(obj) if isinstance(obj, memoryview) else obj
+        _msgpack_pack_header(buf, len(obj), 0, 0, (0xc4, 0xc5, 0xc6))
+        buf += obj
+    elif isinstance(obj, (list, tuple)):
+        _msgpack_pack_header(buf, len(obj), 0x90, 16, (0xdc, 0xdd))
+        for item in obj:
+            _msgpack_pack(item, buf)
+    elif isinstance(obj, dict):
+        _msgpack_pack_header(buf, len(obj), 0x80, 16, (0xde, 0xdf))
+        for key, value in obj.items():
+            _msgpack_pack(key, buf)
+            _msgpack_pack(value, buf)
+    elif isinstance(obj, datetime.datetime):
+        seconds, nanoseconds = _datetime_to_epoch_time(obj)
+        if seconds >> 34 == 0:
+            data64 = nanoseconds << 34 | seconds
+            if data64 <= 0xffffffff:
+                buf += struct.pack('>BbI', 0xd6, _MSGPACK_TIMESTAMP_EXT, data64)
+            else:
+                buf += struct.pack('>BbQ', 0xd7, _MSGPACK_TIMESTAMP_EXT, data64)
+        else:
+            buf += struct.pack(
+                '>BBbIq', 0xc7, 12, _MSGPACK_TIMESTAMP_EXT, nanoseconds, seconds)
+    else:
+        raise TypeError('cannot pack {!r} as msgpack'.format(type(obj)))
+
+def _msgpack_take(data, pos, n):
+    end = pos + n
+    if end > len(data):
+        raise ValueError('truncated input')
+    return data[pos:end], end
+
+def _msgpack_unpack_from(data, pos, depth=0):
+    """
+    Returns the value whose msgpack encoding starts at ``pos`` in the
+    bytearray (or, on Python 3, bytes) ``data``, and the position after it.
+    ``depth`` is the number of arrays and maps it's nested in.
+    """
+    b = data[pos]
+    pos += 1
+    if b <= 0x7f:
+        return b, pos
+    elif b >= 0xe0:
+        return b - 0x100, pos
+    elif b <= 0x8f:
+        kind, n = 'map', b & 0x0f
+    elif b <= 0x9f:
+        kind, n = 'array', b & 0x0f
+    elif b <= 0xbf:
+        kind, n = 'str', b & 0x1f
+    elif b == 0xc0:
+        return None, pos
+    elif b == 0xc2:
+        return False, pos
+    elif b == 0xc3:
+        return True, pos
+    elif b in _MSGPACK_SCALARS:
+        fmt, size = _MSGPACK_SCALARS[b]
+        return struct.unpack_from(fmt, data, pos)[0], pos + size
+    elif b in _MSGPACK_SIZED:
+        kind, fmt = _MSGPACK_SIZED[b]
+        n = struct.unpack_from(fmt, data, pos)[0]
+        pos += struct.calcsize(fmt)
+    elif 0xd4 <= b <= 0xd8:
+        kind, n = 'ext', 1 << (b - 0xd4)
+    else:
+        raise ValueError('invalid msgpack type byte 0x{:02x}'.format(b))
+
+    if kind in ('array', 'map') and depth >= _MSGPACK_MAX_DEPTH:
+        raise ValueError('msgpack value nested too deeply')
+    if kind == 'str':
+        raw, pos = _msgpack_take(data, pos, n)
+        return raw.decode('utf-8'), pos
+    elif kind == 'bin':
+        raw, pos = _msgpack_take(data, pos, n)
+        return bytes(raw), pos
+    elif kind == 'array':
+        items = []
+        for _ in range(n):
+            item, pos = _msgpack_unpack_from(data, pos, depth + 1)
+            items.append(item)
+        return items, pos
+    elif kind == 'map':
+        d = {}
+        for _ in range(n):
+            key, pos = _msgpack_unpack_from(data, pos, depth + 1)
+            d[key], pos = _msgpack_unpack_from(data, pos, depth + 1)
+        return d, pos
+    else:
+        ext_type = struct.unpack_from('>b', data, pos)[0]
+        raw, pos = _msgpack_take(data, pos + 1, n)
+        if ext_type != _MSGPACK_TIMESTAMP_EXT:
+            raise ValueError('unsupported msgpack extension type {}'.format(ext_type))
+        if n == 4:
+            return _epoch_time_to_datetime(struct.unpack('>I', raw)[0], 0), pos
+        elif n == 8:
+            data64 = struct.unpack('>Q', raw)[0]
+            return _epoch_time_to_datetime(data64 & 0x3ffffffff, data64 >> 34), pos
+        elif n == 12:
+            nanoseconds, seconds = struct.unpack('>Iq', raw)
+            return _epoch_time_to_datetime(seconds, nanoseconds), pos
+        raise ValueError('invalid msgpack timestamp length {}'.format(n))
+
+def _msgpack_unpack(data):
+    if six.PY2 or not isinstance(data, (bytes, bytearray)):
+        data = bytearray(data)
+    obj, pos = _msgpack_unpack_from(data, 0)
+    if pos != len(data):
+        raise ValueError('extra data after msgpack value')
+    return obj
+
+_MSGPACK_DECODE_ERRORS = (
+    (IndexError, OverflowError, TypeError, ValueError, struct.error) +
+    ((msgpack.UnpackException,) if msgpack is not None else ())
+)  # type: typing.Tuple[typing.Type[Exception], ...]
+
+class StoneToMsgpackSerializer(StoneToPythonPrimitiveSerializer):
+    """
+    Encodes values as msgpack, appending to a buffer as the validators are
+    walked rather than building a tree of primitives to pack afterwards. The
+    encoding is the same as packing the tree returned by
+    msgpack_compat_obj_encode(). Each encode() call appends to a new buffer,
+    so instances must not be shared between threads.
+    """
+
+    def __init__(self, caller_permissions, alias_validators, old_style, should_redact,
+                 field_mask=None):
+        # type: (CallerPermissionsInterface, typing.Mapping[bv.Validator, typing.Callable[[typing.Any], None]], bool, bool, typing.Optional[FieldMask]) -> None # noqa: E501
+        super(StoneToMsgpackSerializer, self).__init__(
+            caller_permissions, alias_validators, True, old_style, should_redact, field_mask)
+        self._buf = bytearray()
+        # The tag of the union whose struct value is being encoded, which is
+        # written as the first entry of the struct's map.
+        self._merge_tag = None  # type: typing.Optional[typing.Text]
+
+    def encode(self, validator, value):
+        self._buf = bytearray()
+        self.encode_sub(validator, value)
+        return bytes(self._buf)
+
+    def encode_sub(self, validator, value):
+        if self.should_redact and hasattr(validator, '_redact'):
+            if isinstance(value, (list, dict)):
+                _msgpack_pack(validator._redact.apply_many(value), self._buf)
+            else:
+                _msgpack_pack(validator._redact.apply(value), self._buf)
+            return
+        super(StoneToMsgpackSerializer, self).encode_sub(validator, value)
+
+    def encode_frozen(self, validator, value):
+        if self.should_redact and hasattr(validator, '_redact'):
+            self.encode_sub(validator, value)
+        elif isinstance(validator, bv.Primitive):
+            self.encode_primitive(validator, value)
+        elif isinstance(validator, bv.List):
+            _msgpack_pack_header(self._buf, len(value), 0x90, 16, (0xdc, 0xdd))
+            item_validator = validator.item_validator
+            for item in value:
+                self.encode_frozen(item_validator, item)
+        elif isinstance(validator, bv.Map):
+            _msgpack_pack_header(self._buf, len(value), 0x80, 16, (0xde, 0xdf))
+            key_validator = validator.key_validator
+            value_validator = validator.value_validator
+            for key, item in value.items():
+                self.encode_frozen(key_validator, key)
+                self.encode_frozen(value_validator, item)
+        elif isinstance(validator, bv.Nullable):
+            if value is None:
+                self._buf.append(0xc0)
+            else:
+                self.encode_frozen(validator.validator, value)
+        else:
+            self.encode_sub(validator, value)
+
+    def encode_list(self, validator, value):
+        _msgpack_pack_header(self._buf, len(value), 0x90, 16, (0xdc, 0xdd))
+        encode_sub = self.encode_sub
+        item_validator = validator.item_validator
+        for item in value:
+            encode_sub(item_validator, item)
+
+    def encode_map(self, validator, value):
+        _msgpack_pack_header(self._buf, len(value), 0x80, 16, (0xde, 0xdf))
+        encode_sub = self.encode_sub
+        key_validator = validator.key_validator
+        value_validator = validator.value_validator
+        for key, item in value.items():
+            encode_sub(key_validator, key)
+            encode_sub(value_validator, item)
+
+    def encode_nullable(self, validator, value):
+        if value is None:
+            self._buf.append(0xc0)
+        else:
+            self.encode_sub(validator.validator, value)
+
+    def encode_primitive(self, validator, value):
+        if validator in self.alias_validators:
+            self.alias_validators[validator](value)
+
+        if isinstance(validator, bv.Void):
+            value = None
+        elif isinstance(validator, bv.Integer) and isinstance(value, bool):
+            value = int(value)
+        elif six.PY2 and isinstance(validator, bv.Bytes):
+            # On Python 2, str is also used for text, so wrap Bytes to keep
+            # them distinguishable.
+            value = bytearray(value)
+        _msgpack_pack(value, self._buf)
+
+    def encode_struct(self, validator, value):
+        tag, self._merge_tag = self._merge_tag, None
+        mask = self._mask
+        if mask is None:
+            all_fields = validator.definition._all_fields_
+            for extra_permission in self.caller_permissions.permissions:
+                all_fields_name = '_all_{}_fields_'.format(extra_permission)
+                all_fields = all_fields + getattr(validator.definition, all_fields_name, [])
+            fields = [(field_name, field_validator, None)
+                      for field_name, field_validator in all_fields]
+        else:
+            node = mask.subtypes[_struct_class(value)] if mask.subtypes is not None else mask
+            fields = node.fields
+            for extra_permission in self.caller_permissions.permissions:
+                fields = fields + node.permissioned_fields.get(extra_permission, [])
+
+        # The number of entries goes before them, so find the fields to encode
+        # first. Fields of a lazy struct that haven't been decoded are copied
+        # from the dict it was decoded from, without being validated.
+        raw = self._passes_through(value)
+        present = []
+        for field_name, field_validator, field_mask in fields:
+            if raw is not None and field_mask is None and raw.get(field_name) is not None \
+                    and field_name in value._lazy_fields_:
+                present.append((field_name, None, raw[field_name], None))
+                continue
+
+            try:
+                field_value = getattr(value, field_name)
+            except AttributeError as exc:
+                raise bv.ValidationError(exc.args[0])
+
+            # Only serialize struct fields that have been explicitly set, even
+            # if there is a default
+            if field_value is not None \
+                    and getattr(value, '_%s_present' % field_name):
+                present.append((field_name, field_validator, field_value, field_mask))
+
+        buf = self._buf
+        _msgpack_pack_header(
+            buf, len(present) + (tag is not None), 0x80, 16, (0xde, 0xdf))
+        if tag is not None:
+            _msgpack_pack('.tag', buf)
+            _msgpack_pack(tag, buf)
+        encode_sub = self.encode_frozen if isinstance(value, bb.FrozenStruct) else self.encode_sub
+        try:
+            for field_name, field_validator, field_value, field_mask in present:
+                _msgpack_pack(field_name, buf)
+                if field_validator is None:
+                    _msgpack_pack(field_value, buf)
+                    continue
+                self._mask = field_mask
+                try:
+                    encode_sub(field_validator, field_value)
+                except bv.ValidationError as exc:
+                    exc.add_parent(field_name)
+
+                    raise
+        finally:
+            self._mask = mask
+
+    def encode_struct_tree(self, validator, value):
+        tag, subtype = _get_struct_tree_subtype(validator, value)
+        if self.old_style:
+            _msgpack_pack_header(self._buf, 1, 0x80, 16, (0xde, 0xdf))
+            _msgpack_pack(tag, self._buf)
+        else:
+            self._merge_tag = tag
+        self.encode_struct(subtype, value)
+
+    def encode_union(self, validator, value):
+        if value._tag is None:
+            raise bv.ValidationError('no tag set')
+
+        if not validator.definition._is_tag_present(value._tag, self.caller_permissions):
+            raise bv.ValidationError(
+                "caller does not have access to '{}' tag".format(value._tag))
+
+        field_validator = validator.definition._get_val_data_type(value._tag,
+                                                                  self.caller_permissions)
+
+        is_none = field_validator is None or isinstance(field_validator, bv.Void) \
+            or (isinstance(field_validator, bv.Nullable)
+                and value._value is None)
+
+        mask = self._mask
+        value_mask = None
+        if mask is not None:
+            if value._tag in mask.tags:
+                value_mask = mask.tags[value._tag]
+            else:
+                # Only the tag is selected
+                is_none = True
+        if not is_none and value._value is bb.NOT_LOADED:
+            raise bv.ValidationError("value of tag '%s' was not loaded" % value._tag)
+
+        buf = self._buf
+        if is_none:
+            if self.old_style:
+                _msgpack_pack(value._tag, buf)
+            else:
+                _msgpack_pack_header(buf, 1, 0x80, 16, (0xde, 0xdf))
+                _msgpack_pack('.tag', buf)
+                _msgpack_pack(value._tag, buf)
+            return
+
+        if self.old_style:
+            _msgpack_pack_header(buf, 1, 0x80, 16, (0xde, 0xdf))
+            _msgpack_pack(value._tag, buf)
+        else:
+            inner_validator = field_validator
+            if isinstance(inner_validator, bv.Nullable):
+                # We've already checked for the null case above, so now we're
+                # only interested in what the wrapped validator is
+                inner_validator = inner_validator.validator
+            if isinstance(inner_validator, bv.Struct) \
+                    and not isinstance(inner_validator, bv.StructTree):
+                # The struct's fields follow the tag in the same map.
+                self._merge_tag = value._tag
+            else:
+                _msgpack_pack_header(buf, 2, 0x80, 16, (0xde, 0xdf))
+                _msgpack_pack('.tag', buf)
+                _msgpack_pack(value._tag, buf)
+                _msgpack_pack(value._tag, buf)
+
+        encode_value = \
+            self.encode_frozen if isinstance(value, bb.FrozenUnion) else self.encode_sub
+        self._mask = value_mask
+        try:
+            encode_value(field_validator, value._value)
+        except bv.ValidationError as exc:
+            exc.add_parent(value._tag)
+
+            raise
+        finally:
+            self._mask = mask
+            self._merge_tag = None
+
+msgpack_compat_obj_encode = functools.partial(json_compat_obj_encode, for_msgpack=True)
+
+msgpack_compat_obj_decode = functools.partial(json_compat_obj_decode, for_msgpack=True)
+
+def msgpack_encode(data_type, obj, caller_permissions=None, alias_validators=None,
+                   old_style=False, should_redact=False, field_mask=None):
+    """Encodes an object into msgpack based on its type.
+
+    Takes the same arguments as json_encode(), and validates ``obj`` the same
+    way.
+
+    Returns:
+        bytes: msgpack-encoded object.
+    """
+    field_mask = _get_field_mask(data_type, field_mask)
+    config = _encoded_form_config('msgpack', data_type, obj, caller_permissions,
+                                  alias_validators, old_style, should_redact, field_mask)
+    if config is not None:
+        encoded = encoded_form_cache.get(obj, config)
+        if encoded is not None:
+            return encoded
+    encoded = StoneToMsgpackSerializer(
+        caller_permissions, alias_validators, old_style, should_redact,
+        field_mask).encode(data_type, obj)
+    if config is not None:
+        encoded_form_cache.put(obj, config, encoded)
+    return encoded
+
+def msgpack_decode(data_type, serialized_obj, alias_validators=None, strict=True,
+                   caller_permissions=None, old_style=False, intern_strings=False,
+                   field_mask=None, lazy=False):
+    """Performs the reverse operation of msgpack_encode.
+
+    Takes the same arguments as json_decode(), except that ``serialized_obj``
+    is a bytes-like object, and returns the same values.
+    """
+    try:
+        if msgpack is not None:
+            deserialized_obj = msgpack.unpackb(serialized_obj, raw=False, timestamp=3)
+        else:
+            deserialized_obj = _msgpack_unpack(serialized_obj)
+    except _MSGPACK_DECODE_ERRORS:
+        raise bv.ValidationError('could not decode input as msgpack')
+    return msgpack_compat_obj_decode(
+        data_type, deserialized_obj, caller_permissions=caller_permissions,
+        alias_validators=alias_validators, strict=strict, old_style=old_style,
+        intern_strings=intern_strings, field_mask=field_mask, lazy=lazy)
+
+# --------------------------------------------------------------
+# Stone binary
+#
+# A compact format for peers that share a spec, so nothing that both sides can
+# derive from it goes on the wire. An encoded value starts with the 8-byte
+# big-endian fingerprint of its data type's schema (see binary_fingerprint()),
+# followed by the value:
+#
+#   Void            nothing
+#   Boolean         one byte, 0 or 1
+#   UInt32, UInt64  varint
+#   Other integers  zigzag varint
+#   Float32         little-endian IEEE 754 single
+#   Float64         little-endian IEEE 754 double
+#   String, Bytes   varint length, then the UTF-8 or raw bytes
+#   Timestamp       zigzag varint seconds since the epoch, then varint
+#                   microseconds
+#   List            varint count, then the items
+#   Map             varint count, then alternating keys and values
+#   Nullable        one byte, 0 for null or 1 followed by the value
+#   Struct          presence bitmap over _all_fields_ (bit i of byte i // 8 is
+#                   set if field i is present), then the present fields in
+#                   order
+#   StructTree      varint ordinal of the subtype's tags among the sorted keys
+#                   of _tag_to_subtype_, then the subtype's struct
+#   Union           varint ordinal of the tag among the sorted keys of
+#                   _tagmap, then its value
+#
+# Varints are unsigned LEB128, of at most 64 bits. Caller permissions aren't
+# supported, since permissioned fields would shift the ordinals of the fields
+# after them.
+#
+# The decoder rejects a count larger than the number of bytes left in the
+# input, so a short input can't make it loop for long. Items of Void, or of a
+# struct without fields, take no bytes, so lists of them can't be longer than
+# what follows them.
+
+_BINARY_FINGERPRINT_SIZE = 8
+
+# Maps a validator to the fingerprint of its schema.
+_binary_fingerprints = weakref.WeakKeyDictionary()  # type: typing.MutableMapping[bv.Validator, int] # noqa: E501
+
+# Maps a union class to its tags, sorted, and a mapping from tag to ordinal.
+# StructTree classes map the tag tuples of their subtypes likewise.
+_binary_ordinals = {}  # type: typing.Dict[type, typing.Tuple[typing.List[typing.Any], typing.Dict[typing.Any, int]]] # noqa: E501
+
+def _binary_description(validator):
+    """
+    Describes ``validator`` the way the python_types backend describes data
+    types to derive their ``_fingerprint_``, except that structs and unions
+    are described by their ``_fingerprint_``.
+    """
+    if isinstance(validator, bv.Nullable):
+        return '{}?'.format(_binary_description(validator.validator))
+    elif isinstance(validator, bv.List):
+        return 'List({}{})'.format(
+            _binary_description(validator.item_validator),
+            ''.join(',' + c for c in _binary_constraints(
+                [('min_items', validator.min_items), ('max_items', validator.max_items)])))
+    elif isinstance(validator, bv.Map):
+        return 'Map({},{})'.format(_binary_description(validator.key_validator),
+                                   _binary_description(validator.value_validator))
+    elif isinstance(validator, (bv.Struct, bv.Union)):
+        return '0x{:016x}'.format(_get_definition_fingerprint(validator.definition))
+    elif isinstance(validator, bv.Timestamp):
+        return 'Timestamp({})'.format(validator.format)
+
+    if isinstance(validator, (bv.Integer, bv.Real)):
+        # Bounds are only constraints where they're narrower than the type's.
+        cls = type(validator)
+        constraints = _binary_constraints([
+            ('min_value', None if validator.minimum == cls.minimum else validator.minimum),
+            ('max_value', None if validator.maximum == cls.maximum else validator.maximum)])
+    elif isinstance(validator, (bv.String, bv.Bytes)):
+        constraints = _binary_constraints([
+            ('min_length', validator.min_length), ('max_length', validator.max_length),
+            ('pattern', getattr(validator, 'pattern', None))])
+    else:
+        constraints = []
+    if constraints:
+        return '{}({})'.format(type(validator).__name__, ','.join(constraints))
+    return type(validator).__name__
+
+def _binary_constraints(pairs):
+    # Values are JSON encoded, which is the same on Python 2 and 3.
+    return ['{}={}'.format(name, json.dumps(value)) for name, value in pairs
+            if value is not None]
+
+def _get_definition_fingerprint(definition):
+    fingerprint = definition._fingerprint_
+    if fingerprint is None:
+        raise ValueError(
+            '{} has no _fingerprint_, which the python_types backend generates'.format(
+                definition.__name__))
+    return fingerprint
+
+def binary_fingerprint(data_type):
+    """
+    Returns the fingerprint of the schema of ``data_type`` that prefixes its
+    values in the Stone binary format, as a 64-bit unsigned integer. It changes
+    whenever a change to the spec changes the binary encoding of values.
+
+    The fingerprint of a struct or union is the ``_fingerprint_`` of its
+    class. Other data types are hashed in the same way, with the structs and
+    unions in them described by their fingerprints.
+    """
+    try:
+        return _binary_fingerprints[data_type]
+    except KeyError:
+        pass
+    if isinstance(data_type, (bv.Struct, bv.Union)):
+        fingerprint = _get_definition_fingerprint(data_type.definition)
+    else:
+        digest = hashlib.sha256(_binary_description(data_type).encode('utf-8')).digest()
+        fingerprint = struct.unpack('>Q', digest[:_BINARY_FINGERPRINT_SIZE])[0]
+    _binary_fingerprints[data_type] = fingerprint
+    return fingerprint
+
+def _get_binary_ordinals(definition):
+    try:
+        return _binary_ordinals[definition]
+    except KeyError:
+        pass
+    if hasattr(definition, '_tag_to_subtype_'):
+        keys = sorted(definition._tag_to_subtype_)
+    else:
+        keys = sorted(definition._tagmap)
+    ordinals = (keys, {key: i for i, key in enumerate(keys)})
+    _binary_ordinals[definition] = ordinals
+    return ordinals
+
+def _binary_write_varint(buf, n):
+    while n > 0x7f:
+        buf.append(n & 0x7f | 0x80)
+        n >>= 7
+    buf.append(n)
+
+def _binary_write_zigzag(buf, n):
+    _binary_write_varint(buf, n << 1 if n >= 0 else (-n << 1) - 1)
+
+class StoneToBinarySerializer(StoneSerializerBase):
+    """
+    Encodes values in the Stone binary format. Each encode() call appends to a
+    new buffer, so instances must not be shared between threads.
+    """
+
+    def __init__(self, alias_validators):
+        # type: (typing.Mapping[bv.Validator, typing.Callable[[typing.Any], None]]) -> None # noqa: E501
+        super(StoneToBinarySerializer, self).__init__(
+            CallerPermissionsDefault(), alias_validators)
+        self._buf = bytearray()
+
+    def encode(self, validator, value):
+        self._buf = bytearray(struct.pack('>Q', binary_fingerprint(validator)))
+        self.encode_sub(validator, value)
+        return bytes(self._buf)
+
+    def encode_list(self, validator, value):
+        _binary_write_varint(self._buf, len(value))
+        encode_sub = self.encode_sub
+        item_validator = validator.item_validator
+        for item in value:
+            encode_sub(item_validator, item)
+
+    def encode_map(self, validator, value):
+        _binary_write_varint(self._buf, len(value))
+        encode_sub = self.encode_sub
+        key_validator = validator.key_validator
+        value_validator = validator.value_validator
+        for key, item in value.items():
+            encode_sub(key_validator, key)
+            encode_sub(value_validator, item)
+
+    def encode_nullable(self, validator, value):
+        if value is None:
+            self._buf.append(0)
+        else:
+            self._buf.append(1)
+            self.encode_sub(validator.validator, value)
+
+    def encode_primitive(self, validator, value):
+        if validator in self.alias_validators:
+            self.alias_validators[validator](value)
+
+        buf = self._buf
+        if isinstance(validator, bv.Void):
+            pass
+        elif isinstance(validator, bv.Boolean):
+            buf.append(1 if value else 0)
+        elif isinstance(validator, (bv.UInt32, bv.UInt64)):
+            _binary_write_varint(buf, value)
+        elif isinstance(validator, bv.Integer):
+            _binary_write_zigzag(buf, value)
+        elif isinstance(validator, bv.Float32):
+            buf += struct.pack('<f', value)
+        elif isinstance(validator, bv.Real):
+            buf += struct.pack('<d', value)
+        elif isinstance(validator, bv.Timestamp):
+            seconds, nanoseconds = _datetime_to_epoch_time(value)
+            _binary_write_zigzag(buf, seconds)
+            _binary_write_varint(buf, nanoseconds // 1000)
+        else:
+            if isinstance(value, six.text_type):
+                value = value.encode('utf-8')
+            _binary_write_varint(buf, len(value))
+            buf += value
+
+    def encode_struct(self, validator, value):
+        buf = self._buf
+        all_fields = validator.definition._all_fields_
+        bitmap_start = len(buf)
+        buf += bytearray((len(all_fields) + 7) // 8)
+        for i, (field_name, field_validator) in enumerate(all_fields):
+            try:
+                field_value = getattr(value, field_name)
+            except AttributeError as exc:
+                raise bv.ValidationError(exc.args[0])
+
+            # As with JSON, only fields that have been explicitly set are
+            # encoded, even if there is a default.
+            if field_value is not None \
+                    and getattr(value, '_%s_present' % field_name):
+                buf[bitmap_start + i // 8] |= 1 << i % 8
+                try:
+                    self.encode_sub(field_validator, field_value)
+                except bv.ValidationError as exc:
+                    exc.add_parent(field_name)
+
+                    raise
+
+    def encode_struct_tree(self, validator, value):
+        pytype = _struct_class(value)
+        assert pytype in validator.definition._pytype_to_tag_and_subtype_, \
+            '%r is not a serializable subtype of %r.' % (pytype, validator.definition)
+
+        tags, subtype = validator.definition._pytype_to_tag_and_subtype_[pytype]
+
+        assert not isinstance(subtype, bv.StructTree), \
+            'Cannot serialize type %r because it enumerates subtypes.' % subtype.definition
+
+        _binary_write_varint(self._buf, _get_binary_ordinals(validator.definition)[1][tags])
+        self.encode_struct(subtype, value)
+
+    def encode_union(self, validator, value):
+        if value._tag is None:
+            raise bv.ValidationError('no tag set')
+
+        definition = validator.definition
+        try:
+            ordinal = _get_binary_ordinals(definition)[1][value._tag]
+        except KeyError:
+            raise bv.ValidationError(
+                "caller does not have access to '{}' tag".format(value._tag))
+        _binary_write_varint(self._buf, ordinal)
+
+        field_validator = definition._tagmap[value._tag]
+        if not isinstance(field_validator, bv.Void):
+            try:
+                self.encode_sub(field_validator, value._value)
+            except bv.ValidationError as exc:
+                exc.add_parent(value._tag)
+
+                raise
+
+class BinaryToStoneDecoder(object):
+    """
+    Decodes values in the Stone binary format. Instances keep the position in
+    the input being decoded, so they must not be shared between threads.
+    """
+
+    def __init__(self, alias_validators):
+        self.alias_validators = alias_validators
+        self._data = b''
+        self._pos = 0
+
+    def decode(self, data_type, data):
+        """
+        Returns the value of ``data_type`` encoded in ``data``, a bytes-like
+        object.
+        """
+        if six.PY2 or not isinstance(data, (bytes, bytearray)):
+            data = bytearray(data)
+        self._data = data
+        self._pos = _BINARY_FINGERPRINT_SIZE
+        if len(data) < _BINARY_FINGERPRINT_SIZE:
+            raise bv.ValidationError('could not decode input as Stone binary')
+        fingerprint = struct.unpack_from('>Q', data)[0]
+        expected = binary_fingerprint(data_type)
+        if fingerprint != expected:
+            raise bv.ValidationError(
+                'schema fingerprint mismatch: expected 0x%016x, got 0x%016x' %
+                (expected, fingerprint))
+        try:
+            ret = self.decode_sub(data_type)
+        except (IndexError, OverflowError, ValueError, struct.error):
+            raise bv.ValidationError('could not decode input as Stone binary')
+        if self._pos != len(data):
+            raise bv.ValidationError('unexpected data after Stone binary value')
+        if not isinstance(data_type, (bv.Struct, bv.Union)):
+            # Values in structs and unions were validated as they were
+            # assigned, but nothing has checked these yet.
+            ret = data_type.validate(ret)
+        return ret
+
+    def decode_sub(self, data_type):
+        if isinstance(data_type, bv.StructTree):
+            return self.decode_struct_tree(data_type)
+        elif isinstance(data_type, bv.Struct):
+            return self.decode_struct(data_type)
+        elif isinstance(data_type, bv.Union):
+            return self.decode_union(data_type)
+        elif isinstance(data_type, bv.List):
+            return [self.decode_sub(data_type.item_validator)
+                    for _ in range(self.read_count())]
+        elif isinstance(data_type, bv.Map):
+            key_validator = data_type.key_validator
+            value_validator = data_type.value_validator
+            d = {}
+            for _ in range(self.read_count()):
+                key = self.decode_sub(key_validator)
+                d[key] = self.decode_sub(value_validator)
+            return d
+        elif isinstance(data_type, bv.Nullable):
+            if self.read_byte():
+                return self.decode_sub(data_type.validator)
+            return None
+        elif isinstance(data_type, bv.Primitive):
+            # Validation will be done by the containing struct or union when
+            # the field is assigned, or by decode() if there's none.
+            return self.decode_primitive(data_type)
+        else:
+            raise AssertionError('Cannot handle type %r.' % data_type)
+
+    def decode_primitive(self, data_type):
+        if isinstance(data_type, bv.Void):
+            ret = None
+        elif isinstance(data_type, bv.Boolean):
+            ret = bool(self.read_byte())
+        elif isinstance(data_type, (bv.UInt32, bv.UInt64)):
+            ret = self.read_varint()
+        elif isinstance(data_type, bv.Integer):
+            ret = self.read_zigzag()
+        elif isinstance(data_type, bv.Float32):
+            ret = struct.unpack('<f', self.read_bytes(4))[0]
+        elif isinstance(data_type, bv.Real):
+            ret = struct.unpack('<d', self.read_bytes(8))[0]
+        elif isinstance(data_type, bv.Timestamp):
+            seconds = self.read_zigzag()
+            ret = _epoch_time_to_datetime(seconds, self.read_varint() * 1000)
+        elif isinstance(data_type, bv.Bytes):
+            ret = bytes(self.read_bytes(self.read_varint()))
+        else:
+            ret = self.read_bytes(self.read_varint()).decode('utf-8')
+        if self.alias_validators is not None and data_type in self.alias_validators:
+            self.alias_validators[data_type](ret)
+        return ret
+
+    def decode_struct(self, data_type):
+        all_fields = data_type.definition._all_fields_
+        bitmap = self.read_bytes((len(all_fields) + 7) // 8)
+        ins = data_type.definition()
+        set_field = _field_setter(ins)
+        for i, (name, field_data_type) in enumerate(all_fields):
+            if bitmap[i // 8] >> i % 8 & 1:
+                try:
+                    set_field(name, self.decode_sub(field_data_type))
+                except bv.ValidationError as e:
+                    e.add_parent(name)
+                    raise
+            elif field_data_type.has_default():
+                set_field(name, field_data_type.get_default())
+        # Check that all required fields have been set.
+        data_type.validate_fields_only(ins)
+        return ins
+
+    def decode_struct_tree(self, data_type):
+        keys = _get_binary_ordinals(data_type.definition)[0]
+        ordinal = self.read_varint()
+        if ordinal >= len(keys):
+            raise bv.ValidationError('unknown subtype ordinal %d' % ordinal)
+        subtype = data_type.definition._tag_to_subtype_[keys[ordinal]]
+        if isinstance(subtype, bv.StructTree):
+            raise bv.ValidationError("tag '%s' refers to non-leaf subtype" %
+                                     '.'.join(keys[ordinal]))
+        return self.decode_struct(subtype)
+
+    def decode_union(self, data_type):
+        definition = data_type.definition
+        tags = _get_binary_ordinals(definition)[0]
+        ordinal = self.read_varint()
+        if ordinal >= len(tags):
+            raise bv.ValidationError('unknown tag ordinal %d' % ordinal)
+        tag = tags[ordinal]
+        val_data_type = definition._tagmap[tag]
+        val = None
+        if not isinstance(val_data_type, bv.Void):
+            try:
+                val = self.decode_sub(val_data_type)
+            except bv.ValidationError as e:
+                e.add_parent(tag)
+                raise
+        return _make_union_instance(definition, tag, val)
+
+    def read_byte(self):
+        b = self._data[self._pos]
+        self._pos += 1
+        return b
+
+    def read_bytes(self, n):
+        start = self._pos
+        end = self._pos = start + n
+        if end > len(self._data):
+            raise ValueError('truncated input')
+        return self._data[start:end]
+
+    def read_varint(self):
+        data = self._data
+        pos = self._pos
+        n = shift = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                self._pos = pos
+                return n
+            shift += 7
+            if shift > 63:
+                raise ValueError('varint longer than 64 bits')
+
+    def read_zigzag(self):
+        n = self.read_varint()
+        return n >> 1 if not n & 1 else -(n >> 1) - 1
+
+    def read_count(self):
+        n = self.read_varint()
+        if n > len(self._data) - self._pos:
+            raise ValueError('count larger than the rest of the input')
+        return n
+
+def binary_encode(data_type, obj, alias_validators=None):
+    """Encodes an object into the Stone binary format based on its type.
+
+    Args:
+        data_type (Validator): Validator for obj.
+        obj (object): Object to be serialized.
+        alias_validators (Optional[Mapping[bv.Validator, Callable[[], None]]]):
+            Custom validation functions. These must raise bv.ValidationError on
+            failure.
+
+    Returns:
+        bytes: The encoded object, prefixed with binary_fingerprint(data_type).
+
+    See json_encode() for additional information about validation.
+    """
+    return StoneToBinarySerializer(alias_validators).encode(data_type, obj)
+
+def binary_decode(data_type, serialized_obj, alias_validators=None):
+    """Performs the reverse operation of binary_encode.
+
+    Args:
+        data_type (Validator): Validator for serialized_obj.
+        serialized_obj: The bytes-like object to deserialize.
+        alias_validators (Optional[Mapping[bv.Validator, Callable[[], None]]]):
+            Custom validation functions. These must raise bv.ValidationError on
+            failure.
+
+    Returns:
+        See json_decode(). A bv.ValidationError is raised if serialized_obj
+        was encoded with a different schema for data_type.
+    """
+    return BinaryToStoneDecoder(alias_validators).decode(data_type, serialized_obj)
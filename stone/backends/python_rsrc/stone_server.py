@@ -0,0 +1,366 @@
+"""
+Serves the routes of the modules generated by the python_types backend, with
+a Dispatcher that maps requests to handlers and a WSGI adapter. stone_asgi.py
+has an ASGI adapter for the same Dispatcher.
+
+Routes are served the way stone_async.HttpTransport calls them: each is
+POSTed to ``<prefix>/<namespace>/<route>``, where versioned routes have a
+``_v<version>`` suffix, and the ``style`` route attribute picks how the
+argument and result are carried:
+
+* ``rpc`` (also used if unset): both are JSON bodies.
+* ``upload``: the argument is JSON in the Stone-API-Arg header, and the body
+  is passed to the handler. The result is a JSON body.
+* ``download``: the argument is JSON in the Stone-API-Arg header. The handler
+  returns a (result, body) tuple; the result is sent as JSON in the
+  Stone-API-Result header, and the body is streamed.
+
+A handler raises RouteError to return an error of the route's type, which is
+sent with status 409 as the ``error`` key of a JSON body. Arguments that
+can't be decoded get status 400, and paths that aren't a route with a handler
+get status 404.
+
+This module should be dropped into a project that requires the use of Stone. In
+the future, this could be imported from a pre-installed Python package, rather
+than being added to a project.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import functools
+import json
+import threading
+
+try:
+    from . import stone_base as bb
+    from . import stone_serializers as ss
+    from . import stone_streams
+    from . import stone_validators as bv
+except (ImportError, SystemError, ValueError):
+    # Catch errors raised when importing a relative module when not in a package.
+    # This makes testing this file directly (outside of a package) easier.
+    import stone_base as bb  # type: ignore
+    import stone_serializers as ss  # type: ignore
+    import stone_streams  # type: ignore
+    import stone_validators as bv  # type: ignore
+
+_MYPY = False
+if _MYPY:
+    import typing  # noqa: F401 # pylint: disable=import-error,unused-import,useless-suppression
+
+ARG_HEADER = 'Stone-API-Arg'
+RESULT_HEADER = 'Stone-API-Result'
+
+class RouteError(Exception):
+    """Raised by a handler to respond with an error of the route's error
+    type."""
+
+    def __init__(self, error):
+        super(RouteError, self).__init__(error)
+        self.error = error
+
+def route_key(namespace, route):
+    """Returns the ``namespace/route:version`` key of a route."""
+    return '{}/{}:{}'.format(namespace, route.name, route.version)
+
+def route_path(namespace, route):
+    """Returns the path of a route relative to the prefix it's served at."""
+    if route.version > 1:
+        return '{}/{}_v{}'.format(namespace, route.name, route.version)
+    return '{}/{}'.format(namespace, route.name)
+
+class _Codecs(threading.local):
+    # The serializer and decoder used by the routes of a Dispatcher. They
+    # keep state while they work, so each thread has its own.
+
+    def __init__(self, caller_permissions, alias_validators, strict):
+        super(_Codecs, self).__init__()
+        self.caller_permissions = caller_permissions
+        self.alias_validators = alias_validators
+        self.encoder = ss.StoneToPythonPrimitiveSerializer(
+            caller_permissions, alias_validators, False, False, False)
+        self.decoder = ss.PythonPrimitiveToStoneDecoder(
+            caller_permissions, alias_validators, False, False, strict)
+
+class BoundRoute(object):
+    """A route with its handler and the codec for its argument, result and
+    error, which are bound when the Dispatcher is created."""
+
+    __slots__ = ('key', 'path', 'route', 'style', 'handler', '_codecs', '_decode_arg',
+                 '_arg_type', '_result_type', '_error_type')
+
+    def __init__(self, namespace, route, codecs):
+        self.key = route_key(namespace, route)
+        self.path = route_path(namespace, route)
+        self.route = route
+        self.style = route.attrs.get('style') or 'rpc'
+        self.handler = None  # type: typing.Optional[typing.Callable[..., typing.Any]]
+        self._codecs = codecs
+        self._arg_type = route.arg_type
+        self._result_type = route.result_type
+        self._error_type = route.error_type
+        if isinstance(route.arg_type, bv.Primitive):
+            self._decode_arg = self._decode_primitive_arg
+        else:
+            self._decode_arg = self._decode_composite_arg
+
+    def decode_arg(self, serialized_arg):
+        """Decodes the JSON argument of a request.
+
+        Raises:
+            stone_validators.ValidationError
+        """
+        if isinstance(serialized_arg, bytes):
+            try:
+                serialized_arg = serialized_arg.decode('utf-8')
+            except UnicodeDecodeError:
+                raise bv.ValidationError('could not decode input as UTF-8')
+        try:
+            obj = json.loads(serialized_arg)
+        except ValueError:
+            raise bv.ValidationError('could not decode input as JSON')
+        return self._decode_arg(obj)
+
+    def _decode_primitive_arg(self, obj):
+        return self._codecs.decoder.make_stone_friendly(self._arg_type, obj, True)
+
+    def _decode_composite_arg(self, obj):
+        return self._codecs.decoder.json_compat_obj_decode_helper(self._arg_type, obj)
+
+    def encode_result(self, result):
+        """Returns the JSON encoding of a result, as ASCII bytes."""
+        if isinstance(result, (bb.FrozenStruct, bb.FrozenUnion)):
+            # json_encode() caches the encodings of frozen objects.
+            codecs = self._codecs
+            return ss.json_encode(self._result_type, result, codecs.caller_permissions,
+                                  codecs.alias_validators).encode('ascii')
+        return json.dumps(self._codecs.encoder.encode(self._result_type, result)).encode('ascii')
+
+    def encode_error(self, error):
+        """Returns the JSON body of a response with an error, as ASCII
+        bytes."""
+        return json.dumps(
+            {'error': self._codecs.encoder.encode(self._error_type, error)}).encode('ascii')
+
+    def __repr__(self):
+        return 'BoundRoute({!r}, {!r})'.format(self.key, self.handler)
+
+class Dispatcher(object):
+    """Maps the routes of generated namespace modules to handlers.
+
+    The routes are indexed by their ``namespace/route:version`` keys and by
+    the paths they're served at, so finding the route for a request is one
+    dict lookup. Each route's codec is bound up front, rather than when it's
+    called.
+
+    Handlers are called with the decoded argument, the body for upload
+    routes, and the request: the WSGI environ or the ASGI scope::
+
+        dispatcher = Dispatcher({'files': files, 'users': users})
+
+        @dispatcher.handler('files/get_metadata')
+        def get_metadata(arg, request):
+            ...
+            raise RouteError(files.GetMetadataError.not_found)
+
+        @dispatcher.handler('files/upload:2')
+        def upload(arg, body, request):
+            ...
+
+        app = WsgiApp(dispatcher, prefix='/2')
+    """
+
+    def __init__(self, namespaces, caller_permissions=None, alias_validators=None,
+                 strict=True):
+        """
+        Args:
+            namespaces: Maps the names of namespaces to their modules
+                generated by the python_types backend, or to the ROUTES dicts
+                of the modules.
+            caller_permissions (list): The caller permissions arguments and
+                results are decoded and encoded with.
+            alias_validators: Custom validation functions for arguments and
+                results. See json_decode().
+            strict (bool): Whether unknown struct fields and union tags in
+                arguments are errors. See json_decode().
+        """
+        self._codecs = _Codecs(caller_permissions, alias_validators, strict)
+        # Maps route keys to routes.
+        self.routes = {}  # type: typing.Dict[typing.Text, BoundRoute]
+        # Maps the paths that routes are served at to routes.
+        self.paths = {}  # type: typing.Dict[typing.Text, BoundRoute]
+        for namespace, routes in namespaces.items():
+            for route in getattr(routes, 'ROUTES', routes).values():
+                bound = BoundRoute(namespace, route, self._codecs)
+                self.routes[bound.key] = bound
+                self.paths[bound.path] = bound
+
+    def register(self, key, handler):
+        """Sets the handler of the route with a ``namespace/route:version``
+        key. The version can be left out for version 1.
+
+        Returns:
+            The handler.
+        """
+        if ':' not in key:
+            key += ':1'
+        bound = self.routes.get(key)
+        if bound is None:
+            raise ValueError('Unknown route {!r}'.format(key))
+        bound.handler = handler
+        return handler
+
+    def handler(self, key):
+        """A decorator that registers the function as the handler of a
+        route."""
+        return functools.partial(self.register, key)
+
+    def unhandled(self):
+        """Returns the sorted keys of the routes without a handler."""
+        return sorted(key for key, bound in self.routes.items() if bound.handler is None)
+
+# --------------------------------------------------------------
+# WSGI
+
+# WSGI takes the status and headers as native strings, hence the str() calls.
+_STATUSES = {
+    200: str('200 OK'),
+    400: str('400 Bad Request'),
+    404: str('404 Not Found'),
+    405: str('405 Method Not Allowed'),
+    409: str('409 Conflict'),
+}
+
+_JSON_CONTENT_TYPE = (str('Content-Type'), str('application/json'))
+_TEXT_CONTENT_TYPE = (str('Content-Type'), str('text/plain; charset=utf-8'))
+_BINARY_CONTENT_TYPE = (str('Content-Type'), str('application/octet-stream'))
+_ALLOW_POST = [(str('Allow'), str('POST')), (str('Content-Length'), str('0'))]
+_CONTENT_LENGTH = str('Content-Length')
+_RESULT_HEADER = str(RESULT_HEADER)
+
+class WsgiInput(object):
+    """The body of an upload request to a WsgiApp: a binary file-like object
+    that reads wsgi.input up to the end of the body."""
+
+    def __init__(self, environ):
+        self._input = environ['wsgi.input']
+        length = environ.get('CONTENT_LENGTH')
+        if length:
+            self._left = int(length)
+        elif environ.get('wsgi.input_terminated'):
+            # The server has decoded a body sent with chunked encoding.
+            self._left = None
+        else:
+            self._left = 0
+
+    def read(self, size=-1):
+        if self._left is None:
+            return self._input.read(size) if size >= 0 else self._input.read()
+        if size < 0 or size > self._left:
+            size = self._left
+        data = self._input.read(size) if size else b''
+        self._left -= len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(stone_streams.DEFAULT_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+def _to_bytes(chunk):
+    # bytes() of a memoryview is its repr on Python 2.
+    if isinstance(chunk, bytes):
+        return chunk
+    if isinstance(chunk, memoryview):
+        return chunk.tobytes()
+    return bytes(chunk)
+
+def _iter_download_body(body):
+    # Yields a download body as bytes, which is what WSGI servers take, and
+    # closes it once it has been sent.
+    try:
+        if hasattr(body, 'read'):
+            while True:
+                chunk = body.read(stone_streams.DEFAULT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        else:
+            for chunk in body:
+                yield _to_bytes(chunk)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+class WsgiApp(object):
+    """A WSGI application that serves the routes of a Dispatcher at
+    ``<prefix>/<namespace>/<route>``.
+
+    Download bodies can be bytes, a memoryview, a binary file object or an
+    iterable of chunks of bytes. Files are sent with the server's
+    wsgi.file_wrapper, which can use os.sendfile(), and closed once they've
+    been sent.
+    """
+
+    def __init__(self, dispatcher, prefix=''):
+        self.dispatcher = dispatcher
+        self._paths = dispatcher.paths
+        self._prefix = prefix.rstrip('/') + '/'
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        bound = None
+        if path.startswith(self._prefix):
+            bound = self._paths.get(path[len(self._prefix):])
+        if bound is None or bound.handler is None:
+            return self._respond(start_response, 404, _TEXT_CONTENT_TYPE, b'Unknown route')
+        if environ['REQUEST_METHOD'] != 'POST':
+            start_response(_STATUSES[405], list(_ALLOW_POST))
+            return [b'']
+
+        style = bound.style
+        try:
+            if style == 'rpc':
+                arg = bound.decode_arg(WsgiInput(environ).read())
+            else:
+                arg = bound.decode_arg(environ.get('HTTP_STONE_API_ARG', ''))
+        except bv.ValidationError as e:
+            return self._respond(start_response, 400, _TEXT_CONTENT_TYPE,
+                                 'Bad argument: {}'.format(e).encode('utf-8'))
+
+        try:
+            if style == 'upload':
+                r = bound.handler(arg, WsgiInput(environ), environ)
+            else:
+                r = bound.handler(arg, environ)
+        except RouteError as e:
+            return self._respond(start_response, 409, _JSON_CONTENT_TYPE,
+                                 bound.encode_error(e.error))
+        if style != 'download':
+            return self._respond(start_response, 200, _JSON_CONTENT_TYPE, bound.encode_result(r))
+
+        result, body = r
+        try:
+            headers = [_BINARY_CONTENT_TYPE,
+                       (_RESULT_HEADER, str(bound.encode_result(result).decode('ascii')))]
+            length = stone_streams.body_length(body)
+            if length is not None:
+                headers.append((_CONTENT_LENGTH, str(length)))
+            start_response(_STATUSES[200], headers)
+        except BaseException:
+            # The body is only closed by the server once it's been returned.
+            if hasattr(body, 'close'):
+                body.close()
+            raise
+        if stone_streams.is_bytes_like(body):
+            return [_to_bytes(body)]
+        if length is not None and 'wsgi.file_wrapper' in environ:
+            return environ['wsgi.file_wrapper'](body, stone_streams.DEFAULT_CHUNK_SIZE)
+        return _iter_download_body(body)
+
+    @staticmethod
+    def _respond(start_response, status, content_type, body):
+        start_response(_STATUSES[status], [content_type, (_CONTENT_LENGTH, str(len(body)))])
+        return [body]
@@ -0,0 +1,139 @@
+"""
+Helpers for streaming the bodies of upload and download routes.
+
+Upload bodies can be bytes, a memoryview, a binary file object or an iterable
+of chunks of bytes. They're sent in chunks, without loading files into memory.
+
+This module should be dropped into a project that requires the use of Stone. In
+the future, this could be imported from a pre-installed Python package, rather
+than being added to a project.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import os
+import six
+import stat
+
+_MYPY = False
+if _MYPY:
+    import typing  # noqa: F401 # pylint: disable=import-error,unused-import,useless-suppression
+
+# The size of the chunks that bodies are read and written in by default.
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+def is_bytes_like(body):
+    return isinstance(body, (bytes, bytearray, memoryview))
+
+def _byte_view(body):
+    view = memoryview(body)
+    if view.itemsize != 1 or view.ndim != 1:
+        view = view.cast('B')
+    return view
+
+def _regular_file_fileno(f):
+    # Returns the file descriptor of a file object for a regular file, or
+    # None if it doesn't have one.
+    try:
+        fileno = f.fileno()
+        if stat.S_ISREG(os.fstat(fileno).st_mode):
+            return fileno
+    except (AttributeError, EnvironmentError, ValueError):
+        pass
+    return None
+
+def body_length(body):
+    """Returns the number of bytes left in an upload body, or None if it isn't
+    known up front, e.g. for an iterable of chunks or a pipe."""
+    if is_bytes_like(body):
+        return len(_byte_view(body))
+    fileno = _regular_file_fileno(body)
+    if fileno is not None:
+        return max(os.fstat(fileno).st_size - body.tell(), 0)
+    return None
+
+def iter_body_chunks(body, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields an upload body in chunks of at most ``chunk_size`` bytes.
+
+    Bytes-like bodies are sliced without copying them. File objects are read
+    with readinto() into a buffer that's reused, so a chunk is only valid
+    until the next one is taken. Other iterables are assumed to yield chunks
+    of bytes already.
+    """
+    if isinstance(body, six.text_type):
+        raise TypeError('Expected a binary body, got text')
+    if is_bytes_like(body):
+        view = _byte_view(body)
+        for i in range(0, len(view), chunk_size):
+            yield view[i:i + chunk_size]
+    elif hasattr(body, 'readinto'):
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        while True:
+            n = body.readinto(buf)
+            if not n:
+                break
+            yield view[:n]
+    elif hasattr(body, 'read'):
+        while True:
+            chunk = body.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        for chunk in body:
+            yield chunk
+
+def send_body(sock, body, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Sends an upload body on a connected socket.
+
+    A regular file is sent from its current position with socket.sendfile(),
+    which uses os.sendfile() where it's available so that the file isn't
+    copied into user space. Other bodies are sent in chunks from
+    iter_body_chunks().
+
+    Returns:
+        int: The number of bytes sent.
+    """
+    if hasattr(sock, 'sendfile') and _regular_file_fileno(body) is not None:
+        return sock.sendfile(body, body.tell())
+    sent = 0
+    for chunk in iter_body_chunks(body, chunk_size):
+        sock.sendall(chunk)
+        sent += len(chunk)
+    return sent
+
+def iter_download_chunks(body, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yields a download body in chunks.
+
+    ``body`` can be anything iter_body_chunks() takes, e.g. an
+    http.client.HTTPResponse, which is read with readinto(). A
+    requests.Response is read with its iter_content() method.
+    """
+    if hasattr(body, 'iter_content'):
+        return body.iter_content(chunk_size)
+    return iter_body_chunks(body, chunk_size)
+
+def save_body_to_file(body, download_path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Writes a download body to a path, or to a binary file object, in
+    chunks.
+
+    Args:
+        body: A body that iter_download_chunks() takes.
+        download_path: A path, or a binary file object opened for writing.
+        chunk_size (int): The size of the chunks to read and write.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    if hasattr(download_path, 'write'):
+        return _write_chunks(iter_download_chunks(body, chunk_size), download_path)
+    with open(download_path, 'wb') as f:
+        return _write_chunks(iter_download_chunks(body, chunk_size), f)
+
+def _write_chunks(chunks, f):
+    written = 0
+    for chunk in chunks:
+        f.write(chunk)
+        written += len(chunk)
+    return written
@@ -13,12 +13,15 @@ than being added to a project.
 from __future__ import absolute_import, unicode_literals
 
 from abc import ABCMeta, abstractmethod
+import collections
 import datetime
 import hashlib
 import math
 import numbers
 import re
 import six
+import threading
+from six.moves import reprlib
 
 _MYPY = False
 if _MYPY:
@@ -30,23 +33,84 @@ if six.PY3:
 else:
     _binary_types = (bytes, buffer)  # noqa: E501,F821 # pylint: disable=undefined-variable,useless-suppression
 
+# Sentinel for a ValidationError that doesn't record the rejected value.
+_NO_VALUE = object()
+
+# Values in validation error messages are truncated to roughly this many
+# characters.
+_MAX_PREVIEW_LENGTH = 80
+
+_preview_repr = reprlib.Repr()
+_preview_repr.maxstring = _MAX_PREVIEW_LENGTH
+_preview_repr.maxother = _MAX_PREVIEW_LENGTH
+_preview_repr.maxlong = _MAX_PREVIEW_LENGTH
+_preview_repr.maxlist = _preview_repr.maxtuple = 10
+_preview_repr.maxdict = _preview_repr.maxset = _preview_repr.maxfrozenset = 10
+_preview_repr.maxlevel = 3
+
 
 class ValidationError(Exception):
-    """Raised when a value doesn't pass validation by its validator."""
+    """Raised when a value doesn't pass validation by its validator.
+
+    Validation failures are expected to be cheap, even for very large values,
+    so the message is only rendered when the error is converted to a string.
+    The offending value is only ever rendered as a truncated preview, which is
+    taken when the error is created so that the error doesn't keep the value
+    alive.
+    """
 
-    def __init__(self, message, parent=None):
+    def __init__(self, message, parent=None, validator=None, value=_NO_VALUE,
+                 message_args=()):
         """
         Args:
-            message (str): Error message detailing validation failure.
+            message (str): Error message detailing validation failure. If
+                ``value`` or ``message_args`` is given, this is a
+                :meth:`str.format` template in which ``{value}`` (or
+                ``{value!r}``) is replaced by a preview of ``value`` and
+                positional fields are replaced by ``message_args``.
             parent (str): Adds the parent as the closest reference point for
                 the error. Use :meth:`add_parent` to add more.
+            validator (Validator): The validator that rejected the value.
+            value: The value that failed validation.
+            message_args (tuple): Positional arguments for ``message``.
         """
         super(ValidationError, self).__init__(message)
-        self.message = message
+        self._template = message
+        self._rendered = None if value is not _NO_VALUE or message_args else message
+        self._message_args = message_args
+        self.validator = validator
+        self._preview = None if value is _NO_VALUE else _ValuePreview(value)
         self._parents = []
         if parent:
             self._parents.append(parent)
 
+    @property
+    def message(self):
+        """
+        str: The error message, without the path to the failed validator.
+        """
+        if self._rendered is None:
+            self._rendered = self._template.format(*self._message_args, value=self._preview)
+        return self._rendered
+
+    @property
+    def value_preview(self):
+        """
+        str: A truncated representation of the value that failed validation,
+            or None if the value wasn't recorded.
+        """
+        if self._preview is None:
+            return None
+        return repr(self._preview)
+
+    @property
+    def path(self):
+        """
+        list: The names of the fields and tags that lead from the outermost
+            value to the one that failed validation.
+        """
+        return self._parents[::-1]
+
     def add_parent(self, parent):
         """
         Args:
@@ -71,6 +135,48 @@ class ValidationError(Exception):
         return 'ValidationError(%r)' % six.text_type(self)
 
 
+class _ValuePreview(object):
+    """
+    Stands in for a value that's formatted into a validation error message,
+    bounding the size of the output regardless of the size of the value. Only
+    the preview is kept, not the value.
+    """
+
+    __slots__ = ['_str', '_repr']
+
+    def __init__(self, val):
+        if isinstance(val, numbers.Integral) and not isinstance(val, bool):
+            self._repr = _format_integer(val)
+        elif isinstance(val, (six.binary_type, bytearray)):
+            # Sliced first, as reprlib renders these in full before truncating.
+            self._repr = _preview_repr.repr(val[:_MAX_PREVIEW_LENGTH + 1])
+        else:
+            try:
+                self._repr = _preview_repr.repr(val)
+            except ValueError:
+                # Raised by Python 3.11+ for integers with too many digits.
+                self._repr = '<%s>' % type(val).__name__
+        if isinstance(val, (six.text_type, six.binary_type)):
+            if len(val) > _MAX_PREVIEW_LENGTH:
+                ellipsis = b'...' if isinstance(val, six.binary_type) else '...'
+                val = val[:_MAX_PREVIEW_LENGTH] + ellipsis
+            self._str = '%s' % (val,)
+        else:
+            self._str = self._repr
+
+    def __format__(self, format_spec):
+        return self._str
+
+    def __repr__(self):
+        return self._repr
+
+
+def _format_integer(val):
+    if val.bit_length() > _MAX_PREVIEW_LENGTH * 3:
+        return '<integer with %d bits>' % val.bit_length()
+    return '%d' % val
+
+
 def generic_type_name(v):
     """Return a descriptive type name that isn't Python specific. For example,
     an int value will return 'integer' rather than 'int'."""
@@ -105,6 +211,14 @@ class Validator(object):
         """
         pass
 
+    def validate_returns_input(self):
+        """
+        Returns whether :meth:`validate` always returns the value it was
+        given, unchanged. Containers of values with such a validator are
+        validated in place rather than copied.
+        """
+        return False
+
     def has_default(self):
         return False
 
@@ -115,14 +229,17 @@ class Validator(object):
 class Primitive(Validator):
     """A basic type that is defined by Stone."""
     # pylint: disable=abstract-method
-    pass
+
+    def validate_returns_input(self):
+        return True
 
 
 class Boolean(Primitive):
 
     def validate(self, val):
         if not isinstance(val, bool):
-            raise ValidationError('%r is not a valid boolean' % val)
+            raise ValidationError('{value!r} is not a valid boolean',
+                                  validator=self, value=val)
         return val
 
 
@@ -159,8 +276,9 @@ class Integer(Primitive):
             raise ValidationError('expected integer, got %s'
                                   % generic_type_name(val))
         elif not (self.minimum <= val <= self.maximum):
-            raise ValidationError('%d is not within range [%d, %d]'
-                                  % (val, self.minimum, self.maximum))
+            raise ValidationError('{value} is not within range [{}, {}]',
+                                  validator=self, value=val,
+                                  message_args=(self.minimum, self.maximum))
         return val
 
     def __repr__(self):
@@ -228,6 +346,10 @@ class Real(Primitive):
                                      (max_value, self.maximum))
             self.maximum = max_value
 
+    def validate_returns_input(self):
+        # Non-float numbers are converted to floats.
+        return False
+
     def validate(self, val):
         if not isinstance(val, numbers.Real):
             raise ValidationError('expected real number, got %s' %
@@ -293,6 +415,10 @@ class String(Primitive):
                 raise AssertionError('Regex {!r} failed: {}'.format(
                     pattern, e.args[0]))
 
+    def validate_returns_input(self):
+        # In PY2, str values are decoded to unicode.
+        return six.PY3
+
     def validate(self, val):
         """
         A unicode string of the correct length and pattern will pass validation.
@@ -300,24 +426,29 @@ class String(Primitive):
         string will be returned.
         """
         if not isinstance(val, six.string_types):
-            raise ValidationError("'%s' expected to be a string, got %s"
-                                  % (val, generic_type_name(val)))
+            raise ValidationError("'{value}' expected to be a string, got {}",
+                                  validator=self, value=val,
+                                  message_args=(generic_type_name(val),))
         if not six.PY3 and isinstance(val, str):
             try:
                 val = val.decode('utf-8')
             except UnicodeDecodeError:
-                raise ValidationError("'%s' was not valid utf-8")
+                raise ValidationError("{value!r} was not valid utf-8",
+                                      validator=self, value=val)
 
         if self.max_length is not None and len(val) > self.max_length:
-            raise ValidationError("'%s' must be at most %d characters, got %d"
-                                  % (val, self.max_length, len(val)))
+            raise ValidationError("'{value}' must be at most {} characters, got {}",
+                                  validator=self, value=val,
+                                  message_args=(self.max_length, len(val)))
         if self.min_length is not None and len(val) < self.min_length:
-            raise ValidationError("'%s' must be at least %d characters, got %d"
-                                  % (val, self.min_length, len(val)))
+            raise ValidationError("'{value}' must be at least {} characters, got {}",
+                                  validator=self, value=val,
+                                  message_args=(self.min_length, len(val)))
 
         if self.pattern and not self.pattern_re.match(val):
-            raise ValidationError("'%s' did not match pattern '%s'"
-                                  % (val, self.pattern))
+            raise ValidationError("'{value}' did not match pattern '{}'",
+                                  validator=self, value=val,
+                                  message_args=(self.pattern,))
         return val
 
 
@@ -343,11 +474,13 @@ class Bytes(Primitive):
             raise ValidationError("expected bytes type, got %s"
                                   % generic_type_name(val))
         elif self.max_length is not None and len(val) > self.max_length:
-            raise ValidationError("'%s' must have at most %d bytes, got %d"
-                                  % (val, self.max_length, len(val)))
+            raise ValidationError("'{value}' must have at most {} bytes, got {}",
+                                  validator=self, value=val,
+                                  message_args=(self.max_length, len(val)))
         elif self.min_length is not None and len(val) < self.min_length:
-            raise ValidationError("'%s' has fewer than %d bytes, got %d"
-                                  % (val, self.min_length, len(val)))
+            raise ValidationError("'{value}' has fewer than {} bytes, got {}",
+                                  validator=self, value=val,
+                                  message_args=(self.min_length, len(val)))
         return val
 
 
@@ -399,17 +532,33 @@ class List(Composite):
 
         self.min_items = min_items
         self.max_items = max_items
+        self._validate_items_in_place = item_validator.validate_returns_input()
 
     def validate(self, val):
+        self.validate_type_only(val)
+        if self._validate_items_in_place:
+            validate_item = self.item_validator.validate
+            for item in val:
+                validate_item(item)
+            return val if isinstance(val, list) else list(val)
+        return [self.item_validator.validate(item) for item in val]
+
+    def validate_type_only(self, val):
+        """
+        Use this when you only want to validate that val is a list of an
+        acceptable length, but not yet validate each item.
+        """
         if not isinstance(val, (tuple, list)):
-            raise ValidationError('%r is not a valid list' % val)
+            raise ValidationError('{value!r} is not a valid list',
+                                  validator=self, value=val)
         elif self.max_items is not None and len(val) > self.max_items:
-            raise ValidationError('%r has more than %s items'
-                                  % (val, self.max_items))
+            raise ValidationError('{value!r} has more than {} items',
+                                  validator=self, value=val,
+                                  message_args=(self.max_items,))
         elif self.min_items is not None and len(val) < self.min_items:
-            raise ValidationError('%r has fewer than %s items'
-                                  % (val, self.min_items))
-        return [self.item_validator.validate(item) for item in val]
+            raise ValidationError('{value!r} has fewer than {} items',
+                                  validator=self, value=val,
+                                  message_args=(self.min_items,))
 
 
 class Map(Composite):
@@ -422,15 +571,35 @@ class Map(Composite):
         """
         self.key_validator = key_validator
         self.value_validator = value_validator
+        self._validate_items_in_place = (key_validator.validate_returns_input() and
+                                         value_validator.validate_returns_input())
+
+    def validate_returns_input(self):
+        return self._validate_items_in_place
 
     def validate(self, val):
-        if not isinstance(val, dict):
-            raise ValidationError('%r is not a valid dict' % val)
+        self.validate_type_only(val)
+        if self._validate_items_in_place:
+            validate_key = self.key_validator.validate
+            validate_value = self.value_validator.validate
+            for key, value in val.items():
+                validate_key(key)
+                validate_value(value)
+            return val
         return {
             self.key_validator.validate(key):
                 self.value_validator.validate(value) for key, value in val.items()
         }
 
+    def validate_type_only(self, val):
+        """
+        Use this when you only want to validate that val is a dict, but not
+        yet validate each key and value.
+        """
+        if not isinstance(val, dict):
+            raise ValidationError('{value!r} is not a valid dict',
+                                  validator=self, value=val)
+
 
 class Struct(Composite):
 
@@ -450,6 +619,9 @@ class Struct(Composite):
         super(Struct, self).__init__()
         self.definition = definition
 
+    def validate_returns_input(self):
+        return True
+
     def validate(self, val):
         """
         For a val to pass validation, val must be of the correct type and have
@@ -551,6 +723,9 @@ class Union(Composite):
         """
         self.definition = definition
 
+    def validate_returns_input(self):
+        return True
+
     def validate(self, val):
         """
         For a val to pass validation, it must have a _tag set. This assumes
@@ -602,6 +777,9 @@ class Nullable(Validator):
             'void cannot be made nullable'
         self.validator = validator
 
+    def validate_returns_input(self):
+        return self.validator.validate_returns_input()
+
     def validate(self, val):
         if val is None:
             return
@@ -622,31 +800,90 @@ class Nullable(Validator):
         return None
 
 class Redactor(object):
-    def __init__(self, regex):
+    def __init__(self, regex, cache_size=0):
         """
         Args:
             regex: What parts of the field to redact.
+            cache_size (int): If positive, up to this many of the most
+                recently redacted values are remembered along with their
+                redacted versions, so that values that recur, such as
+                identifiers, are only redacted once.
         """
         self.regex = regex
+        self._pattern = re.compile(regex) if regex else None
+        self._cache_size = cache_size
+        self._cache = (collections.OrderedDict()
+                       if cache_size > 0 else None)  # type: typing.Optional[typing.MutableMapping[typing.Any, typing.Any]] # noqa: E501
+        self._cache_lock = threading.Lock()
 
-    @abstractmethod
     def apply(self, val):
         """Redacts information from annotated field.
         Returns: A redacted version of the string provided.
         """
+        cache = self._cache
+        if cache is None:
+            return self.redact(val)
+        # Values of different types can be equal but redact differently,
+        # like 1 and True.
+        key = (type(val), val)
+        with self._cache_lock:
+            try:
+                redacted = cache.pop(key)
+            except KeyError:
+                pass
+            except TypeError:
+                # Unhashable
+                return self.redact(val)
+            else:
+                cache[key] = redacted
+                return redacted
+        redacted = self.redact(val)
+        with self._cache_lock:
+            cache[key] = redacted
+            if len(cache) > self._cache_size:
+                cache.popitem(last=False)
+        return redacted
+
+    def apply_many(self, vals):
+        """Redacts each item of a list, or each value of a dict.
+        Returns: A list, or a dict with the same keys, of redacted values.
+        Values that occur more than once are only redacted once.
+        """
+        redacted = {}  # type: typing.Dict[typing.Any, typing.Any]
+        apply = self.apply
+
+        def apply_once(val):
+            key = (type(val), val)
+            try:
+                return redacted[key]
+            except KeyError:
+                ret = redacted[key] = apply(val)
+                return ret
+            except TypeError:
+                return apply(val)
+
+        if isinstance(vals, dict):
+            return {k: apply_once(v) for k, v in vals.items()}
+        return [apply_once(v) for v in vals]
+
+    @abstractmethod
+    def redact(self, val):
+        """Redacts information from annotated field, bypassing the cache.
+        Returns: A redacted version of the string provided.
+        """
         pass
 
     def _get_matches(self, val):
-        if not self.regex:
+        if self._pattern is None:
             return None
         try:
-            return re.search(self.regex, val)
+            return self._pattern.search(val)
         except TypeError:
             return None
 
 
 class HashRedactor(Redactor):
-    def apply(self, val):
+    def redact(self, val):
         matches = self._get_matches(val)
 
         val_to_hash = str(val) if isinstance(val, int) or isinstance(val, float) else val
@@ -654,7 +891,7 @@ class HashRedactor(Redactor):
         try:
             # add string literal to ensure unicode
             hashed = hashlib.md5(val_to_hash.encode('utf-8')).hexdigest() + ''
-        except [AttributeError, ValueError]:
+        except (AttributeError, ValueError):
             hashed = None
 
         if matches:
@@ -666,7 +903,7 @@ class HashRedactor(Redactor):
 
 
 class BlotRedactor(Redactor):
-    def apply(self, val):
+    def redact(self, val):
         matches = self._get_matches(val)
         if matches:
             return '***'.join(matches.groups())
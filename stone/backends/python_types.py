@@ -4,7 +4,9 @@ Backend for generating Python types that match the spec.
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import hashlib
 import itertools
+import json
 import os
 import re
 import shutil
@@ -78,6 +80,28 @@ _cmdline_parser.add_argument(
           '{route} for the route name. This is used to translate Stone doc '
           'references to routes to references in Python docstrings.'),
 )
+_cmdline_parser.add_argument(
+    '--frozen',
+    action='store_true',
+    help=('Generate immutable structs and unions. Struct fields can only be set '
+          'in the constructor, lists and maps are stored as tuples and read-only '
+          'dicts, and instances can be hashed and compared.'),
+)
+_cmdline_parser.add_argument(
+    '--redactor-cache-size',
+    default=0,
+    type=int,
+    help=('Have the redactor of each redacted field and alias remember up to '
+          'this many of the values it redacted most recently, so that values '
+          'that recur are only redacted once. Off by default.'),
+)
+_cmdline_parser.add_argument(
+    '--server',
+    action='store_true',
+    help=('Copy stone_server.py, with a dispatcher that serves the generated '
+          'routes and a WSGI adapter, and stone_asgi.py, with an ASGI adapter '
+          'that requires Python 3.5+, to the output directory.'),
+)
 
 
 class PythonTypesBackend(CodeBackend):
@@ -107,6 +131,10 @@ class PythonTypesBackend(CodeBackend):
         self.logger.info('Copying stone_base.py to output folder')
         shutil.copy(os.path.join(rsrc_folder, 'stone_base.py'),
                     self.target_folder_path)
+        if self.args.server:
+            for rsrc_file in ['stone_server.py', 'stone_asgi.py', 'stone_streams.py']:
+                self.logger.info('Copying %s to output folder', rsrc_file)
+                shutil.copy(os.path.join(rsrc_folder, rsrc_file), self.target_folder_path)
         for namespace in api.namespaces.values():
             reserved_namespace_name = fmt_namespace(namespace.name)
             with self.output_to_relative_path('{}.py'.format(reserved_namespace_name)):
@@ -236,9 +264,9 @@ class PythonTypesBackend(CodeBackend):
         else:
             if is_struct_type(data_type):
                 # Use a handwritten base class
-                extends = 'bb.Struct'
+                extends = 'bb.FrozenStruct' if self.args.frozen else 'bb.Struct'
             elif is_union_type(data_type):
-                extends = 'bb.Union'
+                extends = 'bb.FrozenUnion' if self.args.frozen else 'bb.Union'
             else:
                 extends = 'object'
         return 'class {}({}):'.format(
@@ -351,6 +379,7 @@ class PythonTypesBackend(CodeBackend):
             self._generate_struct_class_init(data_type)
             self._generate_struct_class_properties(ns, data_type)
             self._generate_struct_class_custom_annotations(ns, data_type)
+            self._generate_struct_class_state(data_type)
             self._generate_struct_class_repr(data_type)
         if data_type.has_enumerated_subtypes():
             validator = 'StructTree'
@@ -389,9 +418,10 @@ class PythonTypesBackend(CodeBackend):
 
     def _generate_struct_class_reflection_attributes(self, ns, data_type):
         """
-        Generates two class attributes:
+        Generates three class attributes:
           * _all_field_names_: Set of all field names including inherited fields.
           * _all_fields_: List of tuples, where each tuple is (name, validator).
+          * _fingerprint_: Structural hash of the struct; see data_type_fingerprint().
 
         If a struct has enumerated subtypes, then two additional attributes are
         generated:
@@ -517,6 +547,7 @@ class PythonTypesBackend(CodeBackend):
                 self.generate_multiline_list(
                     items, before=before, delim=('[', ']'), compact=False)
 
+        self.emit('{}._fingerprint_ = {}'.format(class_name, data_type_fingerprint(data_type)))
         self.emit()
 
     def _generate_struct_class_init(self, data_type):
@@ -556,7 +587,11 @@ class PythonTypesBackend(CodeBackend):
                 field_var_name = fmt_var(field.name, True)
                 self.emit('if {} is not None:'.format(field_var_name))
                 with self.indent():
-                    self.emit('self.{0} = {0}'.format(field_var_name))
+                    if self.args.frozen:
+                        self.emit("self._set_field_('{}', {})".format(
+                            fmt_var(field.name), field_var_name))
+                    else:
+                        self.emit('self.{0} = {0}'.format(field_var_name))
 
             if lineno == self.lineno:
                 self.emit('pass')
@@ -575,7 +610,8 @@ class PythonTypesBackend(CodeBackend):
     def _generate_struct_class_properties(self, ns, data_type):
         """
         Each field of the struct has a corresponding setter and getter.
-        The setter validates the value being set.
+        The setter validates the value being set. Frozen structs only have
+        getters.
         """
         for field in data_type.fields:
             field_name = fmt_func(field.name)
@@ -604,7 +640,10 @@ class PythonTypesBackend(CodeBackend):
                 self.emit('if self._{}_present:'.format(field_name))
                 with self.indent():
                     self.emit('return self._{}_value'.format(field_name))
-
+                self.emit('elif self._{}_value is bb.NOT_LOADED:'.format(field_name))
+                with self.indent():
+                    self.emit(
+                        "raise bb.NotLoadedError(\"field '%s' was not loaded\")" % field_name)
                 self.emit('else:')
                 with self.indent():
                     if dt_nullable:
@@ -619,6 +658,9 @@ class PythonTypesBackend(CodeBackend):
                         )
             self.emit()
 
+            if self.args.frozen:
+                continue
+
             # generate setter for field
             self.emit('@{}.setter'.format(field_name_reserved_check))
             self.emit('def {}(self, val):'.format(field_name_reserved_check))
@@ -735,8 +777,12 @@ class PythonTypesBackend(CodeBackend):
                     annotation_class = class_name_for_annotation_type(annotation_type, ns)
                     self.emit('if annotation_type is {}:'.format(annotation_class))
                     with self.indent():
-                        self.emit('self.{} = {}'.format(
-                            field_name,
+                        if self.args.frozen:
+                            assign = "self._set_field_('{}', {})".format(
+                                fmt_var(field.name), '{}')
+                        else:
+                            assign = 'self.{} = {{}}'.format(field_name)
+                        self.emit(assign.format(
                             generate_func_call(
                                 processor,
                                 args=[
@@ -746,6 +792,34 @@ class PythonTypesBackend(CodeBackend):
                         ))
                     self.emit()
 
+    def _generate_struct_class_state(self, data_type):
+        """
+        Generates __getstate__ and __setstate__, which move the values of all
+        slots, including those of parent classes, to and from a tuple. The
+        base class uses them to pickle and copy structs.
+        """
+        slots = []
+        for field in data_type.all_fields:
+            field_name = fmt_var(field.name)
+            slots.append('self._{}_value'.format(field_name))
+            slots.append('self._{}_present'.format(field_name))
+
+        self.emit('def __getstate__(self):')
+        with self.indent():
+            if slots:
+                self.generate_multiline_list(slots, before='return ')
+            else:
+                self.emit('return ()')
+        self.emit()
+
+        self.emit('def __setstate__(self, state):')
+        with self.indent():
+            if slots:
+                self.generate_multiline_list(slots, after=' = state')
+            else:
+                self.emit('pass')
+        self.emit()
+
     def _generate_struct_class_repr(self, data_type):
         """
         Generates something like:
@@ -904,7 +978,8 @@ class PythonTypesBackend(CodeBackend):
     def _generate_union_class_reflection_attributes(self, ns, data_type):
         """
         Adds a class attribute for each union member assigned to a validator.
-        Also adds an attribute that is a map from tag names to validators.
+        Also adds an attribute that is a map from tag names to validators, and
+        the union's structural hash as _fingerprint_.
         """
         class_name = fmt_class(data_type.name)
 
@@ -946,6 +1021,7 @@ class PythonTypesBackend(CodeBackend):
                     class_name_for_data_type(data_type.parent_type, ns))
                 )
 
+        self.emit('{}._fingerprint_ = {}'.format(class_name, data_type_fingerprint(data_type)))
         self.emit()
 
     def _generate_union_class_variant_creators(self, ns, data_type):
@@ -1025,6 +1101,11 @@ class PythonTypesBackend(CodeBackend):
                         self.emit(
                             'raise AttributeError("tag \'{}\' not set")'.format(
                                 field_name))
+                    self.emit('if self._value is bb.NOT_LOADED:')
+                    with self.indent():
+                        self.emit(
+                            'raise bb.NotLoadedError("value of tag \'{}\' was not loaded")'.format(
+                                field_name))
                     self.emit('return self._value')
                 self.emit()
 
@@ -1118,6 +1199,7 @@ class PythonTypesBackend(CodeBackend):
                     attrs.append("'{}': {!r}".format(attr_key, route.attrs.get(attr_key)))
                 self.generate_multiline_list(
                     attrs, delim=('{', '}'), after=',', compact=True)
+                self.emit('{},'.format(route_fingerprint(namespace, route)))
 
         if namespace.routes:
             self.emit()
@@ -1128,8 +1210,16 @@ class PythonTypesBackend(CodeBackend):
                     route.name_with_version(), fmt_func(route.name, version=route.version)))
         self.emit()
 
+        self.emit('FINGERPRINT = {}'.format(namespace_fingerprint(namespace)))
+        self.emit()
+
     def _generate_redactor(self, validator_name, redactor):
         regex = "'{}'".format(redactor.regex) if redactor.regex else 'None'
+        if self.args.redactor_cache_size < 0:
+            raise RuntimeError('--redactor-cache-size must not be negative, got {}.'.format(
+                self.args.redactor_cache_size))
+        if self.args.redactor_cache_size:
+            regex += ', cache_size={}'.format(self.args.redactor_cache_size)
         if isinstance(redactor, RedactedHash):
             self.emit("{}._redact = bv.HashRedactor({})".format(validator_name, regex))
         elif isinstance(redactor, RedactedBlot):
@@ -1223,3 +1313,121 @@ def generate_func_call(name, args=None, kwargs=None):
         all_args.extend('{}={}'.format(k, v)
                         for k, v in kwargs if v is not None)
     return '{}({})'.format(name, ', '.join(all_args))
+
+
+def _schema_description(data_type, seen):
+    """
+    Returns a description of the structure of a Stone data type: the names
+    and types of its fields, its tags, nullability, subtypes and constraints
+    such as max_length. User-defined types in ``seen`` are described by name
+    only, which ends the recursion for recursive types.
+    """
+    dt, nullable, _ = unwrap(data_type)
+    if is_list_type(dt):
+        description = 'List({}{})'.format(
+            _schema_description(dt.data_type, seen),
+            ''.join(',' + c for c in _constraint_descriptions(dt, 'min_items', 'max_items')))
+    elif is_map_type(dt):
+        description = 'Map({},{})'.format(_schema_description(dt.key_data_type, seen),
+                                          _schema_description(dt.value_data_type, seen))
+    elif is_timestamp_type(dt):
+        description = 'Timestamp({})'.format(dt.format)
+    elif is_user_defined_type(dt):
+        description = '{}.{}'.format(dt.namespace.name, dt.name)
+        if dt not in seen:
+            seen.add(dt)
+            fields = ','.join(
+                '{}:{}'.format(field.name, _schema_description(field.data_type, seen))
+                for field in _fields_in_declaration_order(dt))
+            if is_struct_type(dt):
+                description = 'struct {}{{{}}}'.format(description, fields)
+                if dt.has_enumerated_subtypes():
+                    description += '{}[{}]'.format(
+                        '*' if dt.is_catch_all() else '',
+                        ','.join('{}:{}'.format('.'.join(tags),
+                                                _schema_description(subtype, seen))
+                                 for tags, subtype in dt.get_all_subtypes_with_tags()))
+            else:
+                description = 'union {}{}{{{}}}'.format(
+                    description, '*' if dt.catch_all_field else '', fields)
+    elif is_numeric_type(dt) or is_string_type(dt):
+        if is_string_type(dt):
+            constraints = _constraint_descriptions(dt, 'min_length', 'max_length', 'pattern')
+        else:
+            constraints = _constraint_descriptions(dt, 'min_value', 'max_value')
+        description = dt.name
+        if constraints:
+            description += '({})'.format(','.join(constraints))
+    else:
+        description = dt.name
+    if nullable:
+        description += '?'
+    return description
+
+
+def _constraint_descriptions(data_type, *names):
+    # Values are JSON encoded, which is the same on Python 2 and 3.
+    return ['{}={}'.format(name, json.dumps(getattr(data_type, name)))
+            for name in names if getattr(data_type, name) is not None]
+
+
+def _fields_in_declaration_order(data_type):
+    fields = []
+    if data_type.parent_type:
+        fields.extend(_fields_in_declaration_order(data_type.parent_type))
+    fields.extend(data_type.fields)
+    return fields
+
+
+def _route_description(namespace, route, seen):
+    attrs = []
+    for key in sorted(route.attrs):
+        value = route.attrs[key]
+        if is_tag_ref(value):
+            value = '{}.{}'.format(value.union_data_type.name, value.tag_name)
+        attrs.append('{}:{}'.format(key, value))
+    return 'route {}/{}({};{};{}){{{}}}'.format(
+        namespace.name,
+        route.name_with_version(),
+        _schema_description(route.arg_data_type, seen),
+        _schema_description(route.result_data_type, seen),
+        _schema_description(route.error_data_type, seen),
+        ','.join(attrs))
+
+
+def _fingerprint(description):
+    digest = hashlib.sha256(description.encode('utf-8')).hexdigest()
+    return '0x' + digest[:16]
+
+
+def data_type_fingerprint(data_type):
+    """
+    Returns a stable structural hash of a Stone data type, as a 64-bit
+    hexadecimal Python literal. It changes whenever the data type or any type
+    it refers to changes structurally.
+    """
+    return _fingerprint(_schema_description(data_type, set()))
+
+
+def route_fingerprint(namespace, route):
+    """
+    Like :func:`data_type_fingerprint`, but covers the name, version and
+    attributes of a route along with its argument, result and error types.
+    """
+    return _fingerprint(_route_description(namespace, route, set()))
+
+
+def namespace_fingerprint(namespace):
+    """
+    Like :func:`data_type_fingerprint`, but covers every data type, alias and
+    route of a namespace.
+    """
+    descriptions = []
+    for data_type in sorted(namespace.data_types, key=lambda dt: dt.name):
+        descriptions.append(_schema_description(data_type, set()))
+    for alias in sorted(namespace.aliases, key=lambda alias: alias.name):
+        descriptions.append('alias {}={}'.format(
+            alias.name, _schema_description(alias.data_type, set())))
+    for route in sorted(namespace.routes, key=lambda route: route.name_with_version()):
+        descriptions.append(_route_description(namespace, route, set()))
+    return _fingerprint('\n'.join(descriptions))
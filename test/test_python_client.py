@@ -1,6 +1,10 @@
+import os
+import shutil
+import tempfile
 import textwrap
 
 from stone.backends.python_client import PythonClientBackend
+from stone.frontend.frontend import specs_to_ir
 from stone.ir import ApiNamespace, ApiRoute, Void, Int32
 
 MYPY = False
@@ -13,12 +17,12 @@ class TestGeneratedPythonClient(unittest.TestCase):
     def __init__(self, *args, **kwargs):
         super(TestGeneratedPythonClient, self).__init__(*args, **kwargs)
 
-    def _evaluate_namespace(self, ns):
-        # type: (ApiNamespace) -> typing.Text
+    def _evaluate_namespace(self, ns, extra_args=()):
+        # type: (ApiNamespace, typing.Sequence[str]) -> typing.Text
 
         backend = PythonClientBackend(
             target_folder_path='output',
-            args=['-m', 'files', '-c', 'DropboxBase', '-t', 'dropbox'])
+            args=['-m', 'files', '-c', 'DropboxBase', '-t', 'dropbox'] + list(extra_args))
         backend._generate_routes(ns)
         return backend.output_buffer_to_string()
 
@@ -179,6 +183,283 @@ class TestGeneratedPythonClient(unittest.TestCase):
 
         self.assertEqual(result, expected)
 
+    def test_asyncio_routes(self):
+        # type: () -> None
+
+        route1 = ApiRoute('get_metadata', 1, None)
+        route1.set_attributes(None, None, Void(), Int32(), Void(), {})
+        route2 = ApiRoute('download', 1, None)
+        route2.set_attributes(None, None, Void(), Void(), Void(), {'style': 'download'})
+        ns = ApiNamespace('files')
+        ns.add_route(route1)
+        ns.add_route(route2)
+
+        result = self._evaluate_namespace(ns, ['--asyncio'])
+
+        expected = textwrap.dedent('''\
+            async def files_get_metadata(self):
+                arg = None
+                r = await self.request_async(
+                    files.get_metadata,
+                    'files',
+                    arg,
+                    None,
+                )
+                return r
+
+            async def files_download(self):
+                arg = None
+                r = await self.request_async(
+                    files.download,
+                    'files',
+                    arg,
+                    None,
+                )
+                return None
+
+            async def files_download_to_file(self,
+                                             download_path):
+                arg = None
+                r = await self.request_async(
+                    files.download,
+                    'files',
+                    arg,
+                    None,
+                )
+                await self._save_body_to_file_async(download_path, r[1])
+                return None
+
+        ''')
+
+        self.assertEqual(result, expected)
+
+    def test_generated_files(self):
+        # type: () -> None
+
+        stone_cfg = textwrap.dedent("""\
+            namespace stone_cfg
+
+            struct Route
+                style String = "rpc"
+            """)
+        rpc_spec = textwrap.dedent("""\
+            namespace files
+
+            route get_name(Void, String, Void)
+            """)
+        download_spec = rpc_spec + textwrap.dedent("""\
+
+            route download(Void, Void, Void)
+                attrs
+                    style = "download"
+            """)
+
+        for spec, extra_args, rsrc_files, save_method in [
+                (rpc_spec, [], [], None),
+                (download_spec, [], ['stone_streams.py'], 'def _save_body_to_file('),
+                (rpc_spec, ['--asyncio'], ['stone_async.py', 'stone_cache.py', 'stone_streams.py'],
+                 None),
+                (download_spec, ['--asyncio'],
+                 ['stone_async.py', 'stone_cache.py', 'stone_streams.py'],
+                 'async def _save_body_to_file_async(')]:
+            api = specs_to_ir([('stone_cfg.stone', stone_cfg), ('files.stone', spec)])
+            target_folder_path = tempfile.mkdtemp()
+            try:
+                backend = PythonClientBackend(
+                    target_folder_path=target_folder_path,
+                    args=['-m', 'files_client', '-c', 'DropboxBase', '-t', 'dropbox'] + extra_args)
+                backend.generate(api)
+                self.assertEqual(['files_client.py'] + rsrc_files,
+                                 sorted(os.listdir(target_folder_path)))
+                with open(os.path.join(target_folder_path, 'files_client.py')) as f:
+                    generated = f.read()
+            finally:
+                shutil.rmtree(target_folder_path)
+            self.assertEqual(save_method is not None, '_save_body_to_file' in generated)
+            if save_method is not None:
+                self.assertIn(save_method, generated)
+                self.assertIn('stone_async,' if extra_args else 'stone_streams,', generated)
+
+    def test_batch_routes(self):
+        # type: () -> None
+
+        stone_cfg = textwrap.dedent("""\
+            namespace stone_cfg
+
+            struct Route
+                batch String?
+            """)
+        spec = textwrap.dedent("""\
+            namespace files
+
+            struct Arg
+                path String
+
+            struct Metadata
+                name String
+
+            union LookupError
+                not_found
+
+            union BatchEntry
+                success Metadata
+                failure LookupError
+
+            struct BatchArg
+                entries List(Arg)
+
+            struct BatchResult
+                entries List(BatchEntry)
+
+            route lookup(Arg, Metadata, LookupError)
+                attrs
+                    batch = "lookup_batch"
+
+            route lookup_batch(BatchArg, BatchResult, Void)
+
+            route get_name(Arg, Metadata, Void)
+                attrs
+                    batch = "get_name_batch:2"
+
+            route get_name_batch:2(BatchArg, List(Metadata), Void)
+
+            route bad(Arg, Metadata, Void)
+                attrs
+                    batch = "get_name_batch:2"
+            """)
+        api = specs_to_ir([('stone_cfg.stone', stone_cfg), ('files.stone', spec)])
+        ns = api.namespaces['files']
+        backend = PythonClientBackend(
+            target_folder_path='output',
+            args=['-m', 'files', '-c', 'DropboxBase', '-t', 'dropbox', '--asyncio'])
+
+        ns.routes.remove(ns.route_by_name['bad'])
+        backend._generate_batch_routes([ns])
+        expected = textwrap.dedent('''\
+            # Routes with a batch counterpart, mapped to (batch route, argument
+            # field, result field, result tag, error tag).
+            _batch_routes_ = {
+                files.get_name: (files.get_name_batch_v2, 'entries', None, None, None),
+                files.lookup: (files.lookup_batch, 'entries', 'entries', 'success', 'failure'),
+            }
+
+        ''')
+        self.assertEqual(expected, backend.output_buffer_to_string())
+
+        # The batch route of "bad" returns Metadata rather than its result
+        ns.routes.append(ns.route_by_name['bad'])
+        ns.route_by_name['bad'].result_data_type = Int32()
+        with self.assertRaises(RuntimeError) as cm:
+            backend._generate_batch_routes([ns])
+        self.assertIn('its result entries must be results', str(cm.exception))
+
+        ns.route_by_name['bad'].attrs['batch'] = 'get_name_batch'
+        with self.assertRaises(RuntimeError) as cm:
+            backend._generate_batch_routes([ns])
+        self.assertIn('is not a route in the files namespace', str(cm.exception))
+
+    def test_cached_routes(self):
+        # type: () -> None
+
+        stone_cfg = textwrap.dedent("""\
+            namespace stone_cfg
+
+            struct Route
+                style String = "rpc"
+                cache_ttl Float64?
+            """)
+        spec = textwrap.dedent("""\
+            namespace files
+
+            struct Arg
+                path String
+
+            route get_name(Arg, String, Void)
+                attrs
+                    cache_ttl = 30
+
+            route put(Arg, Void, Void)
+                attrs
+                    style = "upload"
+            """)
+        api = specs_to_ir([('stone_cfg.stone', stone_cfg), ('files.stone', spec)])
+        ns = api.namespaces['files']
+
+        for extra_args, cache, call, request in [
+                ([], 'stone_cache.RouteCache', 'self.route_cache.call', 'self.request'),
+                (['--asyncio'], 'stone_async.AsyncRouteCache',
+                 'await self.route_cache.call_async', 'self.request_async')]:
+            backend = PythonClientBackend(
+                target_folder_path='output',
+                args=['-m', 'files', '-c', 'DropboxBase', '-t', 'dropbox', '--cache-size',
+                      '100'] + extra_args)
+            backend._cache_ttls = backend._get_cache_ttls([ns])
+            self.assertEqual({ns.route_by_name['get_name']: 30}, backend._cache_ttls)
+            backend._generate_route_cache()
+            backend._generate_route_helper(ns, ns.route_by_name['get_name'])
+            expected = textwrap.dedent('''\
+                @property
+                def route_cache(self):
+                    """
+                    The in-process cache of the results of routes with a cache_ttl attribute,
+                    with hit and miss counters per route. It is created on first use; assign
+                    _route_cache to share one between clients.
+                    """
+                    cache = self.__dict__.get('_route_cache')
+                    if cache is None:
+                        cache = self.__dict__.setdefault(
+                            '_route_cache', {cache}(max_size=100))
+                    return cache
+
+                {async_}def files_get_name(self,
+                                   {async_pad}path):
+                    """
+                    :type path: str
+                    :rtype: str
+                    """
+                    arg = files.Arg(path)
+                    r = {call}(
+                        files.get_name,
+                        'files',
+                        arg,
+                        30,
+                        {request},
+                    )
+                    return r
+
+            ''').format(cache=cache, call=call, request=request,
+                        async_='async ' if extra_args else '',
+                        async_pad='      ' if extra_args else '')
+            self.assertEqual(expected, backend.output_buffer_to_string())
+
+        # The cache_ttl attribute is ignored without --cache-size
+        backend = PythonClientBackend(
+            target_folder_path='output',
+            args=['-m', 'files', '-c', 'DropboxBase', '-t', 'dropbox'])
+        self.assertEqual({}, backend._get_cache_ttls([ns]))
+
+        backend = PythonClientBackend(
+            target_folder_path='output',
+            args=['-m', 'files', '-c', 'DropboxBase', '-t', 'dropbox', '--cache-size', '100'])
+        ns.route_by_name['get_name'].attrs['cache_ttl'] = 0
+        with self.assertRaises(RuntimeError) as cm:
+            backend._get_cache_ttls([ns])
+        self.assertIn('must be a positive number of seconds', str(cm.exception))
+
+        ns.route_by_name['get_name'].attrs['cache_ttl'] = 30
+        ns.route_by_name['put'].attrs['cache_ttl'] = 30
+        with self.assertRaises(RuntimeError) as cm:
+            backend._get_cache_ttls([ns])
+        self.assertIn('only RPC-style routes can have a cache_ttl', str(cm.exception))
+
+        # A style that's declared without a default is None when it isn't set
+        api = specs_to_ir([
+            ('stone_cfg.stone', stone_cfg.replace('style String = "rpc"', 'style String?')),
+            ('files.stone', spec)])
+        ns = api.namespaces['files']
+        self.assertIsNone(ns.route_by_name['get_name'].attrs['style'])
+        self.assertEqual({ns.route_by_name['get_name']: 30}, backend._get_cache_ttls([ns]))
+
     def test_route_with_version_number_name_conflict(self):
         # type: () -> None
 
@@ -3,20 +3,51 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import base64
+import collections
+import copy
 import datetime
+import gc
+import hashlib
+import importlib
+import io
 import json
+import os
+import pickle
 import shutil
 import six
+import socket
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
+import weakref
 
+from six.moves import BaseHTTPServer, socketserver
+from wsgiref import simple_server
+import wsgiref.util
+
+try:
+    import asyncio
+    HAS_ASYNCIO = True
+except ImportError:
+    HAS_ASYNCIO = False
+
+import stone.backends.python_rsrc.stone_base as bb
+import stone.backends.python_rsrc.stone_cache as stone_cache
+import stone.backends.python_rsrc.stone_streams as stone_streams
 import stone.backends.python_rsrc.stone_validators as bv
 
 from stone.backends.python_rsrc.stone_serializers import (
     CallerPermissionsInterface,
     json_encode,
     json_decode,
+    msgpack_encode,
+    msgpack_decode,
+    _msgpack_pack,
+    _msgpack_unpack,
     _strftime as stone_strftime,
 )
 
@@ -165,6 +196,27 @@ class TestDropInModules(unittest.TestCase):
         # Passes
         l1.validate(['a'])
 
+    def test_list_validator_in_place(self):
+        # Lists of values that validation doesn't change aren't copied
+        items = [1, 2, 3]
+        self.assertIs(bv.List(bv.Int64()).validate(items), items)
+        self.assertEqual(bv.List(bv.Int64()).validate((1, 2)), [1, 2])
+        nested = [[1], [2]]
+        self.assertIsNot(bv.List(bv.List(bv.Int64())).validate(nested), nested)
+        self.assertIs(bv.List(bv.List(bv.Int64())).validate(nested)[0], nested[0])
+        # Floats are normalized, so a copy is made
+        floats = [1, 2.5]
+        self.assertEqual(bv.List(bv.Float64()).validate(floats), [1.0, 2.5])
+        self.assertEqual(type(bv.List(bv.Float64()).validate(floats)[0]), float)
+        self.assertRaises(bv.ValidationError,
+                          lambda: bv.List(bv.Int64()).validate([1, 'a']))
+
+        d = {'a': 1}
+        self.assertIs(bv.Map(bv.String(), bv.Int64()).validate(d), d)
+        self.assertEqual(bv.Map(bv.String(), bv.Float64()).validate(d), {'a': 1.0})
+        self.assertRaises(bv.ValidationError,
+                          lambda: bv.Map(bv.String(), bv.Int64()).validate({'a': 'b'}))
+
     def test_map_validator(self):
         m = bv.Map(bv.String(pattern="^foo.*"), bv.String(pattern=".*bar$"))
 
@@ -206,6 +258,90 @@ class TestDropInModules(unittest.TestCase):
         s = bv.Struct(C)
         self.assertRaises(bv.ValidationError, lambda: s.validate(object()))
 
+    def test_redactors(self):
+        h = bv.HashRedactor(None)
+        self.assertEqual('202cb962ac59075b964b07152d234b70', h.apply('123'))
+        self.assertEqual('202cb962ac59075b964b07152d234b70', h.apply(123))
+        # Values that can't be hashed are dropped
+        self.assertIsNone(h.apply(None))
+        self.assertIsNone(h.apply(datetime.datetime(2015, 5, 12)))
+
+        b = bv.BlotRedactor('^(.).*(.)$')
+        self.assertEqual('a***z', b.apply('abcz'))
+        self.assertEqual('********', b.apply(b'abcz' if six.PY3 else 1))
+
+        class CountingRedactor(bv.BlotRedactor):
+            calls = 0
+
+            def redact(self, val):
+                self.calls += 1
+                return super(CountingRedactor, self).redact(val)
+
+        r = CountingRedactor('(a)b', cache_size=2)
+        self.assertEqual(['a', 'a', '********', '********', '********'],
+                         r.apply_many(['ab', 'ab', 1, True, [1]]))
+        # [1] isn't hashable, and 1 and True are cached separately
+        self.assertEqual(4, r.calls)
+        self.assertEqual({'x': 'a', 'y': 'a'}, r.apply_many({'x': 'ab', 'y': 'ab'}))
+        self.assertEqual(5, r.calls)
+        r.apply(True)
+        self.assertEqual(5, r.calls)
+        # Evicts 'ab', the least recently used
+        r.apply(1)
+        r.apply('ab')
+        self.assertEqual(7, r.calls)
+
+        # Without a cache, apply_many() still only redacts distinct values once
+        r = CountingRedactor(None)
+        r.apply_many(['a', 'a', 'b'])
+        r.apply('a')
+        self.assertEqual(3, r.calls)
+
+    def test_validation_error_message(self):
+        l1 = bv.List(bv.Int32(), max_items=3)
+        with self.assertRaises(bv.ValidationError) as cm:
+            l1.validate([1, 2, 3, 4])
+        self.assertEqual('[1, 2, 3, 4] has more than 3 items', str(cm.exception))
+        self.assertIs(l1, cm.exception.validator)
+
+        # Large values are truncated in the message
+        with self.assertRaises(bv.ValidationError) as cm:
+            l1.validate(list(range(100000)))
+        self.assertLess(len(str(cm.exception)), 200)
+        self.assertTrue(cm.exception.value_preview.startswith('[0, 1, 2'))
+        with self.assertRaises(bv.ValidationError) as cm:
+            bv.String(max_length=5).validate('a' * 100000)
+        self.assertLess(len(str(cm.exception)), 200)
+        self.assertIn('must be at most 5 characters, got 100000', str(cm.exception))
+        with self.assertRaises(bv.ValidationError) as cm:
+            bv.Int64().validate(10 ** 10000)
+        self.assertLess(len(str(cm.exception)), 200)
+        with self.assertRaises(bv.ValidationError) as cm:
+            bv.List(bv.Bytes()).validate(bytearray(100000))
+        self.assertLess(len(cm.exception.value_preview), 200)
+
+        # Errors keep a preview of the value, not the value
+        class Body(object):
+            def __repr__(self):
+                return '<Body>'
+
+        body = Body()
+        ref = weakref.ref(body)
+        with self.assertRaises(bv.ValidationError) as cm:
+            l1.validate(body)
+        del body
+        gc.collect()
+        self.assertIsNone(ref())
+        self.assertEqual('<Body> is not a valid list', str(cm.exception))
+        self.assertEqual('<Body>', cm.exception.value_preview)
+
+        # Plain messages aren't treated as templates
+        e = bv.ValidationError('{not a template}', parent='f')
+        e.add_parent('s')
+        self.assertEqual('s.f: {not a template}', str(e))
+        self.assertEqual(['s', 'f'], e.path)
+        self.assertIsNone(e.value_preview)
+
     def test_json_encoder(self):
         self.assertEqual(json_encode(bv.Void(), None), json.dumps(None))
         self.assertEqual(json_encode(bv.String(), 'abc'), json.dumps('abc'))
@@ -215,6 +351,13 @@ class TestDropInModules(unittest.TestCase):
         # encoded as a true/false in JSON when an integer is the data type.
         self.assertEqual(json_encode(bv.UInt32(), True), json.dumps(1))
         self.assertEqual(json_encode(bv.Boolean(), True), json.dumps(True))
+        self.assertEqual(json_encode(bv.List(bv.Float64()), [1, 2]), json.dumps([1.0, 2.0]))
+        self.assertEqual(json_encode(bv.Map(bv.String(), bv.Float64()), {'a': 1}),
+                         json.dumps({'a': 1.0}))
+        self.assertRaises(bv.ValidationError,
+                          lambda: json_encode(bv.List(bv.String()), ['a', 1]))
+        self.assertRaises(bv.ValidationError,
+                          lambda: json_encode(bv.Map(bv.String(), bv.String()), {'a': 1}))
         f = '%a, %d %b %Y %H:%M:%S +0000'
         now = datetime.datetime.utcnow()
         self.assertEqual(json_encode(bv.Timestamp('%a, %d %b %Y %H:%M:%S +0000'), now),
@@ -430,6 +573,199 @@ class TestDropInModules(unittest.TestCase):
         self.assertRaises(bv.ValidationError,
                           lambda: json_decode(bv.Void(), json.dumps(12345), strict=True))
 
+    def test_json_iso_8601_timestamp(self):
+        f = '%Y-%m-%dT%H:%M:%SZ'
+        t = bv.Timestamp(f)
+        for dt in [datetime.datetime(2015, 5, 12, 15, 50, 38),
+                   datetime.datetime(1901, 1, 1),
+                   datetime.datetime(9999, 12, 31, 23, 59, 59)]:
+            s = json_encode(t, dt)
+            self.assertEqual(s, json.dumps(dt.strftime(f)))
+            self.assertEqual(json_decode(t, s), dt)
+        # Microseconds are dropped, as with strftime
+        self.assertEqual(json_encode(t, datetime.datetime(2015, 5, 12, 15, 50, 38, 1)),
+                         json.dumps('2015-05-12T15:50:38Z'))
+        # Non-canonical forms that strptime accepts are still accepted
+        self.assertEqual(json_decode(t, json.dumps('2015-5-2T1:2:3Z')),
+                         datetime.datetime(2015, 5, 2, 1, 2, 3))
+        for bad in ['2015-13-12T15:50:38Z', '2015-05-12T15:50:38', '2015-05-12', 1]:
+            self.assertRaises(bv.ValidationError, json_decode, t, json.dumps(bad))
+
+    def test_msgpack_codec(self):
+        # Covers every width of every type
+        values = [
+            None, True, False, 0, 127, 128, 255, 256, 65535, 65536, 2 ** 32 - 1, 2 ** 32,
+            2 ** 64 - 1, -1, -32, -33, -128, -129, -32768, -32769, -2 ** 31, -2 ** 31 - 1,
+            -2 ** 63, 1.5, -0.0, '', 'a' * 31, 'a' * 32, 'a' * 256, 'b' * 65536, '\u2650',
+            b'', b'\x00' * 256, b'\xff' * 65536, [], list(range(16)), list(range(65536)),
+            {}, {'a': [1, {'b': None}]}, {str(i): i for i in range(16)},
+            datetime.datetime(1970, 1, 1), datetime.datetime(2015, 5, 12, 15, 50, 38),
+            datetime.datetime(2015, 5, 12, 15, 50, 38, 123456),
+            datetime.datetime(2600, 1, 1), datetime.datetime(1900, 1, 1, 0, 0, 0, 1),
+        ]
+        for value in values:
+            buf = bytearray()
+            _msgpack_pack(value, buf)
+            self.assertEqual(value, _msgpack_unpack(bytes(buf)))
+
+        # Reference encodings from the msgpack spec
+        buf = bytearray()
+        _msgpack_pack({'a': [1, -1, b'\x00', None]}, buf)
+        self.assertEqual(b'\x81\xa1a\x94\x01\xff\xc4\x01\x00\xc0', bytes(buf))
+        buf = bytearray()
+        _msgpack_pack(datetime.datetime(1970, 1, 1, 0, 0, 1), buf)
+        self.assertEqual(b'\xd6\xff\x00\x00\x00\x01', bytes(buf))
+
+        ts = bv.Timestamp('%Y-%m-%dT%H:%M:%SZ')
+        dt = datetime.datetime(2015, 5, 12, 15, 50, 38)
+        self.assertEqual(dt, msgpack_decode(ts, msgpack_encode(ts, dt)))
+        # Timestamps from older encoders are strings
+        self.assertEqual(dt, msgpack_decode(ts, b'\xb42015-05-12T15:50:38Z'))
+        bs = bv.Bytes()
+        self.assertEqual(b'\xc4\x02\xff\xfe', msgpack_encode(bs, b'\xff\xfe'))
+        self.assertEqual(b'\xff\xfe', msgpack_decode(bs, b'\xc4\x02\xff\xfe'))
+
+        for bad in [b'', b'\xc1', b'\xa2a', b'\x01\x02', b'\xa1\xff', b'\xd4\x01\x00']:
+            self.assertRaises(bv.ValidationError, msgpack_decode, bs, bad)
+
+        # Nesting is limited, so hostile input can't exhaust the stack.
+        nested = []
+        for _ in range(127):
+            nested = [nested]
+        self.assertEqual(nested, _msgpack_unpack(b'\x91' * 127 + b'\x90'))
+        self.assertRaises(ValueError, _msgpack_unpack, b'\x91' * 128 + b'\x90')
+        self.assertRaises(ValueError, _msgpack_unpack, b'\x81\x00' * 10000 + b'\xc0')
+
+    def test_streams(self):
+        data = bytes(bytearray(range(256))) * 100
+        chunks = list(stone_streams.iter_body_chunks(data, 10000))
+        self.assertEqual([10000, 10000, 5600], [len(c) for c in chunks])
+        self.assertIsInstance(chunks[0], memoryview)
+        self.assertEqual(data, b''.join(c.tobytes() for c in chunks))
+        self.assertEqual(
+            data, b''.join(bytes(c) for c in stone_streams.iter_body_chunks(io.BytesIO(data))))
+        self.assertEqual([b'a', b'b'], list(stone_streams.iter_body_chunks(iter([b'a', b'b']))))
+        self.assertRaises(TypeError, list, stone_streams.iter_body_chunks('text'))
+
+        self.assertEqual(len(data), stone_streams.body_length(data))
+        self.assertEqual(len(data), stone_streams.body_length(memoryview(data)))
+        self.assertIsNone(stone_streams.body_length(io.BytesIO(data)))
+        self.assertIsNone(stone_streams.body_length(iter([data])))
+
+        class Response(object):
+            def iter_content(self, chunk_size):
+                return iter([data[:chunk_size], data[chunk_size:]])
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for body in [data, io.BytesIO(data), [data[:10], data[10:]], Response()]:
+                self.assertEqual(len(data), stone_streams.save_body_to_file(body, path, 1000))
+                with open(path, 'rb') as f:
+                    self.assertEqual(data, f.read())
+            out = io.BytesIO()
+            self.assertEqual(len(data), stone_streams.save_body_to_file(io.BytesIO(data), out))
+            self.assertEqual(data, out.getvalue())
+
+            with open(path, 'rb') as f:
+                f.seek(100)
+                self.assertEqual(len(data) - 100, stone_streams.body_length(f))
+                sock1, sock2 = socket.socketpair()
+                try:
+                    self.assertEqual(len(data) - 100, stone_streams.send_body(sock1, f))
+                    self.assertEqual(len(data), f.tell())
+                    self.assertEqual(3, stone_streams.send_body(sock1, b'end'))
+                    sock1.close()
+                    received = []
+                    while True:
+                        chunk = sock2.recv(65536)
+                        if not chunk:
+                            break
+                        received.append(chunk)
+                    self.assertEqual(data[100:] + b'end', b''.join(received))
+                finally:
+                    sock1.close()
+                    sock2.close()
+        finally:
+            os.remove(path)
+
+    def test_route_repr(self):
+        route = bb.Route('get', 2, False, None, None, None, {}, 0x0123456789abcdef)
+        self.assertEqual(
+            "Route('get', 2, False, None, None, None, {}, 0x0123456789abcdef)",
+            repr(route).replace("u'", "'"))
+        route.fingerprint = None
+        self.assertTrue(repr(route).endswith(', {}, None)'))
+
+    def test_route_cache(self):
+        now = [0.0]
+        cache = stone_cache.RouteCache(max_size=2, clock=lambda: now[0])
+        route = bb.Route('get', 1, False, bv.String(), bv.String(), bv.Void(), {})
+        calls = []
+
+        def request(route_, namespace, arg, arg_binary):
+            self.assertIs(route, route_)
+            self.assertEqual('ns', namespace)
+            self.assertIsNone(arg_binary)
+            calls.append(arg)
+            if arg == 'error':
+                raise ValueError(arg)
+            return arg.upper()
+
+        self.assertEqual('A', cache.call(route, 'ns', 'a', 10, request))
+        self.assertEqual('A', cache.call(route, 'ns', 'a', 10, request))
+        self.assertEqual(['a'], calls)
+        self.assertEqual('B', cache.call(route, 'ns', 'b', 10, request))
+        # Using "a" makes "b" the least recently used.
+        cache.call(route, 'ns', 'a', 10, request)
+        cache.call(route, 'ns', 'c', 10, request)
+        self.assertEqual(2, len(cache))
+        cache.call(route, 'ns', 'b', 10, request)
+        self.assertEqual(['a', 'b', 'c', 'b'], calls)
+        self.assertEqual(2, cache.hits['ns/get:1'])
+        self.assertEqual(4, cache.misses['ns/get:1'])
+
+        # Results expire after their TTL
+        now[0] = 10.0
+        cache.call(route, 'ns', 'b', 10, request)
+        self.assertEqual(['a', 'b', 'c', 'b', 'b'], calls)
+
+        # Errors aren't cached
+        for _ in range(2):
+            self.assertRaises(ValueError, cache.call, route, 'ns', 'error', 10, request)
+        self.assertEqual(['error', 'error'], calls[-2:])
+
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertRaises(ValueError, stone_cache.RouteCache, max_size=0)
+
+        # Concurrent misses make one request
+        del calls[:]
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_request(_route, _namespace, arg, _arg_binary):
+            calls.append(arg)
+            started.set()
+            release.wait()
+            return arg.upper()
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(cache.call(route, 'ns', 'd', 10, slow_request)))
+            for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        # Give the other threads time to find the call in flight.
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['D'] * 5, results)
+        self.assertEqual(['d'], calls)
+
     def test_json_decoder_struct(self):
         class S(object):
             _all_field_names_ = {'f', 'g'}
@@ -763,6 +1099,18 @@ struct ContainsAlias
 
 struct S3
     u ns2.BaseU = z
+
+struct Entry
+    id String
+    name String
+
+struct Listing
+    entries List(Entry)
+    by_id Map(String, Entry)?
+    page ListingPage?
+
+union_closed ListingPage
+    entries List(Entry)
 """
 
 test_ns2_spec = """\
@@ -1101,6 +1449,59 @@ class TestGeneratedPython(unittest.TestCase):
         t12 = v.get_t12()
         self.assertEqual(t12['another key'].get_t1(), 'hello again')
 
+    def test_union_decoding_void_instances_are_shared(self):
+        # Void tags decode to the class attribute of the same name
+        self.assertIs(self.decode(self.sv.Union(self.ns.V), json.dumps('t0')), self.ns.V.t0)
+        self.assertIs(self.decode(self.sv.Union(self.ns.V), json.dumps({'.tag': 't0'})),
+                      self.ns.V.t0)
+        self.assertIs(self.decode(self.sv.Union(self.ns.V), json.dumps('t0'), old_style=True),
+                      self.ns.V.t0)
+        self.assertIs(self.decode(self.sv.Union(self.ns.V), json.dumps('unknown'), strict=False),
+                      self.ns.V.other)
+
+        # Inherited void tags are shared instances of the child class
+        u1 = self.decode(self.sv.Union(self.ns.UOpen), json.dumps('t0'))
+        u2 = self.decode(self.sv.Union(self.ns.UOpen), json.dumps('t0'))
+        self.assertIsInstance(u1, self.ns.UOpen)
+        self.assertIs(u1, u2)
+        self.assertEqual(u1, self.ns.U.t0)
+
+        # Nullable tags without a value aren't shared
+        v1 = self.decode(self.sv.Union(self.ns.V), json.dumps('t2'))
+        v2 = self.decode(self.sv.Union(self.ns.V), json.dumps('t2'))
+        self.assertTrue(v1.is_t2())
+        self.assertIsNot(v1, v2)
+
+    def test_decoding_with_interned_strings(self):
+        # Build equal strings that aren't the same object
+        def tag():
+            return ''.join(['t', '1'])
+
+        def key():
+            return ''.join(['k', 'e', 'y'])
+
+        spec_tag = [t for t in self.ns.V._tagmap if t == 't1'][0]
+        obj = [{'.tag': tag(), 't1': 'a'}, {'.tag': tag(), 't1': 'b'}]
+        vs = self.compat_obj_decode(
+            self.sv.List(self.sv.Union(self.ns.V)), obj, intern_strings=True)
+        self.assertEqual(['a', 'b'], [v.get_t1() for v in vs])
+        self.assertIs(vs[0]._tag, spec_tag)
+        self.assertIs(vs[1]._tag, spec_tag)
+        vs = self.compat_obj_decode(self.sv.List(self.sv.Union(self.ns.V)), obj)
+        self.assertIsNot(vs[0]._tag, vs[1]._tag)
+
+        m = self.sv.List(self.sv.Map(self.sv.String(), self.sv.Int32()))
+        ds = self.compat_obj_decode(m, [{key(): 1}, {key(): 2}], intern_strings=True)
+        self.assertEqual([{'key': 1}, {'key': 2}], ds)
+        self.assertIs(list(ds[0])[0], list(ds[1])[0])
+
+        # A map key equal to a tag doesn't stand in for the tag
+        m = self.sv.List(self.sv.Map(self.sv.String(), self.sv.Union(self.ns.V)))
+        ds = self.compat_obj_decode(
+            m, [{tag(): {'.tag': 't0'}}, {'x': {'.tag': tag(), 't1': 'a'}}], intern_strings=True)
+        self.assertIsNot(spec_tag, list(ds[0])[0])
+        self.assertIs(spec_tag, ds[1]['x']._tag)
+
     def test_union_decoding_with_optional_struct(self):
         # Simulate that U2 used to have a field b with no value, but it's since
         # been evolved to a field with an optional struct (only has optional
@@ -1397,15 +1798,8 @@ class TestGeneratedPython(unittest.TestCase):
     def test_msgpack(self):
         # Do a limited amount of testing just to make sure that unicode
         # handling and byte array handling are functional.
-
-        # If the machine doesn't have msgpack, don't worry about these tests.
-        try:
-            from stone_serializers import (
-                msgpack_encode,
-                msgpack_decode,
-            )
-        except ImportError:
-            return
+        msgpack_encode = self.ss.msgpack_encode
+        msgpack_decode = self.ss.msgpack_decode
 
         b = self.ns.B(a='hi', b=32, c=b'\x00\x01')
         s = msgpack_encode(self.sv.Struct(self.ns.B), b)
@@ -1424,6 +1818,690 @@ class TestGeneratedPython(unittest.TestCase):
         u2 = msgpack_decode(self.sv.String(), s)
         self.assertEqual(u, u2)
 
+        # Packing as the validators are walked gives the same encoding as
+        # packing the tree of primitives.
+        ns = self.ns
+        v = self.sv.Union(ns.V)
+        values = [
+            (v, ns.V.t0, {}),
+            (v, ns.V.t1('a'), {}),
+            (v, ns.V.t2(None), {}),
+            (v, ns.V.t3(ns.S(f='a')), {}),
+            (v, ns.V.t4(ns.S(f='a')), {}),
+            (v, ns.V.t4(None), {}),
+            (v, ns.V.t6(ns.U.t1('b')), {}),
+            (v, ns.V.t7(ns.File(name='f', size=1)), {}),
+            (v, ns.V.t10([ns.U.t0, ns.U.t1('c')]), {}),
+            (v, ns.V.t12({'k': ns.U.t2}), {}),
+            (v, ns.V.t3(ns.S(f='a')), {'old_style': True}),
+            (v, ns.V.t7(ns.File(name='f', size=1)), {'old_style': True}),
+            (v, ns.V.t3(ns.S(f='a')), {'field_mask': ['t3']}),
+            (v, ns.V.t3(ns.S(f='a')), {'field_mask': ['t1']}),
+            (self.sv.Struct(ns.D), ns.D(a='a', d=[1, None], e={'k': None, 'l': 'x'}), {}),
+            (self.sv.Struct(ns.D), ns.D(a='a', d=[], e={}), {'field_mask': ['a']}),
+            (self.sv.StructTree(ns.Resource), ns.Folder(name='d'), {}),
+            (self.sv.Struct(ns.B), b, {}),
+            (self.sv.Struct(ns.B), msgpack_decode(
+                self.sv.Struct(ns.B), msgpack_encode(self.sv.Struct(ns.B), b), lazy=True), {}),
+        ]
+        for validator, value, kwargs in values:
+            buf = bytearray()
+            _msgpack_pack(self.ss.msgpack_compat_obj_encode(validator, value, **kwargs), buf)
+            self.assertEqual(bytes(buf), msgpack_encode(validator, value, **kwargs))
+
+    def test_fingerprints(self):
+        fingerprints = [self.ns.A._fingerprint_, self.ns.B._fingerprint_,
+                        self.ns.U._fingerprint_, self.ns.UExtend._fingerprint_,
+                        self.ns2.BaseS._fingerprint_, self.ns.FINGERPRINT, self.ns2.FINGERPRINT]
+        for fingerprint in fingerprints:
+            self.assertIsInstance(fingerprint, six.integer_types)
+            self.assertTrue(0 <= fingerprint < 2 ** 64)
+        self.assertEqual(len(fingerprints), len(set(fingerprints)))
+
+    def test_binary(self):
+        binary_encode = self.ss.binary_encode
+        binary_decode = self.ss.binary_decode
+
+        def round_trip(data_type, obj):
+            return binary_decode(data_type, binary_encode(data_type, obj))
+
+        b = self.ns.B(a='hi', b=32, c=b'\x00\x01')
+        b2 = round_trip(self.sv.Struct(self.ns.B), b)
+        self.assertEqual((b.a, b.b, b.c), (b2.a, b2.b, b2.c))
+        # Presence bitmap, 'hi', 32 (zigzag encoded), b'\x00\x01'
+        s = binary_encode(self.sv.Struct(self.ns.B), b)
+        self.assertEqual(b'\x07\x02hi\x40\x02\x00\x01', s[8:])
+
+        d = self.ns.D(a='x', c=None, d=[1, None, -2 ** 63], e={'k': None, 'l': 'v'})
+        d2 = round_trip(self.sv.Struct(self.ns.D), d)
+        self.assertEqual(('x', 10, None, d.d, d.e), (d2.a, d2.b, d2.c, d2.d, d2.e))
+        self.assertFalse(d2._b_present)
+
+        for v in [self.ns.V.t0, self.ns.V.t1('a'), self.ns.V.t2(None),
+                  self.ns.V.t4(self.ns.S(f='s')), self.ns.V.t5(self.ns.U.t1('u')),
+                  self.ns.V.t7(self.ns.File(name='f', size=3)),
+                  self.ns.V.t8(self.ns.Folder(name='d')),
+                  self.ns.V.t10([self.ns.U.t0, self.ns.U.t2]),
+                  self.ns.V.t12({'a': self.ns.U.t0})]:
+            v2 = round_trip(self.sv.Union(self.ns.V), v)
+            self.assertEqual(self.encode(self.sv.Union(self.ns.V), v),
+                             self.encode(self.sv.Union(self.ns.V), v2))
+        self.assertIs(self.ns.V.t0, round_trip(self.sv.Union(self.ns.V), self.ns.V.t0))
+        f = round_trip(self.sv.StructTree(self.ns.Resource), self.ns.File(name='f', size=3))
+        self.assertIsInstance(f, self.ns.File)
+        self.assertEqual(('f', 3), (f.name, f.size))
+
+        ts = self.sv.Timestamp('%Y-%m-%dT%H:%M:%SZ')
+        for dt in [datetime.datetime(2015, 5, 12, 15, 50, 38),
+                   datetime.datetime(1, 1, 1, 0, 0, 0, 1)]:
+            self.assertEqual(dt, round_trip(ts, dt))
+        for data_type, value in [(self.sv.Int32(), -5), (self.sv.UInt64(), 2 ** 64 - 1),
+                                 (self.sv.Float64(), -1.5), (self.sv.Boolean(), True),
+                                 (self.sv.String(), '\u2650'), (self.sv.Bytes(), b'\xff'),
+                                 (self.sv.Nullable(self.sv.String()), None)]:
+            self.assertEqual(value, round_trip(data_type, value))
+
+        # Values are validated on both ends
+        self.assertRaises(self.sv.ValidationError, binary_encode,
+                          self.sv.Struct(self.ns.B), self.ns.B(a='hi'))
+        s = binary_encode(self.sv.Int64(), -1)
+        self.assertRaises(self.sv.ValidationError, binary_decode, self.sv.UInt32(), s)
+        s = binary_encode(self.sv.List(self.sv.UInt32()), [1, 2])
+        self.assertRaises(self.sv.ValidationError, binary_decode,
+                          self.sv.List(self.sv.UInt32()), s[:-1])
+        self.assertRaises(self.sv.ValidationError, binary_decode,
+                          self.sv.List(self.sv.UInt32()), s + b'\x00')
+
+        def reprefix(data_type, s):
+            # Gives s the fingerprint of data_type, to decode it as that.
+            return struct.pack('>Q', self.ss.binary_fingerprint(data_type)) + s[8:]
+
+        # Including values that aren't in any struct or union
+        for data_type, value, as_type in [
+                (self.sv.List(self.sv.Int64()), [2 ** 40], self.sv.List(self.sv.Int32())),
+                (self.sv.List(self.sv.String()), ['123'],
+                 self.sv.List(self.sv.String(pattern='[a-z]+'))),
+                (self.sv.Map(self.sv.String(), self.sv.Int64()), {'a': 2 ** 40},
+                 self.sv.Map(self.sv.String(), self.sv.Int32())),
+                (self.sv.Nullable(self.sv.String()), 'ab',
+                 self.sv.Nullable(self.sv.String(max_length=1))),
+                (self.sv.List(self.sv.Int32()), [1, 2],
+                 self.sv.List(self.sv.Int32(), max_items=1))]:
+            s = reprefix(as_type, binary_encode(data_type, value))
+            self.assertRaises(self.sv.ValidationError, binary_decode, as_type, s)
+
+        # Varints longer than 64 bits are rejected
+        uint64 = self.sv.UInt64()
+        s = binary_encode(uint64, 2 ** 64 - 1)
+        self.assertEqual(10, len(s[8:]))
+        self.assertRaises(self.sv.ValidationError, binary_decode,
+                          uint64, s[:8] + b'\xff' * 10 + b'\x01')
+
+        # Counts larger than the rest of the input are rejected, so items that
+        # take no bytes can't make the decoder loop for long
+        void_list = self.sv.List(self.sv.Void())
+        s = binary_encode(void_list, [None] * 10 ** 6)
+        self.assertEqual(3, len(s[8:]))
+        self.assertRaises(self.sv.ValidationError, binary_decode, void_list, s)
+        self.assertEqual([], binary_decode(void_list, binary_encode(void_list, [])))
+
+        # Float32 takes 4 bytes
+        s = binary_encode(self.sv.Float32(), 1.5)
+        self.assertEqual(struct.pack('<f', 1.5), s[8:])
+        self.assertEqual(1.5, binary_decode(self.sv.Float32(), s))
+
+        # Fingerprints depend only on the schema, and are the generated
+        # fingerprints of structs and unions
+        fingerprint = self.ss.binary_fingerprint
+        self.assertEqual(self.ns.B._fingerprint_, fingerprint(self.sv.Struct(self.ns.B)))
+        self.assertEqual(self.ns.V._fingerprint_, fingerprint(self.sv.Union(self.ns.V)))
+        self.assertEqual(fingerprint(self.sv.List(self.sv.Struct(self.ns.B))),
+                         fingerprint(self.sv.List(self.sv.Struct(self.ns.B))))
+        self.assertNotEqual(fingerprint(self.sv.List(self.sv.Struct(self.ns.A))),
+                            fingerprint(self.sv.List(self.sv.Struct(self.ns.B))))
+        self.assertEqual(fingerprint(self.sv.Union(self.ns.V)),
+                         fingerprint(self.sv.Union(self.ns.V)))
+        self.assertNotEqual(fingerprint(self.sv.Union(self.ns.U)),
+                            fingerprint(self.sv.Union(self.ns.UExtend)))
+        self.assertNotEqual(fingerprint(self.sv.Int64()), fingerprint(self.sv.UInt64()))
+        self.assertEqual(fingerprint(self.sv.Int32(min_value=-2 ** 31)),
+                         fingerprint(self.sv.Int32()))
+        for constrained, unconstrained in [
+                (self.sv.Int32(max_value=5), self.sv.Int32()),
+                (self.sv.Float64(min_value=0), self.sv.Float64()),
+                (self.sv.String(pattern='[a-z]+'), self.sv.String()),
+                (self.sv.List(self.sv.String(max_length=5)),
+                 self.sv.List(self.sv.String(max_length=10))),
+                (self.sv.List(self.sv.String(), max_items=3), self.sv.List(self.sv.String()))]:
+            self.assertNotEqual(fingerprint(constrained), fingerprint(unconstrained))
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            binary_decode(self.sv.Union(self.ns.UExtend),
+                          binary_encode(self.sv.Union(self.ns.U), self.ns.U.t0))
+        self.assertIn('schema fingerprint mismatch', str(cm.exception))
+
+    def test_ndjson(self):
+        class CountingStream(io.BytesIO):
+            writes = 0
+
+            def write(self, b):
+                self.writes += 1
+                return super(CountingStream, self).write(b)
+
+        validator = self.sv.Struct(self.ns.B)
+        objs = [self.ns.B(a='hi', b=i, c=b'\x00\x01') for i in range(10)]
+        stream = CountingStream()
+        self.assertEqual(10, self.ss.ndjson_encode_iter(validator, objs, stream, chunk_size=100))
+        # Lines are 33 bytes, so they're written in two chunks of 4 and the rest
+        self.assertEqual(3, stream.writes)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual([self.encode(validator, obj).encode('ascii') for obj in objs], lines)
+
+        text_stream = io.StringIO()
+        self.ss.ndjson_encode_iter(validator, iter(objs), text_stream)
+        self.assertEqual(stream.getvalue().decode('ascii'), text_stream.getvalue())
+
+        for s in [stream, text_stream]:
+            s.seek(0)
+            decoded = list(self.ss.ndjson_decode_iter(validator, s))
+            self.assertEqual(list(range(10)), [obj.b for obj in decoded])
+
+        # Blank lines are skipped, but count towards line numbers
+        lines = ['{"a": "x", "b": 1, "c": ""}', '', '{"a": "y", "b": 2, "c": "", "z": 0}']
+        decoded = self.ss.ndjson_decode_iter(validator, lines, strict=False)
+        self.assertEqual(['x', 'y'], [obj.a for obj in decoded])
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            list(self.ss.ndjson_decode_iter(validator, lines))
+        self.assertEqual("line 3: unknown field 'z'", str(cm.exception))
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            list(self.ss.ndjson_decode_iter(self.sv.String(), ['"a"', '"b', '"c"']))
+        self.assertEqual('line 2: could not decode input as JSON', str(cm.exception))
+
+        # Lines before an invalid object are written
+        stream = io.BytesIO()
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.ss.ndjson_encode_iter(validator, objs[:2] + [self.ns.B(a='x')], stream)
+        self.assertEqual("line 3: missing required field 'b'", str(cm.exception))
+        self.assertEqual(2, len(stream.getvalue().splitlines()))
+
+    def test_json_log_encode(self):
+        validator = self.sv.Struct(self.ns.D)
+        d = self.ns.D(a='x' * 20, d=list(range(30)), e={'k%d' % i: 'v' for i in range(10)})
+
+        # Lists are truncated to max_list_length, with a count of the rest
+        s = self.ss.json_log_encode(validator, d, max_bytes=100, max_list_length=10)
+        self.assertEqual(
+            '{"a": "xxxxxxxxxxxxxxxxxxxx", '
+            '"d": [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, "... (20 more)"], '
+            '"e": {"k0": "v", "...": "..."}}', s)
+        s = self.ss.json_log_encode(validator, d, max_list_length=3)
+        self.assertEqual(['... (27 more)'], json.loads(s)['d'][3:])
+        self.assertEqual('7 more', json.loads(s)['e']['...'])
+        self.assertEqual(4, len(json.loads(s)['e']))
+
+        # The output is valid JSON for any budget
+        for max_bytes in range(0, 200, 7):
+            json.loads(self.ss.json_log_encode(validator, d, max_bytes=max_bytes))
+        self.assertEqual('{"a": "..."}', self.ss.json_log_encode(validator, d, max_bytes=10))
+        self.assertEqual(
+            '"yyyyyyyyyyyyyyy..."',
+            self.ss.json_log_encode(self.sv.String(), 'y' * 100, max_bytes=20))
+        self.assertEqual(
+            '"enp6enp6enp6enp..."',
+            self.ss.json_log_encode(self.sv.Bytes(), b'z' * 100, max_bytes=20))
+
+        # Nesting beyond max_depth is elided
+        v = self.ns.V.t10([self.ns.U.t1('a')])
+        self.assertEqual(
+            '{".tag": "t10", "t10": "..."}',
+            self.ss.json_log_encode(self.sv.Union(self.ns.V), v, max_depth=1))
+        self.assertEqual(
+            self.encode(self.sv.Union(self.ns.V), v),
+            self.ss.json_log_encode(self.sv.Union(self.ns.V), v))
+
+        # Invalid objects are logged as they are
+        self.assertEqual(
+            '{"b": 1}', self.ss.json_log_encode(validator, self.ns.D(b=1)))
+        # ...unless they can't be encoded
+        bad = self.ns.V.t10([self.ns.U.t1('a')])
+        bad._tag = 'zzz'
+        self.assertEqual(
+            '[{".tag": "t10", "t10": [{".tag": "t1", "t1": "a"}]}, "<invalid>"]',
+            self.ss.json_log_encode(self.sv.List(self.sv.Union(self.ns.V)), [v, bad]))
+        self.assertEqual(
+            '["<invalid>", "2015"]',
+            self.ss.json_log_encode(self.sv.List(self.sv.Timestamp('%Y')),
+                                    ['x', datetime.datetime(2015, 1, 1)]))
+
+        # Escaped characters count against max_bytes
+        for c in ['"', '\n', '\xe9', '\U0001f600']:
+            s = self.ss.json_log_encode(self.sv.String(), c * 100, max_bytes=20)
+            self.assertLessEqual(len(s), 20, s)
+            text = json.loads(s)
+            self.assertGreater(len(text), 3)
+            self.assertEqual(c * (len(text[:-3]) // len(c)) + '...', text)
+
+    def test_canonical_json_encode(self):
+        validator = self.sv.Struct(self.ns.D)
+        d1 = self.ns.D(a='\xe9', d=[1, None], e={'b': 'x', 'a': None, 'c': '\n'})
+        d2 = self.ns.D(e=collections.OrderedDict([('c', '\n'), ('a', None), ('b', 'x')]),
+                       d=[1, None], a='\xe9')
+        encoded = self.ss.canonical_json_encode(validator, d1)
+        self.assertEqual(
+            b'{"a":"\xc3\xa9","d":[1,null],"e":{"a":null,"b":"x","c":"\\n"}}', encoded)
+        self.assertEqual(encoded, self.ss.canonical_json_encode(validator, d2))
+        self.assertEqual(
+            hashlib.sha256(encoded).hexdigest(), self.ss.stone_hash(validator, d2).hexdigest())
+        self.assertEqual(
+            hashlib.md5(encoded).hexdigest(),
+            self.ss.stone_hash(validator, d1, algorithm='md5').hexdigest())
+
+        c = self.ns.C(a='a', b=True, c=b'\x00', d=-0.0)
+        self.assertEqual(
+            b'{"a":"a","b":1,"c":"AA==","d":0.0}',
+            self.ss.canonical_json_encode(self.sv.Struct(self.ns.C), c))
+        c.d = 1e16
+        self.assertIn(b'"d":1e+16', self.ss.canonical_json_encode(self.sv.Struct(self.ns.C), c))
+        self.assertEqual(
+            b'{".tag":"t11","t11":{"a":1,"b":2}}',
+            self.ss.canonical_json_encode(
+                self.sv.Union(self.ns.V), self.ns.V.t11({'b': 2, 'a': 1})))
+
+        # Timestamps are in ISO 8601 whatever their format
+        dt = datetime.datetime(2015, 5, 12, 15, 50, 38, 5)
+        self.assertEqual(
+            b'"2015-05-12T15:50:38.000005Z"',
+            self.ss.canonical_json_encode(self.sv.Timestamp('%a, %d %b %Y'), dt))
+
+        with self.assertRaises(self.sv.ValidationError):
+            self.ss.stone_hash(validator, self.ns.D(a='x'))
+
+        # Lazily decoded objects are encoded like eagerly decoded ones
+        raw = {'a': 'a', 'b': True, 'c': 'AA==', 'd': 1, '.tag': 'c'}
+        validator = self.sv.Struct(self.ns.C)
+        self.assertEqual(
+            self.ss.canonical_json_encode(validator, self.compat_obj_decode(validator, raw)),
+            self.ss.canonical_json_encode(
+                validator, self.compat_obj_decode(validator, raw, lazy=True)))
+        self.assertIn(b'"d":1.0', self.ss.canonical_json_encode(
+            validator, self.compat_obj_decode(validator, raw, lazy=True)))
+
+        # NaN and infinities have no JSON encoding
+        writer = self.ss.CanonicalJsonWriter(lambda chunk: None)
+        for value in [float('nan'), float('inf'), float('-inf')]:
+            with self.assertRaises(ValueError):
+                writer.write([value])
+
+    def test_stone_diff(self):
+        validator = self.sv.Struct(self.ns.D)
+        old = self.ns.D(a='x', c='c', d=[1, 2, 3, 4], e={'k': 'v', 'j': None, 'i': 'i'})
+        new = self.ns.D(a='y', b=11, d=[1, 5, 3, 4], e={'k': 'w', 'j': None, 'h': None})
+        patch = self.ss.stone_diff(validator, old, new)
+        self.assertEqual([
+            {'op': 'set', 'path': ['a'], 'value': 'y'},
+            {'op': 'set', 'path': ['b'], 'value': 11},
+            {'op': 'unset', 'path': ['c']},
+            {'op': 'set', 'path': ['d', 1], 'value': 5},
+            {'op': 'set', 'path': ['e', 'k'], 'value': 'w'},
+            {'op': 'set', 'path': ['e', 'h'], 'value': None},
+            {'op': 'unset', 'path': ['e', 'i']},
+        ], patch)
+        patched = self.ss.stone_apply_patch(validator, old, json.loads(json.dumps(patch)))
+        self.assertEqual(
+            self.compat_obj_encode(validator, new), self.compat_obj_encode(validator, patched))
+        self.assertEqual('x', old.a)
+        self.assertEqual([], self.ss.stone_diff(validator, new, patched))
+
+        # Lists are spliced
+        new = self.ns.D(a='x', d=[1, 2, 7, 8, 9, 4], e={})
+        patch = self.ss.stone_diff(validator, self.ns.D(a='x', d=[1, 2, 3, 4], e={}), new)
+        self.assertEqual(
+            [{'op': 'splice', 'path': ['d'], 'index': 2, 'delete': 1, 'insert': [7, 8, 9]}],
+            patch)
+
+        # Unions are stepped into if their tag doesn't change
+        validator = self.sv.Union(self.ns.V)
+        old = self.ns.V.t7(self.ns.File(name='n', size=3))
+        new = self.ns.V.t7(self.ns.File(name='n', size=4))
+        patch = self.ss.stone_diff(validator, old, new)
+        self.assertEqual([{'op': 'set', 'path': ['t7', 'size'], 'value': 4}], patch)
+        self.assertEqual(4, self.ss.stone_apply_patch(validator, old, patch).get_t7().size)
+        new = self.ns.V.t7(self.ns.Folder(name='n'))
+        patch = self.ss.stone_diff(validator, old, new)
+        self.assertEqual(
+            [{'op': 'set', 'path': ['t7'], 'value': {'.tag': 'folder', 'name': 'n'}}], patch)
+        old = self.ns.V.t3(self.ns.S(f='a'))
+        patch = self.ss.stone_diff(validator, old, self.ns.V.t3(self.ns.S(f='b')))
+        self.assertEqual([{'op': 'set', 'path': ['t3', 'f'], 'value': 'b'}], patch)
+        self.assertEqual('b', self.ss.stone_apply_patch(validator, old, patch).get_t3().f)
+        patch = self.ss.stone_diff(validator, old, self.ns.V.t0)
+        self.assertEqual([{'op': 'set', 'path': [], 'value': {'.tag': 't0'}}], patch)
+        self.assertTrue(self.ss.stone_apply_patch(validator, old, patch).is_t0())
+
+    def test_stone_apply_patch_validation(self):
+        validator = self.sv.Struct(self.ns.D)
+        d = self.ns.D(a='x', d=[1], e={})
+        for patch, message in [
+            ([{'op': 'set', 'path': ['a'], 'value': 1}],
+             "a: '1' expected to be a string, got integer"),
+            ([{'op': 'unset', 'path': ['a']}], "missing required field 'a'"),
+            ([{'op': 'set', 'path': ['z'], 'value': 1}], "0: unknown field 'z'"),
+            ([{'op': 'set', 'path': ['d', 1], 'value': 1}], '0: invalid index 1'),
+            ([{'op': 'splice', 'path': ['d'], 'index': 0, 'delete': 2, 'insert': []}],
+             '0: invalid splice'),
+            ([{'op': 'splice', 'path': ['a'], 'index': 0, 'delete': 0, 'insert': []}],
+             '0: can only splice lists'),
+            ([{'op': 'set', 'path': ['c', 'x'], 'value': 1}], "0: no value at 'c'"),
+            ([{'op': 'move', 'path': []}], '0: invalid operation'),
+            ([{'op': 'set', 'path': []}], "0: missing key 'value'"),
+        ]:
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                self.ss.stone_apply_patch(validator, d, patch)
+            self.assertEqual(message, str(cm.exception))
+
+        validator = self.sv.Union(self.ns.V)
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.ss.stone_apply_patch(
+                validator, self.ns.V.t1('a'), [{'op': 'set', 'path': ['t9', 0], 'value': 'b'}])
+        self.assertEqual("0: tag 't9' isn't set", str(cm.exception))
+
+    def test_pickle_and_copy(self):
+        validator = self.sv.Struct(self.ns.C)
+        c = self.ns.C(a='a', b=1, c=b'c', d=1.5)
+        s = self.ns.V.t10([self.ns.U.t1('x'), self.ns.U.t0])
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            unpickled = pickle.loads(pickle.dumps(c, protocol))
+            self.assertIs(type(unpickled), self.ns.C)
+            self.assertEqual(
+                self.compat_obj_encode(validator, c), self.compat_obj_encode(validator, unpickled))
+            self.assertEqual(s, pickle.loads(pickle.dumps(s, protocol)))
+        d = self.ns.D(a='a', d=[1], e={})
+        copied = copy.copy(d)
+        self.assertIs(d.d, copied.d)
+        copied.a = 'b'
+        self.assertEqual('a', d.a)
+        copied = copy.deepcopy(d)
+        self.assertEqual([1], copied.d)
+        self.assertIsNot(d.d, copied.d)
+        self.assertEqual(s, copy.deepcopy(s))
+
+        # Lazy structs are loaded first
+        encoded = self.compat_obj_encode(validator, c)
+        for f in [copy.copy, copy.deepcopy, lambda v: pickle.loads(pickle.dumps(v, 2))]:
+            result = f(self.compat_obj_decode(validator, encoded, lazy=True))
+            self.assertIs(type(result), self.ns.C)
+            self.assertEqual(encoded, self.compat_obj_encode(validator, result))
+        # Fields left out by a field mask stay so
+        masked = pickle.loads(pickle.dumps(
+            self.compat_obj_decode(validator, encoded, field_mask=['a']), 2))
+        self.assertFalse(self.ss.bb.is_loaded(masked, 'b'))
+
+    def test_field_mask_encode(self):
+        validator = self.sv.Struct(self.ns.D)
+        d = self.ns.D(a='x', d=[1, 2], e={'k': 'v'})
+        self.assertEqual(
+            {'a': 'x', 'e': {'k': 'v'}},
+            self.compat_obj_encode(validator, d, field_mask=['a', 'e']))
+        self.assertEqual('{"d": [1]}', self.encode(validator, self.ns.D(d=[1]), field_mask='d'))
+        # Only selected fields need to be present
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.encode(validator, self.ns.D(d=[1]), field_mask=['a'])
+        self.assertEqual("missing required field 'a'", str(cm.exception))
+
+        # Wildcards select list items and union tags. Tags are always kept.
+        validator = self.sv.List(self.sv.Union(self.ns.V))
+        vs = [
+            self.ns.V.t3(self.ns.S(f='f')),
+            self.ns.V.t7(self.ns.File(name='n', size=3)),
+            self.ns.V.t8(self.ns.Folder(name='fo')),
+            self.ns.V.t10([self.ns.U.t1('a')]),
+            self.ns.V.t0,
+        ]
+        self.assertEqual(
+            [{'.tag': 't3', 'f': 'f'},
+             {'.tag': 't7', 't7': {'.tag': 'file', 'size': 3}},
+             {'.tag': 't8'},
+             {'.tag': 't10'},
+             {'.tag': 't0'}],
+            self.compat_obj_encode(validator, vs, field_mask=['*.t3.f', '*.t7.size']))
+        self.assertEqual(
+            [{'.tag': 't3'},
+             {'.tag': 't7', 't7': {'.tag': 'file', 'name': 'n'}},
+             {'.tag': 't8', 't8': {'.tag': 'folder', 'name': 'fo'}},
+             {'.tag': 't10'},
+             {'.tag': 't0'}],
+            self.compat_obj_encode(validator, vs, field_mask=['*.*.name']))
+        self.assertEqual(
+            ['t3', 't7', 't8', {'t10': [{'t1': 'a'}]}, 't0'],
+            self.compat_obj_encode(validator, vs, field_mask=['*.t10'], old_style=True))
+        self.assertEqual(
+            self.encode(validator, vs), self.encode(validator, vs, field_mask=['*.*']))
+
+        # Masks are compiled once
+        field_mask = self.ss.compile_field_mask(validator, ['*.t3.f'])
+        self.assertIs(field_mask, self.ss.compile_field_mask(validator, ('*.t3.f',)))
+        self.assertEqual(
+            [{'.tag': 't3', 'f': 'f'}],
+            self.compat_obj_encode(validator, vs[:1], field_mask=field_mask))
+        # Only the most recently used masks of each validator are kept
+        cache_size_was, self.ss.FIELD_MASK_CACHE_SIZE = self.ss.FIELD_MASK_CACHE_SIZE, 2
+        try:
+            d = self.sv.Struct(self.ns.D)
+            a = self.ss.compile_field_mask(d, ['a'])
+            b = self.ss.compile_field_mask(d, ['b'])
+            self.assertIs(a, self.ss.compile_field_mask(d, ['a']))
+            self.ss.compile_field_mask(d, ['c'])
+            self.assertEqual(2, len(self.ss._field_masks[d]))
+            self.assertIs(a, self.ss.compile_field_mask(d, ['a']))
+            self.assertIsNot(b, self.ss.compile_field_mask(d, ['b']))
+        finally:
+            self.ss.FIELD_MASK_CACHE_SIZE = cache_size_was
+
+        for data_type, paths, message in [
+                (self.sv.Struct(self.ns.D), ['z'], "'z' is not a field of D"),
+                (self.sv.Struct(self.ns.D), ['a.b'],
+                 "'a.b' selects a field of String, which has none"),
+                (self.sv.Struct(self.ns.D), ['d.x'], "'d.x' selects a field of a List; use 'd.*'"),
+                (self.sv.Struct(self.ns.D), ['a..b'], "invalid field mask path 'a..b'"),
+                (validator, ['*.zz'], "'*.zz' is not a tag of V"),
+                (validator, ['*.*.zz'], "'*.*' doesn't select anything in V")]:
+            with self.assertRaises(ValueError) as cm:
+                self.ss.compile_field_mask(data_type, paths)
+            self.assertEqual(message, str(cm.exception).replace("u'", "'"))
+
+    def test_field_mask_decode(self):
+        bb = __import__('stone_base')
+        validator = self.sv.Struct(self.ns.D)
+        # The unselected list holds an invalid item, but isn't decoded
+        s = json.dumps({'a': 'x', 'b': 3, 'd': [1, 'bad'], 'e': {'k': 'v'}})
+        d = self.decode(validator, s, field_mask=['a', 'b'])
+        self.assertEqual(('x', 3), (d.a, d.b))
+        for field_name in ['c', 'd', 'e']:
+            self.assertFalse(bb.is_loaded(d, field_name))
+            with self.assertRaises(bb.NotLoadedError) as cm:
+                getattr(d, field_name)
+            self.assertEqual("field '%s' was not loaded" % field_name, str(cm.exception))
+        self.assertTrue(bb.is_loaded(d, 'a'))
+        self.assertEqual('{"a": "x", "b": 3}', self.encode(validator, d, field_mask=['a', 'b']))
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.encode(validator, d)
+        self.assertEqual("field 'c' was not loaded", str(cm.exception))
+        # Only selected fields need to be present
+        d = self.decode(validator, json.dumps({'a': 'x'}), field_mask=['a'])
+        self.assertEqual('x', d.a)
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.decode(validator, json.dumps({'b': 1}), field_mask=['a'])
+        self.assertEqual("missing required field 'a'", str(cm.exception))
+
+        # Values of unselected tags aren't decoded
+        validator = self.sv.List(self.sv.Union(self.ns.V))
+        vs = [
+            self.ns.V.t3(self.ns.S(f='f')),
+            self.ns.V.t7(self.ns.File(name='n', size=3)),
+            self.ns.V.t1('s'),
+            self.ns.V.t0,
+        ]
+        field_mask = self.ss.compile_field_mask(validator, ['*.t7.size'])
+        encoded = self.compat_obj_encode(validator, vs, field_mask=field_mask)
+        decoded = self.compat_obj_decode(validator, encoded, field_mask=field_mask)
+        self.assertEqual(['t3', 't7', 't1', 't0'], [v._tag for v in decoded])
+        self.assertFalse(bb.is_loaded(decoded[0]))
+        with self.assertRaises(bb.NotLoadedError) as cm:
+            decoded[2].get_t1()
+        self.assertEqual("value of tag 't1' was not loaded", str(cm.exception))
+        self.assertIs(self.ns.V.t0, decoded[3])
+        self.assertEqual(3, decoded[1].get_t7().size)
+        self.assertFalse(bb.is_loaded(decoded[1].get_t7(), 'name'))
+        self.assertEqual(
+            encoded, self.compat_obj_encode(validator, decoded, field_mask=field_mask))
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.encode(validator, decoded)
+        self.assertEqual("value of tag 't3' was not loaded", str(cm.exception))
+
+        encoded = self.compat_obj_encode(validator, vs, old_style=True)
+        decoded = self.compat_obj_decode(
+            validator, encoded, field_mask=['*.t3'], old_style=True)
+        self.assertEqual('f', decoded[0].get_t3().f)
+        self.assertFalse(bb.is_loaded(decoded[2]))
+
+        # Through lists and maps of structs
+        validator = self.sv.Struct(self.ns.Listing)
+        entries = [{'id': '1', 'name': 'a'}, {'id': '2', 'name': 'b'}]
+        s = json.dumps({'entries': entries, 'by_id': {'1': entries[0]},
+                        'page': {'.tag': 'entries', 'entries': entries}})
+        listing = self.decode(validator, s, field_mask=['entries.*.name'])
+        self.assertEqual(['a', 'b'], [entry.name for entry in listing.entries])
+        self.assertFalse(bb.is_loaded(listing.entries[0], 'id'))
+        self.assertFalse(bb.is_loaded(listing, 'by_id'))
+        listing = self.decode(
+            validator, s, field_mask=['by_id.*.name', 'page.entries.*.name'])
+        self.assertEqual('a', listing.by_id['1'].name)
+        self.assertEqual(['a', 'b'], [entry.name for entry in listing.page.get_entries()])
+        self.assertFalse(bb.is_loaded(listing.page.get_entries()[1], 'id'))
+        self.assertEqual(
+            {'entries': [{'name': 'a'}, {'name': 'b'}]},
+            self.compat_obj_encode(validator, self.decode(validator, s, field_mask=[
+                'entries.*.name']), field_mask=['entries.*.name']))
+        # The selected fields are still validated
+        s = json.dumps({'entries': [{'id': '1', 'name': 2}]})
+        with self.assertRaises(self.sv.ValidationError):
+            self.decode(validator, s, field_mask=['entries.*.name'])
+
+    def test_lazy_decode(self):
+        validator = self.sv.Struct(self.ns.D)
+        # The list holds an invalid item, which isn't noticed until it's read
+        s = json.dumps({'a': 'x', 'd': [1, 'bad'], 'e': {'k': 'v'}})
+        d = self.decode(validator, s, lazy=True)
+        self.assertIsInstance(d, self.ns.D)
+        self.assertEqual(['a', 'c', 'd', 'e'], sorted(d._lazy_fields_))
+        self.assertIsNotNone(d._lazy_raw_)
+        self.assertEqual(('x', 10), (d.a, d.b))
+        self.assertEqual(['c', 'd', 'e'], sorted(d._lazy_fields_))
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            d.d  # pylint: disable=pointless-statement
+        self.assertEqual('d: expected integer, got string', str(cm.exception))
+        # Setting a field discards its undecoded value
+        d.d = [3]
+        self.assertEqual([3], d.d)
+        self.assertEqual("D(a='x', d=[3], e={'k': 'v'}, b=None, c=None)",
+                         repr(d).replace("u'", "'"))
+        self.assertEqual([], sorted(d._lazy_fields_))
+        # The primitive value isn't kept once every field is decoded
+        self.assertIsNone(d._lazy_raw_)
+        self.assertEqual('{"a": "x", "d": [3], "e": {"k": "v"}}', self.encode(validator, d))
+        # Required fields are checked up front
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.decode(validator, json.dumps({'b': 1}), lazy=True)
+        self.assertEqual("missing required field 'a'", str(cm.exception))
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.ss.load_lazy(self.decode(validator, s, lazy=True))
+        self.assertEqual('d: expected integer, got string', str(cm.exception))
+
+        validator = self.sv.List(self.sv.Union(self.ns.V))
+        vs = [
+            self.ns.V.t3(self.ns.S(f='f')),
+            self.ns.V.t7(self.ns.File(name='n', size=3)),
+            self.ns.V.t8(self.ns.Folder(name='fo')),
+        ]
+        encoded = self.compat_obj_encode(validator, vs)
+        decoded = self.compat_obj_decode(validator, encoded, lazy=True)
+        self.assertIsInstance(decoded[1].get_t7(), self.ns.File)
+        self.assertEqual(encoded, self.compat_obj_encode(validator, decoded))
+        decoded = self.ss.load_lazy(self.compat_obj_decode(validator, encoded, lazy=True))
+        self.assertEqual({}, decoded[1].get_t7()._lazy_fields_)
+        self.assertIsNone(decoded[1].get_t7()._lazy_raw_)
+        self.assertEqual(3, decoded[1].get_t7()._size_value)
+        self.assertEqual(encoded, self.compat_obj_encode(validator, decoded))
+
+        # The items of lists and maps of structs stay lazy when the list or map
+        # is read
+        validator = self.sv.Struct(self.ns.Listing)
+        entries = [{'id': '1', 'name': 'a'}, {'id': '2', 'name': 2}]
+        s = json.dumps({'entries': entries, 'by_id': {'1': entries[0]},
+                        'page': {'.tag': 'entries', 'entries': entries}})
+        listing = self.decode(validator, s, lazy=True)
+        self.assertEqual(['id', 'name'], sorted(listing.entries[1]._lazy_fields_))
+        self.assertEqual(['id', 'name'], sorted(listing.by_id['1']._lazy_fields_))
+        self.assertEqual(
+            ['id', 'name'], sorted(listing.page.get_entries()[0]._lazy_fields_))
+        self.assertEqual('1', listing.entries[0].id)
+        self.assertEqual(['name'], sorted(listing.entries[0]._lazy_fields_))
+        self.assertEqual('2', listing.entries[1].id)
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            listing.entries[1].name  # pylint: disable=pointless-statement
+        self.assertIn('expected to be a string', str(cm.exception))
+        with self.assertRaises(self.sv.ValidationError):
+            self.ss.load_lazy(self.decode(validator, s, lazy=True))
+
+        # Field masks apply to lazy structs too
+        validator = self.sv.List(self.sv.Union(self.ns.V))
+        decoded = self.compat_obj_decode(
+            validator, encoded, lazy=True, field_mask=['*.t7.size'])
+        self.assertEqual(3, decoded[1].get_t7().size)
+        with self.assertRaises(AttributeError):
+            decoded[1].get_t7().name  # pylint: disable=pointless-statement
+
+    def test_lazy_reencode(self):
+        validator = self.sv.Struct(self.ns.D)
+        raw = {'a': 'x', 'c': None, 'd': [1, 'bad'], 'e': {'k': 'v'}}
+        d = self.compat_obj_decode(validator, raw, lazy=True)
+        d.a = 'y'
+        # Fields that haven't been decoded are copied as they are
+        encoded = self.compat_obj_encode(validator, d)
+        self.assertEqual({'a': 'y', 'd': [1, 'bad'], 'e': {'k': 'v'}}, encoded)
+        self.assertIs(raw['e'], encoded['e'])
+        self.assertEqual(['d', 'e'], sorted(d._lazy_fields_))
+        self.assertEqual(
+            {'d': [1, 'bad']}, self.compat_obj_encode(validator, d, field_mask=['d']))
+        # ...unless they'd be encoded differently
+        for kwargs in [{'old_style': True}, {'should_redact': True}, {'for_msgpack': True}]:
+            d = self.compat_obj_decode(validator, raw, lazy=True)
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                self.compat_obj_encode(validator, d, **kwargs)
+            self.assertEqual('d: expected integer, got string', str(cm.exception))
+        # ...or were decoded by a non-strict decoder, which drops unknown fields
+        d = self.compat_obj_decode(validator, dict(raw, zzz=1), lazy=True, strict=False)
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.compat_obj_encode(validator, d)
+        self.assertEqual('d: expected integer, got string', str(cm.exception))
+        validator = self.sv.Struct(self.ns.Listing)
+        raw = {'entries': [{'id': '1', 'name': 'a', 'zzz': 1}], 'zzz': 1}
+        listing = self.compat_obj_decode(validator, raw, lazy=True, strict=False)
+        self.assertEqual({'entries': [{'id': '1', 'name': 'a'}]},
+                         self.compat_obj_encode(validator, listing))
+
+        validator = self.sv.List(self.sv.Union(self.ns.V))
+        vs = [
+            self.ns.V.t7(self.ns.File(name='n', size=3)),
+            self.ns.V.t8(self.ns.Folder(name='fo')),
+        ]
+        encoded = self.compat_obj_encode(validator, vs)
+        decoded = self.compat_obj_decode(validator, encoded, lazy=True)
+        decoded[0].get_t7().size = 5
+        reencoded = self.compat_obj_encode(validator, decoded)
+        self.assertEqual(5, reencoded[0]['t7']['size'])
+        self.assertEqual(encoded[1], reencoded[1])
+        self.assertEqual(['name'], list(decoded[1].get_t8()._lazy_fields_))
+
     def test_alias_validators(self):
 
         def aliased_string_validator(val):
@@ -3313,6 +4391,1049 @@ class TestAnnotationsGeneratedPython(unittest.TestCase):
             self.compat_obj_encode(self.sv.Union(self.ns3.U), ui,
                 caller_permissions=self.internal_and_alpha_cp, should_redact=True), json_data)
 
+    def test_json_log_encode_with_redaction(self):
+        s = self.ns3.S2(a=['test_str'], b={'key': 'test_str'})
+        self.assertEqual(
+            {'a': ['********'], 'b': {'key': '74e710825309d622d0b920390ef03edf'}},
+            json.loads(self.ss.json_log_encode(self.sv.Struct(self.ns3.S2), s,
+                caller_permissions=self.internal_and_alpha_cp)))
+
+        ui = self.ns3.U.t2([self.ns3.X(a='test_str', b='test_str')])
+        self.assertEqual(
+            {'.tag': 't2', 't2': [{'a': '********', 'b': '74e710825309d622d0b920390ef03edf'}]},
+            json.loads(self.ss.json_log_encode(self.sv.Union(self.ns3.U), ui,
+                caller_permissions=self.internal_and_alpha_cp)))
+
+
+test_frozen_spec = """\
+namespace frozen_ns
+
+struct Point
+    x Int32
+    y Int32 = 0
+    tags List(String)?
+    extra Map(String, List(Int32))?
+
+struct Point3 extends Point
+    z Int32
+
+union Shape
+    empty
+    poly List(Point)
+    named String
+"""
+
+
+class TestFrozenGeneratedPython(unittest.TestCase):
+
+    def setUp(self):
+
+        # Sanity check: stone must be importable for the compiler to work
+        __import__('stone')
+
+        # Compile spec by calling out to stone
+        p = subprocess.Popen(
+            [sys.executable,
+             '-m',
+             'stone.cli',
+             'python_types',
+             'output',
+             '-',
+             '--',
+             '--frozen'],
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        _, stderr = p.communicate(input=test_frozen_spec.encode('utf-8'))
+        if p.wait() != 0:
+            raise AssertionError('Could not execute stone tool: %s' %
+                                 stderr.decode('utf-8'))
+
+        sys.path.append('output')
+        self.ns = __import__('frozen_ns')
+        self.bb = __import__('stone_base')
+        self.sv = __import__('stone_validators')
+        self.ss = __import__('stone_serializers')
+
+    def test_frozen_struct(self):
+        p = self.ns.Point(x=1, tags=['a'], extra={'k': [1, 2]})
+        self.assertEqual(('a',), p.tags)
+        self.assertEqual({'k': (1, 2)}, p.extra)
+        self.assertIsInstance(p.extra, self.bb.FrozenDict)
+        with self.assertRaises(AttributeError):
+            p.x = 2
+        with self.assertRaises(AttributeError):
+            del p.x
+        with self.assertRaises(TypeError):
+            p.extra['j'] = (3,)
+        with self.assertRaises(self.sv.ValidationError):
+            self.ns.Point(x='1')
+
+        same = self.ns.Point(x=1, tags=('a',), extra={'k': (1, 2)})
+        self.assertEqual(same, p)
+        self.assertEqual(hash(same), hash(p))
+        self.assertNotEqual(self.ns.Point(x=1), p)
+        self.assertNotEqual(self.ns.Point3(x=1, z=3), self.ns.Point(x=1))
+        self.assertEqual(1, len({p, same}))
+
+        q = p.replace(x=2, tags=None)
+        self.assertEqual(self.ns.Point(x=2, extra={'k': [1, 2]}), q)
+        self.assertEqual(1, p.x)
+        self.assertEqual(
+            self.ns.Point3(x=1, z=4), self.ns.Point3(x=1, z=3).replace(z=4))
+        with self.assertRaises(TypeError):
+            p.replace(w=1)
+
+    def test_frozen_union(self):
+        s = self.ns.Shape.poly([self.ns.Point(x=1)])
+        self.assertEqual((self.ns.Point(x=1),), s.get_poly())
+        self.assertEqual(hash(self.ns.Shape.poly([self.ns.Point(x=1)])), hash(s))
+        self.assertEqual(self.ns.Shape.named('n'), self.ns.Shape.named('n'))
+
+    def test_frozen_serialization(self):
+        validator = self.sv.Struct(self.ns.Point)
+        p = self.ns.Point(x=1, tags=['a'], extra={'k': [1, 2]})
+        encoded = {'x': 1, 'tags': ['a'], 'extra': {'k': [1, 2]}}
+        self.assertEqual(encoded, self.ss.json_compat_obj_encode(validator, p))
+        for kwargs in [{}, {'lazy': True}]:
+            decoded = self.ss.json_compat_obj_decode(validator, encoded, **kwargs)
+            self.assertIs(type(decoded), self.ns.Point)
+            self.assertEqual(p, decoded)
+        decoded = self.ss.json_compat_obj_decode(validator, encoded, field_mask=['x'])
+        self.assertFalse(self.bb.is_loaded(decoded, 'tags'))
+        self.assertEqual(p, self.ss.msgpack_decode(
+            validator, self.ss.msgpack_encode(validator, p)))
+        self.assertEqual(p, self.ss.binary_decode(
+            validator, self.ss.binary_encode(validator, p)))
+
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.ss.json_compat_obj_encode(validator, self.ns.Point(y=1))
+        self.assertEqual("missing required field 'x'", str(cm.exception))
+
+        validator = self.sv.Union(self.ns.Shape)
+        s = self.ns.Shape.poly([self.ns.Point(x=1)])
+        encoded = self.ss.json_compat_obj_encode(validator, s)
+        self.assertEqual({'.tag': 'poly', 'poly': [{'x': 1}]}, encoded)
+        self.assertEqual(
+            s,
+            self.ss.json_compat_obj_decode(validator, encoded))
+
+    def test_encoded_form_cache(self):
+        cache = self.ss.EncodedFormCache(max_bytes=100)
+        cache_was, self.ss.encoded_form_cache = self.ss.encoded_form_cache, cache
+        try:
+            validator = self.sv.Struct(self.ns.Point)
+            p = self.ns.Point(x=1, tags=['a'])
+            encoded = self.ss.json_encode(validator, p)
+            self.assertIs(encoded, self.ss.json_encode(validator, p))
+            # Keyed by encoder configuration
+            self.assertEqual('{"x": 1}', self.ss.json_encode(validator, p, field_mask=['x']))
+            self.assertEqual(
+                self.ss.msgpack_encode(validator, p), self.ss.msgpack_encode(validator, p))
+            self.assertEqual(2, cache.hits)
+            self.assertEqual(3, cache.stats()['entries'])
+            # Equal masks share entries, even when they're compiled separately
+            mask = self.ss.compile_field_mask(validator, ['x'])
+            self.ss._field_masks.clear()
+            other_mask = self.ss.compile_field_mask(validator, ['x'])
+            self.assertIsNot(mask, other_mask)
+            self.ss.json_encode(validator, p, field_mask=other_mask)
+            self.assertEqual(3, cache.hits)
+            self.assertEqual(3, cache.stats()['entries'])
+            # Mutable values aren't cached
+            self.ss.json_encode(self.sv.List(self.sv.Int32()), [1])
+            self.assertEqual(3, cache.stats()['entries'])
+
+            del p
+            gc.collect()
+            self.assertEqual(0, cache.stats()['entries'])
+
+            points = [self.ns.Point(x=i, tags=['a' * 20]) for i in range(4)]
+            for p in points:
+                self.ss.json_encode(validator, p)
+            stats = cache.stats()
+            # Each takes up 42 bytes
+            self.assertEqual(2, stats['evictions'])
+            self.assertEqual(2, stats['entries'])
+            self.assertEqual(84, stats['size'])
+        finally:
+            self.ss.encoded_form_cache = cache_was
+
+
+test_async_route_schema = """\
+namespace stone_cfg
+
+struct Route
+    style String = "rpc"
+    coalesce Boolean = false
+    batch String?
+    cache_ttl Float64?
+"""
+
+test_async_spec = """\
+namespace async_ns
+
+struct EchoArg
+    text String
+
+struct EchoResult
+    text String
+
+union EchoError
+    too_long
+
+route echo(EchoArg, EchoResult, EchoError)
+
+route echo:2(EchoArg, EchoResult, EchoError)
+
+route missing(Void, Void, Void)
+
+route upload(EchoArg, EchoResult, Void)
+    attrs
+        style = "upload"
+
+route download(EchoArg, EchoResult, Void)
+    attrs
+        style = "download"
+        coalesce = true
+
+route get(EchoArg, EchoResult, EchoError)
+    attrs
+        coalesce = true
+
+route get_cached(EchoArg, EchoResult, EchoError)
+    attrs
+        cache_ttl = 60
+
+struct LookupBatchArg
+    entries List(EchoArg)
+
+union LookupBatchResultEntry
+    success EchoResult
+    failure EchoError
+
+struct LookupBatchResult
+    entries List(LookupBatchResultEntry)
+
+route lookup(EchoArg, EchoResult, EchoError)
+    attrs
+        batch = "lookup_batch"
+
+route lookup_batch(LookupBatchArg, LookupBatchResult, Void)
+"""
+
+
+class _StandInServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # An in-process HTTP server for the routes of test_async_spec.
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _StandInHandler)
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.uploads = []
+        self.client_ports = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def handle_error(self, request, client_address):
+        # Connections of cancelled requests are reset by the client.
+        pass
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        server = self.server
+        with server.lock:
+            server.requests[self.path.rsplit('/', 1)[1]] += 1
+            server.client_ports.add(self.client_address[1])
+            server.in_flight += 1
+            server.max_in_flight = max(server.in_flight, server.max_in_flight)
+        try:
+            # Long enough for concurrent requests to overlap.
+            time.sleep(0.005)
+            self._respond(self.path.rsplit('/', 1)[1], self._read_body())
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers['Content-Length']))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';', 1)[0], 16)
+            if size == 0:
+                self.rfile.readline()
+                return b''.join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def _respond(self, route_name, body):
+        headers = {}
+        chunks = None
+        if route_name in ('echo', 'echo_v2', 'get', 'get_cached', 'lookup'):
+            text = json.loads(body.decode('utf-8'))['text']
+            if len(text) > 5:
+                status, out = 409, {'error': {'.tag': 'too_long'}}
+            else:
+                status, out = 200, {'text': text + ('_v2' if route_name == 'echo_v2' else '')}
+        elif route_name == 'lookup_batch':
+            entries = []
+            for entry in json.loads(body.decode('utf-8'))['entries']:
+                if len(entry['text']) > 5:
+                    entries.append({'.tag': 'failure', 'failure': {'.tag': 'too_long'}})
+                else:
+                    entries.append({'.tag': 'success', 'text': entry['text']})
+            status, out = 200, {'entries': entries}
+        elif route_name == 'upload':
+            self.server.uploads.append(body)
+            text = json.loads(self.headers['Stone-API-Arg'])['text']
+            status, out = 200, {'text': text}
+        elif route_name == 'download':
+            text = json.loads(self.headers['Stone-API-Arg'])['text']
+            headers['Stone-API-Result'] = json.dumps({'text': text})
+            status = 200
+            if text == 'chunked':
+                chunks = [b'a' * 10, b'b' * 100000, b'c']
+                out = b''
+            elif text == 'stall':
+                chunks = [b'a', None, b'b']
+                out = b''
+            elif text.startswith('n='):
+                out = _download_body(int(text[2:]))
+            else:
+                out = text * 3
+        else:
+            status, out = 404, 'Unknown route'
+        if not isinstance(out, (six.text_type, bytes)):
+            out = json.dumps(out)
+        if isinstance(out, six.text_type):
+            out = out.encode('utf-8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if chunks is None:
+            self.send_header('Content-Length', str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+        else:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in chunks + [b'']:
+                if chunk is None:
+                    # Stall in the middle of the body.
+                    time.sleep(0.5)
+                    continue
+                self.wfile.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+
+
+def _download_body(n):
+    return (bytes(bytearray(range(256))) * (n // 256 + 1))[:n]
+
+
+@unittest.skipIf(not HAS_ASYNCIO, 'Requires asyncio')
+class TestAsyncGeneratedPython(unittest.TestCase):
+
+    def setUp(self):
+
+        # Sanity check: stone must be importable for the compiler to work
+        __import__('stone')
+
+        # Compile specs by calling out to stone
+        os.makedirs(os.path.join('output', 'async_pkg'))
+        with open(os.path.join('output', 'async_pkg', '__init__.py'), 'w'):
+            pass
+        specs = []
+        for name, spec in [('stone_cfg', test_async_route_schema), ('async_ns', test_async_spec)]:
+            specs.append(os.path.join('output', name + '.stone'))
+            with open(specs[-1], 'w') as f:
+                f.write(spec)
+        for backend_args in [['python_types', os.path.join('output', 'async_pkg')] + specs,
+                             ['python_client', os.path.join('output', 'async_pkg')] + specs +
+                             ['--', '-m', 'client', '-c', 'Base', '-t', 'async_pkg',
+                              '--asyncio', '--cache-size', '2']]:
+            p = subprocess.Popen(
+                [sys.executable, '-m', 'stone.cli',
+                 '-a', 'style', '-a', 'coalesce', '-a', 'batch', '-a', 'cache_ttl'] +
+                backend_args,
+                stderr=subprocess.PIPE)
+            _, stderr = p.communicate()
+            if p.wait() != 0:
+                raise AssertionError('Could not execute stone tool: %s' %
+                                     stderr.decode('utf-8'))
+
+        sys.path.append('output')
+        self.ns = importlib.import_module('async_pkg.async_ns')
+        self.sa = importlib.import_module('async_pkg.stone_async')
+        client = importlib.import_module('async_pkg.client')
+
+        self.server = _StandInServer()
+        threading.Thread(target=self.server.serve_forever).start()
+
+        class Client(self.sa.HttpTransport, client.Base):
+            pass
+
+        class CoalescingClient(self.sa.CoalescingTransport, self.sa.HttpTransport, client.Base):
+            pass
+
+        self.base_url = 'http://127.0.0.1:%d/2' % self.server.server_address[1]
+        self.client_class = Client
+        self.coalescing_client_class = CoalescingClient
+        self.clients = []
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        # Let the closed transports clean up.
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        self.server.shutdown()
+        self.server.server_close()
+        sys.path.remove('output')
+        for name in list(sys.modules):
+            if name.startswith('async_pkg'):
+                del sys.modules[name]
+        # Clear output of stone tool after all tests.
+        shutil.rmtree('output')
+
+    def _client(self, coalescing=False, **kwargs):
+        if coalescing:
+            client = self.coalescing_client_class(self.base_url, **kwargs)
+        else:
+            client = self.client_class(self.base_url, **kwargs)
+        self.clients.append(client)
+        return client
+
+    def _run(self, aw):
+        return self.loop.run_until_complete(aw)
+
+    def test_rpc(self):
+        client = self._client()
+
+        results = self._run(self.sa.gather_bounded([
+            client.async_ns_echo('hi'),
+            client.async_ns_echo_v2('h\u00e9'),
+        ]))
+        self.assertEqual(['hi', 'h\u00e9_v2'], [r.text for r in results])
+
+        with self.assertRaises(self.sa.ApiError) as cm:
+            self._run(client.async_ns_echo('too long'))
+        self.assertTrue(cm.exception.error.is_too_long())
+        with self.assertRaises(self.sa.HttpError) as cm:
+            self._run(client.async_ns_missing())
+        self.assertEqual(404, cm.exception.status)
+        self.assertEqual(b'Unknown route', cm.exception.body)
+
+    def test_upload_and_download(self):
+        client = self._client()
+        self.assertEqual('a\u00e9',
+                         self._run(client.async_ns_upload(b'bc', 'a\u00e9')).text)
+        self.assertEqual([b'bc'], self.server.uploads)
+        result, body = self._run(client.async_ns_download('ab'))
+        self.assertEqual('ab', result.text)
+        self.assertEqual(b'ababab', self._run(body.read()))
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            result = self._run(client.async_ns_download_to_file(path, 'q'))
+            self.assertEqual('q', result.text)
+            with open(path, 'rb') as f:
+                self.assertEqual(b'qqq', f.read())
+        finally:
+            os.remove(path)
+
+    def test_download_to_file_with_other_transports(self):
+        # A transport that isn't an HttpTransport gets the generated default
+        # for saving download bodies.
+        data = _download_body(300000)
+        loop = self.loop
+
+        class AsyncChunks(object):
+            def __init__(self):
+                self.chunks = iter([data[:100000], data[100000:]])
+                self.closed = False
+
+            def __aiter__(self):
+                return self
+
+            def __anext__(self):
+                future = asyncio.Future(loop=loop)
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    future.set_exception(StopAsyncIteration())
+                else:
+                    future.set_result(chunk)
+                return future
+
+            def close(self):
+                self.closed = True
+
+        class Transport(importlib.import_module('async_pkg.client').Base):
+            def __init__(self, body):
+                self.body = body
+
+            def request_async(self, route, namespace, arg, arg_binary=None):
+                future = asyncio.Future(loop=loop)
+                future.set_result((arg.text, self.body))
+                return future
+
+        body = AsyncChunks()
+        for transport_body in [data, io.BytesIO(data), body]:
+            f = io.BytesIO()
+            result = self._run(Transport(transport_body).async_ns_download_to_file(f, 'q'))
+            self.assertEqual('q', result)
+            self.assertEqual(data, f.getvalue())
+        self.assertTrue(body.closed)
+
+    def test_streaming_uploads(self):
+        client = self._client()
+        data = _download_body(300000)
+
+        def chunks():
+            for i in range(0, len(data), 70000):
+                yield data[i:i + 70000]
+
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.seek(1000)
+            bodies = [memoryview(data), bytearray(data), io.BytesIO(data), chunks(), f]
+            for body in bodies:
+                self._run(client.async_ns_upload(body, 'up'))
+        self.assertEqual([data] * 4 + [data[1000:]], self.server.uploads)
+
+        # Async iterables of chunks
+        class AsyncChunks(object):
+            def __init__(self):
+                self.chunks = chunks()
+
+            def __aiter__(self):
+                return self
+
+            def __anext__(self):
+                future = asyncio.Future(loop=self.loop)
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    future.set_exception(StopAsyncIteration())
+                else:
+                    future.set_result(chunk)
+                return future
+
+        AsyncChunks.loop = self.loop
+        self._run(client.async_ns_upload(AsyncChunks(), 'up'))
+        self.assertEqual(data, self.server.uploads[-1])
+        self.assertEqual(1, client.pool.opened)
+
+    def test_streaming_downloads(self):
+        client = self._client()
+        result, body = self._run(client.async_ns_download('n=300000'))
+        chunks = []
+        while True:
+            chunk = self._run(body.read_chunk(100000))
+            if not chunk:
+                break
+            self.assertLessEqual(len(chunk), 100000)
+            chunks.append(chunk)
+        self.assertEqual(_download_body(300000), b''.join(chunks))
+
+        _, body = self._run(client.async_ns_download('chunked'))
+        self.assertEqual(b'a' * 10 + b'b' * 100000 + b'c', self._run(body.read()))
+        # Bodies read to the end give back their connection
+        self.assertEqual(1, client.pool.opened)
+
+        f = io.BytesIO()
+        result = self._run(client.async_ns_download_to_file(f, 'n=1000000'))
+        self.assertEqual('n=1000000', result.text)
+        self.assertEqual(_download_body(1000000), f.getvalue())
+        self.assertEqual(1, client.pool.opened)
+
+        # A body that's closed early closes its connection
+        _, body = self._run(client.async_ns_download('n=300000'))
+        self.assertTrue(self._run(body.read_chunk()))
+        body.close()
+        self.assertEqual(b'', self._run(body.read()))
+        self._run(client.async_ns_echo('hi'))
+        self.assertEqual(2, client.pool.opened)
+
+        # Each read of the body has the transport's timeout
+        client = self._client(timeout=0.2)
+        _, body = self._run(client.async_ns_download('stall'))
+        self.assertEqual(b'a', self._run(body.read_chunk()))
+        with self.assertRaises(asyncio.TimeoutError):
+            self._run(body.read_chunk())
+        self.assertEqual(b'', self._run(body.read()))
+
+    def test_connection_pooling(self):
+        client = self._client(max_connections=4)
+        results = self._run(self.sa.fan_out(
+            client.async_ns_echo, [six.text_type(i) for i in range(200)], limit=20))
+        self.assertEqual([six.text_type(i) for i in range(200)], [r.text for r in results])
+        self.assertLessEqual(client.pool.opened, 4)
+        self.assertEqual(client.pool.opened, len(self.server.client_ports))
+        self.assertLessEqual(self.server.max_in_flight, 4)
+
+        # Connections are reused across calls
+        self._run(client.async_ns_echo('again'))
+        self.assertLessEqual(client.pool.opened, 4)
+
+    def test_fan_out(self):
+        client = self._client()
+        texts = (six.text_type(i) for i in range(30))
+        results = self._run(self.sa.gather_bounded(
+            (client.async_ns_echo(text) for text in texts), limit=3))
+        self.assertEqual([six.text_type(i) for i in range(30)], [r.text for r in results])
+        self.assertLessEqual(self.server.max_in_flight, 3)
+
+        results = self._run(self.sa.fan_out(
+            client.async_ns_echo, ['ok', 'too long'], return_exceptions=True))
+        self.assertEqual('ok', results[0].text)
+        self.assertIsInstance(results[1], self.sa.ApiError)
+
+        # The first error stops the calls that haven't started.
+        started = []
+
+        def echo(text):
+            started.append(text)
+            return client.async_ns_echo(text)
+
+        with self.assertRaises(self.sa.ApiError):
+            self._run(self.sa.fan_out(
+                echo, ['x' * (i % 10) for i in range(1000)], limit=5))
+        self.assertLess(len(started), 1000)
+
+        # No coroutine is taken from the generator once a call has failed.
+        del started[:]
+        with self.assertRaises(self.sa.ApiError):
+            self._run(self.sa.gather_bounded(
+                (echo(text) for text in ['too long', 'ok']), limit=1))
+        self.assertEqual(['too long'], started)
+
+        with self.assertRaises(ValueError):
+            self._run(self.sa.fan_out(echo, [], limit=0))
+
+    def test_single_flight(self):
+        client = self._client(coalescing=True)
+        results = self._run(self.sa.gather_bounded(
+            [client.async_ns_get('a') for _ in range(10)] +
+            [client.async_ns_get('b') for _ in range(5)] +
+            [client.async_ns_echo('a') for _ in range(3)]))
+        self.assertEqual(['a'] * 13 + ['b'] * 5, sorted(r.text for r in results))
+        self.assertIs(results[0], results[9])
+        self.assertEqual(2, self.server.requests['get'])
+        self.assertEqual(13, client.coalesced_calls)
+        # Routes without a coalesce attribute aren't coalesced
+        self.assertEqual(3, self.server.requests['echo'])
+
+        # Calls are only coalesced while in flight
+        self._run(client.async_ns_get('a'))
+        self.assertEqual(3, self.server.requests['get'])
+
+        # Download bodies can only be read once, so downloads aren't coalesced
+        downloads = self._run(self.sa.gather_bounded(
+            [client.async_ns_download('ab') for _ in range(2)]))
+        self.assertEqual(2, self.server.requests['download'])
+        for _, body in downloads:
+            self.assertEqual(b'ababab', self._run(body.read()))
+
+        results = self._run(self.sa.gather_bounded(
+            [client.async_ns_get('too long') for _ in range(2)], return_exceptions=True))
+        self.assertIs(results[0], results[1])
+        self.assertTrue(results[0].error.is_too_long())
+        self.assertEqual({}, client._in_flight)
+
+    def test_route_cache(self):
+        client = self._client()
+        results = self._run(self.sa.gather_bounded(
+            [client.async_ns_get_cached('a') for _ in range(5)]))
+        self.assertEqual(['a'] * 5, [r.text for r in results])
+        self.assertIs(results[0], results[4])
+        self.assertEqual(1, self.server.requests['get_cached'])
+        self.assertIs(results[0], self._run(client.async_ns_get_cached('a')))
+        self.assertEqual(1, self.server.requests['get_cached'])
+        self.assertEqual(5, client.route_cache.hits['async_ns/get_cached:1'])
+        self.assertEqual(1, client.route_cache.misses['async_ns/get_cached:1'])
+
+        # The cache holds 2 results.
+        for text in ['b', 'c', 'a']:
+            self._run(client.async_ns_get_cached(text))
+        self.assertEqual(4, self.server.requests['get_cached'])
+
+        # Errors aren't cached
+        for _ in range(2):
+            with self.assertRaises(self.sa.ApiError):
+                self._run(client.async_ns_get_cached('too long'))
+        self.assertEqual(6, self.server.requests['get_cached'])
+
+        # Routes without a cache_ttl attribute aren't cached, and each
+        # client has its own cache.
+        self._run(client.async_ns_get('a'))
+        self._run(client.async_ns_get('a'))
+        self.assertEqual(2, self.server.requests['get'])
+        self._run(self._client().async_ns_get_cached('a'))
+        self.assertEqual(7, self.server.requests['get_cached'])
+
+    def test_batching(self):
+        client = self._client(coalescing=True, max_batch_size=4)
+        results = self._run(self.sa.gather_bounded(
+            [client.async_ns_lookup(text) for text in ['a', 'b', 'too long', 'a', 'c']],
+            return_exceptions=True))
+        self.assertEqual('a', results[0].text)
+        self.assertEqual('b', results[1].text)
+        self.assertTrue(results[2].error.is_too_long())
+        self.assertIsNone(results[2].body)
+        self.assertIs(results[0], results[3])
+        self.assertEqual('c', results[4].text)
+        # 4 distinct calls fill a batch
+        self.assertEqual(1, self.server.requests['lookup_batch'])
+        self.assertEqual(0, self.server.requests['lookup'])
+        self.assertEqual(1, client.batch_requests)
+        self.assertEqual(1, client.coalesced_calls)
+
+        results = self._run(self.sa.gather_bounded(
+            client.async_ns_lookup(six.text_type(i)) for i in range(10)))
+        self.assertEqual([six.text_type(i) for i in range(10)], [r.text for r in results])
+        self.assertEqual(4, self.server.requests['lookup_batch'])
+
+        # A call that's alone in its window isn't batched
+        self.assertEqual('z', self._run(client.async_ns_lookup('z')).text)
+        self.assertEqual(1, self.server.requests['lookup'])
+        self.assertEqual(4, client.batch_requests)
+
+
+class _QuietWSGIRequestHandler(simple_server.WSGIRequestHandler):
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class TestServerGeneratedPython(unittest.TestCase):
+
+    def setUp(self):
+
+        # Sanity check: stone must be importable for the compiler to work
+        __import__('stone')
+
+        # Compile specs by calling out to stone
+        os.makedirs(os.path.join('output', 'server_pkg'))
+        with open(os.path.join('output', 'server_pkg', '__init__.py'), 'w'):
+            pass
+        specs = []
+        for name, spec in [('stone_cfg', test_async_route_schema), ('async_ns', test_async_spec)]:
+            specs.append(os.path.join('output', name + '.stone'))
+            with open(specs[-1], 'w') as f:
+                f.write(spec)
+        for backend_args in [['python_types', os.path.join('output', 'server_pkg')] + specs +
+                             ['--', '--server'],
+                             ['python_client', os.path.join('output', 'server_pkg')] + specs +
+                             ['--', '-m', 'client', '-c', 'Base', '-t', 'server_pkg',
+                              '--asyncio']]:
+            p = subprocess.Popen(
+                [sys.executable, '-m', 'stone.cli', '-a', 'style'] + backend_args,
+                stderr=subprocess.PIPE)
+            _, stderr = p.communicate()
+            if p.wait() != 0:
+                raise AssertionError('Could not execute stone tool: %s' %
+                                     stderr.decode('utf-8'))
+
+        sys.path.append('output')
+        self.ns = importlib.import_module('server_pkg.async_ns')
+        self.server_module = importlib.import_module('server_pkg.stone_server')
+        self.uploads = []
+        self.dispatcher = self.server_module.Dispatcher({'async_ns': self.ns})
+        self.dispatcher.register('async_ns/echo', self._echo)
+        self.dispatcher.register('async_ns/echo:2', self._echo)
+        self.dispatcher.register('async_ns/missing', lambda arg, request: None)
+        self.dispatcher.register('async_ns/upload', self._upload)
+        self.dispatcher.register('async_ns/download', self._download)
+
+    def tearDown(self):
+        sys.path.remove('output')
+        for name in list(sys.modules):
+            if name.startswith('server_pkg'):
+                del sys.modules[name]
+        # Clear output of stone tool after all tests.
+        shutil.rmtree('output')
+
+    def _echo(self, arg, request):
+        # The WSGI environ or the ASGI scope
+        self.assertTrue('PATH_INFO' in request or 'path' in request)
+        if len(arg.text) > 5:
+            raise self.server_module.RouteError(self.ns.EchoError.too_long)
+        return self.ns.EchoResult(arg.text)
+
+    def _upload(self, arg, body, _request):
+        if not hasattr(body, 'read_chunk'):
+            self.uploads.append(b''.join(body))
+            return self.ns.EchoResult(arg.text)
+        # The body of an ASGI request is read asynchronously.
+        result = asyncio.get_event_loop().create_future()
+
+        def done(read):
+            self.uploads.append(read.result())
+            result.set_result(self.ns.EchoResult(arg.text))
+        asyncio.ensure_future(body.read()).add_done_callback(done)
+        return result
+
+    def _download(self, arg, _request):
+        result = self.ns.EchoResult(arg.text)
+        if arg.text == 'file':
+            f = tempfile.TemporaryFile()
+            f.write(_download_body(100000))
+            f.seek(0)
+            return result, f
+        elif arg.text == 'iter':
+            return result, iter([b'a', bytearray(b'b'), memoryview(b'c')])
+        return result, arg.text.encode('utf-8') * 3
+
+    def _wsgi(self, app, path, body=b'', method='POST', headers=None):
+        environ = {}
+        wsgiref.util.setup_testing_defaults(environ)
+        environ.update({
+            'REQUEST_METHOD': str(method),
+            'PATH_INFO': str(path),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': io.BytesIO(body),
+        })
+        for name, value in (headers or {}).items():
+            environ[str('HTTP_' + name.upper().replace('-', '_'))] = str(value)
+        response = []
+
+        def start_response(status, response_headers):
+            response[:] = [int(status.split(' ')[0]), dict(response_headers)]
+
+        out = app(environ, start_response)
+        try:
+            data = b''.join(out)
+        finally:
+            if hasattr(out, 'close'):
+                out.close()
+        return response[0], response[1], data
+
+    def test_dispatcher(self):
+        dispatcher = self.dispatcher
+        self.assertEqual(
+            ['async_ns/echo:1', 'async_ns/echo:2', 'async_ns/get:1', 'async_ns/get_cached:1',
+             'async_ns/lookup:1', 'async_ns/lookup_batch:1'],
+            sorted(set(dispatcher.routes) - {
+                'async_ns/missing:1', 'async_ns/upload:1', 'async_ns/download:1'}))
+        self.assertIs(self.ns.echo_v2, dispatcher.routes['async_ns/echo:2'].route)
+        self.assertIs(dispatcher.routes['async_ns/echo:2'], dispatcher.paths['async_ns/echo_v2'])
+        self.assertEqual('upload', dispatcher.routes['async_ns/upload:1'].style)
+        self.assertEqual(['async_ns/get:1', 'async_ns/get_cached:1', 'async_ns/lookup:1',
+                          'async_ns/lookup_batch:1'], dispatcher.unhandled())
+        self.assertRaises(ValueError, dispatcher.register, 'async_ns/echo:3', self._echo)
+
+        @dispatcher.handler('async_ns/get')
+        def get(arg, request):  # pylint: disable=unused-argument
+            return self.ns.EchoResult(arg.text)
+        self.assertIs(get, dispatcher.routes['async_ns/get:1'].handler)
+
+        # The ROUTES dict of a module can be passed instead of the module
+        self.assertEqual(
+            sorted(dispatcher.routes),
+            sorted(self.server_module.Dispatcher({'async_ns': self.ns.ROUTES}).routes))
+
+    def test_wsgi(self):
+        app = self.server_module.WsgiApp(self.dispatcher, prefix='/2/')
+
+        status, headers, body = self._wsgi(app, '/2/async_ns/echo', b'{"text": "hi"}')
+        self.assertEqual(200, status)
+        self.assertEqual('application/json', headers['Content-Type'])
+        self.assertEqual(str(len(body)), headers['Content-Length'])
+        self.assertEqual({'text': 'hi'}, json.loads(body.decode('utf-8')))
+        status, _, body = self._wsgi(app, '/2/async_ns/echo_v2', b'{"text": "h\\u00e9"}')
+        self.assertEqual((200, {'text': 'h\u00e9'}), (status, json.loads(body.decode('utf-8'))))
+        status, _, body = self._wsgi(app, '/2/async_ns/missing', b'null')
+        self.assertEqual((200, b'null'), (status, body))
+
+        status, headers, body = self._wsgi(app, '/2/async_ns/echo', b'{"text": "too long"}')
+        self.assertEqual(409, status)
+        self.assertEqual({'error': {'.tag': 'too_long'}}, json.loads(body.decode('utf-8')))
+
+        for path, request_body, expected in [
+                ('/2/async_ns/echo', b'{"text": 1}', 400),
+                ('/2/async_ns/echo', b'{"text"', 400),
+                ('/2/async_ns/echo', b'{"text": "a", "other": 1}', 400),
+                ('/2/async_ns/get', b'{"text": "a"}', 404),
+                ('/2/async_ns/echo_v3', b'{"text": "a"}', 404),
+                ('/async_ns/echo', b'{"text": "a"}', 404)]:
+            status, _, body = self._wsgi(app, path, request_body)
+            self.assertEqual(expected, status, (path, request_body, body))
+        status, headers, _ = self._wsgi(app, '/2/async_ns/echo', method='GET')
+        self.assertEqual((405, 'POST'), (status, headers['Allow']))
+
+        data = _download_body(100000)
+        status, _, body = self._wsgi(app, '/2/async_ns/upload', data,
+                                     headers={'Stone-API-Arg': '{"text": "up"}'})
+        self.assertEqual((200, {'text': 'up'}), (status, json.loads(body.decode('utf-8'))))
+        self.assertEqual([data], self.uploads)
+        status, _, _ = self._wsgi(app, '/2/async_ns/upload', data)
+        self.assertEqual(400, status)
+
+        for text, expected in [('ab', b'ababab'), ('file', data), ('iter', b'abc')]:
+            status, headers, body = self._wsgi(
+                app, '/2/async_ns/download', headers={'Stone-API-Arg': json.dumps({'text': text})})
+            self.assertEqual(200, status)
+            self.assertEqual({'text': text}, json.loads(headers['Stone-API-Result']))
+            self.assertEqual(expected, body)
+            self.assertEqual(None if text == 'iter' else str(len(expected)),
+                             headers.get('Content-Length'))
+
+        # The body is closed if the result can't be encoded.
+        f = io.BytesIO(data)
+        self.dispatcher.register('async_ns/download', lambda arg, request: (None, f))
+        validators = importlib.import_module('server_pkg.stone_validators')
+        with self.assertRaises(validators.ValidationError):
+            self._wsgi(app, '/2/async_ns/download', headers={'Stone-API-Arg': '{"text": "a"}'})
+        self.assertTrue(f.closed)
+
+    @unittest.skipIf(not HAS_ASYNCIO, 'Requires asyncio')
+    def test_asgi(self):
+        stone_asgi = importlib.import_module('server_pkg.stone_asgi')
+        app = stone_asgi.AsgiApp(self.dispatcher, prefix='/2')
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        def completed(result):
+            future = loop.create_future()
+            future.set_result(result)
+            return future
+
+        class DownloadIter(object):
+            # An async iterable of chunks.
+            def __init__(self):
+                self.chunks = [b'x', b'yz']
+
+            def __aiter__(self):
+                return self
+
+            def __anext__(self):
+                if not self.chunks:
+                    raise StopAsyncIteration  # noqa: F821 # pylint: disable=undefined-variable
+                return completed(self.chunks.pop(0))
+
+        read_threads = set()
+
+        class ThreadFile(io.BytesIO):
+            # Records the threads it's read in.
+            def read(self, *args):
+                read_threads.add(threading.current_thread())
+                return io.BytesIO.read(self, *args)
+
+        def download(arg, request):
+            if arg.text == 'async':
+                return self.ns.EchoResult(arg.text), DownloadIter()
+            elif arg.text == 'thread':
+                return self.ns.EchoResult(arg.text), ThreadFile(b'abc')
+            return self._download(arg, request)
+        self.dispatcher.register('async_ns/download', download)
+
+        def echo(arg, request):
+            # Handlers can return awaitables.
+            future = loop.create_future()
+            try:
+                future.set_result(self._echo(arg, request))
+            except self.server_module.RouteError as e:
+                future.set_exception(e)
+            return future
+        self.dispatcher.register('async_ns/echo:2', echo)
+
+        def call(scope, messages):
+            sent = []
+            loop.run_until_complete(app(
+                scope, lambda: completed(messages.pop(0)),
+                lambda message: completed(sent.append(message))))
+            return sent
+
+        def http(path, chunks=(b'',), method='POST', headers=()):
+            sent = call(
+                {'type': 'http', 'method': method, 'path': path,
+                 'headers': [(k.lower().encode('ascii'), v.encode('ascii')) for k, v in headers]},
+                [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+                 for i, chunk in enumerate(chunks)])
+            self.assertEqual('http.response.start', sent[0]['type'])
+            self.assertFalse(sent[-1].get('more_body', False))
+            return (sent[0]['status'], dict(sent[0]['headers']),
+                    b''.join(m['body'] for m in sent[1:]))
+
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        status, headers, body = http('/2/async_ns/echo', [b'{"text":', b' "hi"}'])
+        self.assertEqual((200, b'application/json'), (status, headers[b'content-type']))
+        self.assertEqual({'text': 'hi'}, json.loads(body.decode('utf-8')))
+        status, _, body = http('/2/async_ns/echo_v2', [b'{"text": "too long"}'])
+        self.assertEqual((409, {'error': {'.tag': 'too_long'}}),
+                         (status, json.loads(body.decode('utf-8'))))
+        self.assertEqual(400, http('/2/async_ns/echo', [b'[]'])[0])
+        self.assertEqual(404, http('/2/async_ns/get', [b'{"text": "a"}'])[0])
+        self.assertEqual(405, http('/2/async_ns/echo', method='GET')[0])
+
+        data = _download_body(100000)
+        status, _, body = http('/2/async_ns/upload', [data[:10], data[10:], b''],
+                               headers=[('Stone-API-Arg', '{"text": "up"}')])
+        self.assertEqual((200, {'text': 'up'}), (status, json.loads(body.decode('utf-8'))))
+        self.assertEqual([data], self.uploads)
+
+        for text, expected in [('ab', b'ababab'), ('file', data), ('iter', b'abc'),
+                               ('async', b'xyz'), ('thread', b'abc')]:
+            status, headers, body = http(
+                '/2/async_ns/download', headers=[('Stone-API-Arg', json.dumps({'text': text}))])
+            self.assertEqual(200, status)
+            self.assertEqual({'text': text}, json.loads(headers[b'stone-api-result'].decode()))
+            self.assertEqual(expected, body)
+        # Files are read off the event loop.
+        self.assertTrue(read_threads)
+        self.assertNotIn(threading.current_thread(), read_threads)
+
+        sent = call({'type': 'lifespan'},
+                    [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+        self.assertEqual(['lifespan.startup.complete', 'lifespan.shutdown.complete'],
+                         [m['type'] for m in sent])
+
+    @unittest.skipIf(not HAS_ASYNCIO, 'Requires asyncio')
+    def test_wsgi_with_client(self):
+        app = self.server_module.WsgiApp(self.dispatcher, prefix='/2')
+        server = simple_server.make_server(
+            '127.0.0.1', 0, app, handler_class=_QuietWSGIRequestHandler)
+        threading.Thread(target=server.serve_forever).start()
+        sa = importlib.import_module('server_pkg.stone_async')
+        client_module = importlib.import_module('server_pkg.client')
+
+        class Client(sa.HttpTransport, client_module.Base):
+            pass
+
+        client = Client('http://127.0.0.1:%d/2' % server.server_address[1])
+        loop = asyncio.new_event_loop()
+        data = _download_body(100000)
+        try:
+            run = loop.run_until_complete
+            self.assertEqual('hi', run(client.async_ns_echo('hi')).text)
+            self.assertEqual('h\u00e9', run(client.async_ns_echo_v2('h\u00e9')).text)
+            self.assertIsNone(run(client.async_ns_missing()))
+            with self.assertRaises(sa.ApiError) as cm:
+                run(client.async_ns_echo('too long'))
+            self.assertTrue(cm.exception.error.is_too_long())
+            with self.assertRaises(sa.HttpError) as cm:
+                run(client.async_ns_get('a'))
+            self.assertEqual(404, cm.exception.status)
+            self.assertEqual('up', run(client.async_ns_upload(data, 'up')).text)
+            out = io.BytesIO()
+            result = run(client.async_ns_download_to_file(out, 'file'))
+            self.assertEqual(('file', data), (result.text, out.getvalue()))
+        finally:
+            client.close()
+            loop.close()
+            server.shutdown()
+            server.server_close()
+        self.assertEqual([data], self.uploads)
 
 if __name__ == '__main__':
     unittest.main()
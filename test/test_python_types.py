@@ -1,6 +1,13 @@
+import re
 import textwrap
 
-from stone.backends.python_types import PythonTypesBackend
+import stone.backends.python_rsrc.stone_validators as bv
+from stone.backends.python_types import (
+    PythonTypesBackend,
+    data_type_fingerprint,
+    namespace_fingerprint,
+    route_fingerprint,
+)
 from stone.ir import (
     AnnotationType,
     AnnotationTypeParam,
@@ -8,6 +15,11 @@ from stone.ir import (
     ApiRoute,
     CustomAnnotation,
     Int32,
+    List,
+    Nullable,
+    RedactedBlot,
+    RedactedHash,
+    String,
     Struct,
     StructField,
     Void,
@@ -16,6 +28,7 @@ from stone.ir import (
 MYPY = False
 if MYPY:
     import typing  # noqa: F401 # pylint: disable=import-error,unused-import,useless-suppression
+    from stone.ir import DataType  # noqa: F401 # pylint: disable=unused-import
 
 import unittest
 
@@ -75,6 +88,7 @@ class TestGeneratedPythonTypes(unittest.TestCase):
                 bv.Void(),
                 bv.Void(),
                 {},
+                0xf65affa9dc73bfc7,
             )
             alpha_get_metadata_v2 = bb.Route(
                 'alpha/get_metadata',
@@ -84,6 +98,7 @@ class TestGeneratedPythonTypes(unittest.TestCase):
                 bv.Int32(),
                 bv.Void(),
                 {},
+                0xbadbc9f34ef8268f,
             )
 
             ROUTES = {
@@ -91,6 +106,8 @@ class TestGeneratedPythonTypes(unittest.TestCase):
                 'alpha/get_metadata:2': alpha_get_metadata_v2,
             }
 
+            FINGERPRINT = 0x9f1c019961bd1c15
+
         """)
 
         self.assertEqual(result, expected)
@@ -112,6 +129,61 @@ class TestGeneratedPythonTypes(unittest.TestCase):
             'There is a name conflict between {!r} and {!r}'.format(route1, route2),
             str(cm.exception))
 
+    def test_fingerprints(self):
+        # type: () -> None
+        ns = ApiNamespace('files')
+
+        def mk_struct(name, *fields):
+            # type: (typing.Text, *typing.Tuple[typing.Text, DataType]) -> Struct
+            struct = Struct(name, ns, None)
+            struct.set_attributes(None, [
+                StructField(field_name, data_type, None, None)
+                for field_name, data_type in fields])
+            return struct
+
+        s = mk_struct('S', ('a', Int32()), ('b', List(String())))
+        fingerprint = data_type_fingerprint(s)
+        self.assertTrue(re.match('^0x[0-9a-f]{16}$', fingerprint), fingerprint)
+        # Docs and other cosmetic details don't matter, but structure does.
+        self.assertEqual(
+            fingerprint,
+            data_type_fingerprint(mk_struct('S', ('a', Int32()), ('b', List(String())))))
+        changes = [
+            [('a', Int32())],
+            [('a', Int32()), ('c', List(String()))],
+            [('a', Int32()), ('b', List(Nullable(String())))],
+            [('b', List(String())), ('a', Int32())],
+            # Constraints are part of the wire contract too.
+            [('a', Int32(max_value=5)), ('b', List(String()))],
+            [('a', Int32()), ('b', List(String(max_length=10)))],
+            [('a', Int32()), ('b', List(String(pattern='[a-z]+')))],
+            [('a', Int32()), ('b', List(String(), max_items=3))],
+        ]  # type: typing.List[typing.List[typing.Tuple[typing.Text, DataType]]]
+        for fields in changes:
+            self.assertNotEqual(fingerprint, data_type_fingerprint(mk_struct('S', *fields)))
+        self.assertNotEqual(
+            data_type_fingerprint(mk_struct('S', ('a', String(max_length=10)))),
+            data_type_fingerprint(mk_struct('S', ('a', String(max_length=5)))))
+
+        # Recursive types terminate, and changes to referenced types propagate.
+        r = mk_struct('R', ('s', s))
+        r.fields.append(StructField('r', Nullable(r), None, None))
+        t = mk_struct('R', ('s', mk_struct('S', ('a', Int32()))))
+        t.fields.append(StructField('r', Nullable(t), None, None))
+        self.assertNotEqual(data_type_fingerprint(r), data_type_fingerprint(t))
+
+        route = ApiRoute('get', 1, None)
+        attrs = {'auth': 'user'}
+        route.set_attributes(None, None, s, Void(), Void(), attrs)
+        ns.add_route(route)
+        fingerprint = route_fingerprint(ns, route)
+        attrs['auth'] = 'app'
+        self.assertNotEqual(fingerprint, route_fingerprint(ns, route))
+
+        fingerprint = namespace_fingerprint(ns)
+        ns.add_data_type(s)
+        self.assertNotEqual(fingerprint, namespace_fingerprint(ns))
+
     def test_struct_with_custom_annotations(self):
         # type: () -> None
         ns = ApiNamespace('files')
@@ -163,6 +235,8 @@ class TestGeneratedPythonTypes(unittest.TestCase):
                     """
                     if self._annotated_field_present:
                         return self._annotated_field_value
+                    elif self._annotated_field_value is bb.NOT_LOADED:
+                        raise bb.NotLoadedError("field 'annotated_field' was not loaded")
                     else:
                         raise AttributeError("missing required field 'annotated_field'")
 
@@ -184,6 +258,8 @@ class TestGeneratedPythonTypes(unittest.TestCase):
                     """
                     if self._unannotated_field_present:
                         return self._unannotated_field_value
+                    elif self._unannotated_field_value is bb.NOT_LOADED:
+                        raise bb.NotLoadedError("field 'unannotated_field' was not loaded")
                     else:
                         raise AttributeError("missing required field 'unannotated_field'")
 
@@ -204,6 +280,18 @@ class TestGeneratedPythonTypes(unittest.TestCase):
                     if annotation_type is MyAnnotationType:
                         self.annotated_field = bb.partially_apply(processor, MyAnnotationType(test_param=42))('{}.annotated_field'.format(field_path), self.annotated_field)
 
+                def __getstate__(self):
+                    return (self._annotated_field_value,
+                            self._annotated_field_present,
+                            self._unannotated_field_value,
+                            self._unannotated_field_present)
+
+                def __setstate__(self, state):
+                    (self._annotated_field_value,
+                     self._annotated_field_present,
+                     self._unannotated_field_value,
+                     self._unannotated_field_present) = state
+
                 def __repr__(self):
                     return 'MyStruct(annotated_field={!r}, unannotated_field={!r})'.format(
                         self._annotated_field_value,
@@ -216,6 +304,81 @@ class TestGeneratedPythonTypes(unittest.TestCase):
         self.maxDiff = None
         self.assertEqual(result, expected)
 
+    def test_frozen_struct(self):
+        # type: () -> None
+        ns = ApiNamespace('files')
+        annotation_type = AnnotationType('MyAnnotationType', ns, None, [
+            AnnotationTypeParam('test_param', Int32(), None, False, None, None)
+        ])
+        ns.add_annotation_type(annotation_type)
+        annotation = CustomAnnotation('MyAnnotation', ns, None, 'MyAnnotationType',
+            None, [], {'test_param': 42})
+        annotation.set_attributes(annotation_type)
+        ns.add_annotation(annotation)
+        struct = Struct('MyStruct', ns, None)
+        struct.set_attributes(None, [
+            StructField('annotated_field', Int32(), None, None),
+        ])
+        struct.fields[0].set_annotations([annotation])
+
+        backend = PythonTypesBackend(target_folder_path='output', args=['--frozen'])
+        backend._generate_struct_class(ns, struct)
+        result = backend.output_buffer_to_string()
+
+        expected = textwrap.dedent('''\
+            class MyStruct(bb.FrozenStruct):
+
+                __slots__ = [
+                    '_annotated_field_value',
+                    '_annotated_field_present',
+                ]
+
+                _has_required_fields = True
+
+                def __init__(self,
+                             annotated_field=None):
+                    self._annotated_field_value = None
+                    self._annotated_field_present = False
+                    if annotated_field is not None:
+                        self._set_field_('annotated_field', annotated_field)
+
+                @property
+                def annotated_field(self):
+                    """
+                    :rtype: int
+                    """
+                    if self._annotated_field_present:
+                        return self._annotated_field_value
+                    elif self._annotated_field_value is bb.NOT_LOADED:
+                        raise bb.NotLoadedError("field 'annotated_field' was not loaded")
+                    else:
+                        raise AttributeError("missing required field 'annotated_field'")
+
+                def _process_custom_annotations(self, annotation_type, field_path, processor):
+                    super(MyStruct, self)._process_custom_annotations(annotation_type, field_path, processor)
+
+                    if annotation_type is MyAnnotationType:
+                        self._set_field_('annotated_field', bb.partially_apply(processor, MyAnnotationType(test_param=42))('{}.annotated_field'.format(field_path), self.annotated_field))
+
+                def __getstate__(self):
+                    return (self._annotated_field_value,
+                            self._annotated_field_present)
+
+                def __setstate__(self, state):
+                    (self._annotated_field_value,
+                     self._annotated_field_present) = state
+
+                def __repr__(self):
+                    return 'MyStruct(annotated_field={!r})'.format(
+                        self._annotated_field_value,
+                    )
+
+            MyStruct_validator = bv.Struct(MyStruct)
+
+        ''') # noqa
+        self.maxDiff = None
+        self.assertEqual(result, expected)
+
     def test_annotation_type_class(self):
         # type: () -> None
         ns = ApiNamespace('files')
@@ -277,4 +440,33 @@ class TestGeneratedPythonTypes(unittest.TestCase):
         ''')
         self.assertEqual(result, expected)
 
+    def test_redactor_cache_size(self):
+        # type: () -> None
+        ns = ApiNamespace('files')
+        redactors = [RedactedHash('Hash', ns, None), RedactedBlot('Blot', ns, None, '(a)b')]
+        for args, expected in [
+                ([], ["v._redact = bv.HashRedactor(None)",
+                      "v._redact = bv.BlotRedactor('(a)b')"]),
+                (['--redactor-cache-size', '100'],
+                 ["v._redact = bv.HashRedactor(None, cache_size=100)",
+                  "v._redact = bv.BlotRedactor('(a)b', cache_size=100)"])]:
+            backend = PythonTypesBackend(target_folder_path='output', args=args)
+            for redactor in redactors:
+                backend._generate_redactor('v', redactor)
+            result = backend.output_buffer_to_string()
+            self.assertEqual(expected, result.splitlines())
+
+            for line in result.splitlines():
+                scope = {'bv': bv, 'v': bv.String()}
+                exec(line, scope)  # pylint: disable=exec-used
+                # Redactors are set by generated code, so validators don't declare them.
+                redactor = getattr(scope['v'], '_redact')
+                self.assertEqual(int(args[1]) if args else 0, redactor._cache_size)
+                self.assertEqual(redactor.apply('ab'), redactor.apply('ab'))
+
+        backend = PythonTypesBackend(
+            target_folder_path='output', args=['--redactor-cache-size', '-1'])
+        with self.assertRaises(RuntimeError):
+            backend._generate_redactor('v', redactors[0])
+
     # TODO: add more unit tests for client code generation